@@ -22,19 +22,23 @@ __all__ = [
     # numcu
     'add', 'div', 'mul',
     # improc
-    'conv_separable', 'isub', 'nlm', 'aff_dist', 'centre_mass_rel',
+    'conv_separable', 'isub', 'nlm', 'aff_dist', 'aff_rigid_params', 'centre_mass_rel',
     # core
-    'create_disk', 'get_cylinder', 'imdiff', 'imscroll', 'profile_points', 'imtrimup',
-    'affine_fsl', 'affine_dipy', 'affine_niftyreg',
+    'create_disk', 'get_cylinder', 'imdiff', 'imscroll', 'profile_points', 'rasterise',
+    'imtrimup',
+    'affine_fsl', 'affine_dipy', 'affine_mi', 'affine_niftyreg',
     'array2nii', 'bias_field_correction',
     'centre_mass_img', 'centre_mass_corr', 'coreg_spm', 'coreg_vinci',
     'create_dir', 'create_mask', 'ct2mu',
     'dcm2im', 'dcm2nii', 'dcmanonym', 'dcminfo', 'dcmsort', 'isdcm', 'dcmdir',
-    'dice_coeff', 'dice_coeff_multiclass', 'fwhm2sig', 'getmgh', 'getnii', 'mgh2nii',
-    'getnii_descr', 'im_cut', 'imfill', 'imsmooth', 'iyang', 'motion_reg', 'nii_gzip',
-    'nii_modify', 'nii_ugzip', 'niisort', 'orientnii', 'pet2pet_rigid', 'pick_t1w',
-    'psf_gaussian', 'psf_measured', 'pvc_iyang', 'realign_mltp_spm', 'resample_fsl',
+    'dice_coeff', 'dice_coeff_multiclass', 'dipy_regctx', 'fwhm2sig', 'getmgh', 'getnii',
+    'mgh2nii', 'getnii_descr', 'im_cut', 'imfill', 'imsmooth', 'iyang', 'motion_reg',
+    'motion_reg_dipy', 'nii_gzip',
+    'nii_modify', 'nii_ugzip', 'nii_update_hdr', 'niisort', 'orientnii', 'pet2pet_rigid',
+    'pick_t1w', 'psf_gaussian', 'psf_kernel', 'psf_measured', 'pvc_iyang', 'pvc_session',
+    'realign_mltp_spm', 'resample_fsl', 'roi_labels',
     'resample_mltp_spm', 'resample_niftyreg', 'resample_spm', 'resample_vinci', 'resample_dipy',
+    'resample_apply', 'resample_batch', 'resample_plan',
     'time_stamp', 'rem_chars',
     # Signa
     'pifa2nii', 'nii2pifa',
@@ -42,9 +46,11 @@ __all__ = [
     'acr'
     # 'get_params', 'get_paths', 'extract_reso_part', 'sampling_masks'
     # 'create_mumap_core', 'create_nac_core', 'create_reso', 'create_sampl_reso', 'create_sampl',
-    # 'standard_analysis', 'estimate_fwhm'
+    # 'standard_analysis', 'estimate_fwhm', 'template_store', 'batch_qc', 'qc_table',
+    # 'rods_contrast'
     ] # yapf: disable
 
+from importlib import import_module
 from os import fspath
 
 try:          # py<3.9
@@ -52,75 +58,43 @@ try:          # py<3.9
 except ImportError:
     from importlib import resources as iresources
 
-try:
-    from numcu import add, div, mul
-except ImportError:
-    pass
+# > attributes imported on first access (PEP 562): name -> (module, attribute);
+# > the attribute `None` stands for the module itself
+_LAZY = {
+    'acr': ('.acr', None), 'img': ('.img', None), 'prc': ('.prc', None),
+    'cs': ('niftypet.ninst.cudasetup', None)}
+_LAZY.update((k, ('niftypet.ninst.dinf', k)) for k in ('dev_info', 'gpuinfo'))
+_LAZY.update((k, ('niftypet.ninst.tools', k))
+             for k in ('LOG_FORMAT', 'LogHandler', 'path_resources', 'resources'))
+_LAZY.update((k, ('numcu', k)) for k in ('add', 'div', 'mul'))
+_LAZY.update((k, ('.img', k)) for k in ('create_disk', 'get_cylinder', 'imdiff', 'imscroll',
+                                        'profile_points', 'rasterise', 'pifa2nii', 'nii2pifa'))
+_LAZY.update((k, ('.prc', k)) for k in __all__ if k not in _LAZY and k != 'cmake_prefix')
+
+# > optional dependencies (their attributes are missing if not installed)
+_OPTIONAL = ('numcu',)
+
+
+def __getattr__(name):
+    '''import the submodules and dependencies only when their attributes are used'''
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    mod, attr = _LAZY[name]
+    try:
+        val = import_module(mod, __name__)
+    except ImportError as exc:
+        if mod not in _OPTIONAL:
+            raise
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r} ({exc})") from exc
+    if attr is not None:
+        val = getattr(val, attr)
+    globals()[name] = val
+    return val
+
 
-from niftypet.ninst import cudasetup as cs
-from niftypet.ninst.dinf import dev_info, gpuinfo
-from niftypet.ninst.tools import LOG_FORMAT, LogHandler, path_resources, resources
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
 
-from . import acr
-from .img import create_disk, get_cylinder, imdiff, imscroll, nii2pifa, pifa2nii, profile_points
-from .prc import imtrimup  # for backward compatibility
-from .prc import (
-    aff_dist,
-    affine_dipy,
-    affine_fsl,
-    affine_niftyreg,
-    array2nii,
-    bias_field_correction,
-    centre_mass_corr,
-    centre_mass_img,
-    centre_mass_rel,
-    conv_separable,
-    coreg_spm,
-    coreg_vinci,
-    create_dir,
-    create_mask,
-    ct2mu,
-    dcm2im,
-    dcm2nii,
-    dcmanonym,
-    dcmdir,
-    dcminfo,
-    dcmsort,
-    dice_coeff,
-    dice_coeff_multiclass,
-    fwhm2sig,
-    getmgh,
-    getnii,
-    getnii_descr,
-    im_cut,
-    imfill,
-    imsmooth,
-    isdcm,
-    isub,
-    iyang,
-    mgh2nii,
-    motion_reg,
-    nii_gzip,
-    nii_modify,
-    nii_ugzip,
-    niisort,
-    nlm,
-    orientnii,
-    pet2pet_rigid,
-    pick_t1w,
-    psf_gaussian,
-    psf_measured,
-    pvc_iyang,
-    realign_mltp_spm,
-    rem_chars,
-    resample_dipy,
-    resample_fsl,
-    resample_mltp_spm,
-    resample_niftyreg,
-    resample_spm,
-    resample_vinci,
-    time_stamp,
-)
 
 # for use in `cmake -DCMAKE_PREFIX_PATH=...`
 cmake_prefix = fspath(iresources.files("niftypet.nimpa").resolve() / "cmake")
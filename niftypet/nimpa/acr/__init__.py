@@ -2,12 +2,15 @@
 __all__ = [
     'get_params', 'get_paths', 'extract_reso_part', 'sampling_masks', 'create_mumap_core',
     'create_nac_core', 'create_reso', 'create_sampl_reso', 'create_sampl', 'standard_analysis',
-    'estimate_fwhm', 'preproc']
+    'estimate_fwhm', 'preproc', 'template_store', 'batch_qc', 'qc_table', 'rods_contrast',
+    'analysis_labels', 'get_geom']
 
-from .analysis import estimate_fwhm, standard_analysis
-from .ioaux import extract_reso_part, get_paths, sampling_masks
+from .analysis import analysis_labels, estimate_fwhm, standard_analysis
+from .batch import batch_qc, qc_table
+from .ioaux import extract_reso_part, get_geom, get_paths, rods_contrast, sampling_masks
 from .params import get_params
 from .proc import preproc
+from .store import template_store
 from .templates import (
     create_mumap_core,
     create_nac_core,
@@ -6,9 +6,11 @@ from pathlib import Path
 
 import numpy as np
 import scipy
+import scipy.ndimage as ndi
 from scipy.optimize import curve_fit
 
 from ..prc import imio, prc
+from .ioaux import extract_rings, zcrop
 
 
 def erf(x, a, u, k, b):
@@ -21,70 +23,83 @@ def derf(x, a, u, k):
     return a * k * 2 / (np.pi**.5) * np.exp(-(k * (x-u))**2)
 
 
-def standard_analysis(
-        fim,
-        vois,
-        fwhm=4.,
-        patient_weight=70,  # kg
-        simulated_dose=220, # MBq
-        width_mm=10,
-        zoffset=0):
+# > VOIs of the standard ACR analysis (bit of the label volume for each)
+ACR_VOIS = ('s_i1', 's_i2', 's_i3', 's_i4', 's_bckg', 's_b', 's_w', 's_a')
+
+
+def analysis_labels(vois, voxsize, width_mm=10, zoffset=0):
     """
-    Perform the standard ACR analysis.
+    Encode the VOIs of the standard ACR analysis in a single label volume
+    (`uint8`, one bit for each of `ACR_VOIS`, so that overlapping VOIs are
+    also supported) restricted to the axial band covering all `zoffset`s.
     Arguments:
-      fim:        the input NIfTI image in high resolution.
       vois:       the masks for VOIs to perform the analysis.
-      fwhm:       the FWHM of the smoothing Gaussian kernel.
-      zoffset:    offset from the middle of the axial extension
-                  of the inserts.  By default the slice for
-                  the analysis is in the middle of the insert's
-                  axial extension.
-      patient_does: patient simulated does in MBq
-      patient_weight: patient weight in kg
+      voxsize:    voxel size of the VOIs/image (axial first).
+      width_mm:   axial width of the analysis slice.
+      zoffset:    offset(s) from the middle of the axial extension
+                  of the inserts (scalar or list).
     """
-
-    fim = Path(fim)
-    if not fim.is_file():
-        raise IOError('unrecognised input NIfTI file')
-
-    imd = imio.getnii(fim, output='all')
-
-    # > for SUV calculations
-    dose2wght = simulated_dose * 1e6 / (patient_weight*1e3)
-
-    im_smo = prc.imsmooth(imd['im'], fwhm=fwhm, voxsize=imd['voxsize'])
-
-    im_suv = im_smo / dose2wght
-
     # > axial width for standard analysis
-    width_vox = int(np.round(width_mm / imd['voxsize'][0]))
+    width_vox = int(np.round(width_mm / voxsize[0]))
 
     # > axial voxel range
     zrng = vois['r_insrt']
-
     z_start_idx = int(np.mean(zrng) - width_vox/2)
 
-    msk = np.zeros(vois['s_i1'].shape, dtype=bool)
+    zoffset = np.atleast_1d(zoffset)
+    z0 = max(z_start_idx + int(zoffset.min()), 0)
+    z1 = z_start_idx + int(zoffset.max()) + width_vox
+
+    lbl = np.zeros(vois[ACR_VOIS[0]][z0:z1].shape, dtype=np.uint8)
+    for i, v in enumerate(ACR_VOIS):
+        lbl[vois[v][z0:z1]] |= np.uint8(1 << i)
 
-    zi = z_start_idx + zoffset
-    msk[zi:zi + width_vox, ...] = True
+    return {'lbl': lbl, 'z0': z0, 'z_start_idx': z_start_idx, 'width_vox': width_vox}
+
+
+def _voi_stats(im, lbl):
+    """
+    Maximum, mean and minimum of `im` in each of `ACR_VOIS` from one grouped
+    reduction over the unique label values (VOI combinations) of `lbl`.
+    """
+    msk = lbl > 0
+    codes, inv = np.unique(lbl[msk], return_inverse=True)
+    vals = im[msk]
+    idx = np.arange(1, len(codes) + 1)
+    cmax = np.atleast_1d(ndi.maximum(vals, inv + 1, idx))
+    cmin = np.atleast_1d(ndi.minimum(vals, inv + 1, idx))
+    csum = np.bincount(inv, weights=vals, minlength=len(codes))
+    cnum = np.bincount(inv, minlength=len(codes))
+
+    stats = {}
+    for i, v in enumerate(ACR_VOIS):
+        sel = (codes & (1 << i)) > 0
+        if not sel.any():
+            stats[v] = (np.nan, np.nan, np.nan)
+            continue
+        stats[v] = (cmax[sel].max(), csum[sel].sum() / cnum[sel].sum(), cmin[sel].min())
+    return stats
+
+
+def _analysis_metrics(stats):
+    """ACR standard analysis metrics and tests from the VOI statistics"""
 
     # > (A) Contrast
-    h1 = np.float32(np.max(im_suv[vois['s_i1'] * msk]))
-    h2 = np.max(im_suv[vois['s_i2'] * msk])
-    h3 = np.max(im_suv[vois['s_i3'] * msk])
-    h4 = np.max(im_suv[vois['s_i4'] * msk])
+    h1 = np.float32(stats['s_i1'][0])
+    h2 = stats['s_i2'][0]
+    h3 = stats['s_i3'][0]
+    h4 = stats['s_i4'][0]
 
     # > (B) Scatter/Attenuation
-    bckg_avg = np.float32(np.mean(im_suv[vois['s_bckg'] * msk]))
-    bone_avg = np.mean(im_suv[vois['s_b'] * msk])
-    h2o_avg = np.mean(im_suv[vois['s_w'] * msk])
-    air_avg = np.mean(im_suv[vois['s_a'] * msk])
+    bckg_avg = np.float32(stats['s_bckg'][1])
+    bone_avg = stats['s_b'][1]
+    h2o_avg = stats['s_w'][1]
+    air_avg = stats['s_a'][1]
 
-    bckg_min = np.min(im_suv[vois['s_bckg'] * msk])
-    bone_min = np.min(im_suv[vois['s_b'] * msk])
-    h2o_min = np.min(im_suv[vois['s_w'] * msk])
-    air_min = np.min(im_suv[vois['s_a'] * msk])
+    bckg_min = stats['s_bckg'][2]
+    bone_min = stats['s_b'][2]
+    h2o_min = stats['s_w'][2]
+    air_min = stats['s_a'][2]
 
     # > Ratio Calculations
     h1_bckg = h1 / bckg_avg
@@ -109,27 +124,99 @@ def standard_analysis(
     for k in out:
         out[k] = np.float32(out[k])
 
-    test1 = bckg_avg > 0.85 and bckg_avg < 1.15
-    test2 = h1 > 1.8 and h1 < 2.8
-    test3 = h2_h1 > 0.7
+    test1 = out['bckg_avg'] > 0.85 and out['bckg_avg'] < 1.15
+    test2 = out['h1max'] > 1.8 and out['h1max'] < 2.8
+    test3 = out['h2_h1'] > 0.7
 
-    out['test_bckg_avg'] = 'PASS'*test1 + 'FAIL' * ~test1 + ': ' + str(round(bckg_avg,
-                                                                             2)) + ' (0.85-1.15)'
-    out['test_25mm_insert'] = 'PASS'*test2 + 'FAIL' * ~test2 + ': ' + str(round(h1,
-                                                                                2)) + ' (1.8-2.8)'
-    out['test_16/25_insert'] = 'PASS'*test3 + 'FAIL' * ~test3 + ': ' + str(round(h2_h1,
-                                                                                 2)) + ' (>0.7)'
+    out['test_bckg_avg'] = ('PASS' if test1 else 'FAIL') + ': ' + str(round(bckg_avg,
+                                                                            2)) + ' (0.85-1.15)'
+    out['test_25mm_insert'] = ('PASS' if test2 else 'FAIL') + ': ' + str(round(h1,
+                                                                               2)) + ' (1.8-2.8)'
+    out['test_16/25_insert'] = ('PASS' if test3 else 'FAIL') + ': ' + str(round(h2_h1,
+                                                                                2)) + ' (>0.7)'
 
     return out
 
 
-def estimate_fwhm(fim, vois, Cntd, insert='water'):
+def standard_analysis(
+        fim,
+        vois,
+        fwhm=4.,
+        patient_weight=70,  # kg
+        simulated_dose=220, # MBq
+        width_mm=10,
+        zoffset=0,
+        labels=None):
+    """
+    Perform the standard ACR analysis.
+    Arguments:
+      fim:        the input NIfTI image in high resolution.
+      vois:       the masks for VOIs to perform the analysis.
+      fwhm:       the FWHM of the smoothing Gaussian kernel.
+      zoffset:    offset from the middle of the axial extension
+                  of the inserts.  By default the slice for
+                  the analysis is in the middle of the insert's
+                  axial extension.
+      patient_does: patient simulated does in MBq
+      patient_weight: patient weight in kg
+      labels:     precomputed VOI labels (see `analysis_labels`)
+                  covering all the `zoffset`s.
+    For the sensitivity analysis, `fwhm` and/or `zoffset` can be lists, in
+    which case the list of outputs for all their combinations is returned,
+    with the `fwhm` and `zoffset` values included in each output.
+    """
+
+    fim = Path(fim)
+    if not fim.is_file():
+        raise IOError('unrecognised input NIfTI file')
+
+    imd = imio.getnii(fim, output='all')
+
+    sweep = np.ndim(fwhm) > 0 or np.ndim(zoffset) > 0
+    fwhms = list(fwhm) if np.ndim(fwhm) > 0 else [fwhm]
+    zoffs = list(zoffset) if np.ndim(zoffset) > 0 else [zoffset]
+
+    if labels is None:
+        labels = analysis_labels(vois, imd['voxsize'], width_mm=width_mm, zoffset=zoffs)
+
+    # > for SUV calculations
+    dose2wght = simulated_dose * 1e6 / (patient_weight*1e3)
+
+    nz = len(imd['im'])
+    outs = []
+    for fw in fwhms:
+        # > smooth only the label band extended by the kernel support (the
+        # > separable convolution with zero boundaries gives identical results)
+        psf = prc.psf_fwhm(fw, imd['voxsize'])
+        r = psf.shape[1] // 2
+        zc0 = max(labels['z0'] - r, 0)
+        zc1 = min(labels['z0'] + len(labels['lbl']) + r, nz)
+        im_smo = prc.imsmooth(imd['im'][zc0:zc1], psf=psf)
+
+        for zo in zoffs:
+            # > the analysis slice within the label band
+            zi = labels['z_start_idx'] + int(zo) - labels['z0']
+            if zi < 0 or (zi + labels['width_vox'] > len(labels['lbl'])
+                          and labels['z0'] + len(labels['lbl']) < nz):
+                raise ValueError('the VOI labels do not cover the z-offset of the analysis')
+            z = slice(labels['z0'] + zi - zc0, labels['z0'] + zi + labels['width_vox'] - zc0)
+
+            im_suv = im_smo[z] / dose2wght
+            out = _analysis_metrics(
+                _voi_stats(im_suv, labels['lbl'][zi:zi + labels['width_vox']]))
+            if sweep:
+                out.update(fwhm=fw, zoffset=zo)
+            outs.append(out)
+
+    return outs if sweep else outs[0]
+
+
+def estimate_fwhm(fim, vois, Cntd, insert='water', plot=True):
     ''' Estimate the effective image resolution
         for any given ACR cylindrical insert
+        (`plot=False` for no plotting and no matplotlib)
     '''
 
-    from matplotlib import pyplot as plt
-
     if isinstance(fim, (str, Path)) and Path(fim).is_file():
         im = imio.getnii(fim)
     elif isinstance(fim, np.ndarray) and fim.ndim == 3:
@@ -137,6 +224,8 @@ def estimate_fwhm(fim, vois, Cntd, insert='water'):
     else:
         raise IOError('unrecognised input file or Numpy array')
 
+    # > cropped to the sub-masks from `zmask(..., crop=True)`
+    im = zcrop(im, vois)
     if im.shape != vois['fst_insrt'].shape:
         raise ValueError('the VOIs shape is incompatible with the image')
 
@@ -162,23 +251,14 @@ def estimate_fwhm(fim, vois, Cntd, insert='water'):
     # > sampling for analytical edge functions (transaxial)
     x = np.linspace(-1, np.max(Cntd['sinsrt']) + 1)
 
-    # > extracted ring index values
-    riv = np.zeros((RIR[ins][1] - RIR[ins][0]), dtype=np.float64)
-
     res = {
         'y': np.zeros(len(x), dtype=np.float64), 'dy': np.zeros(len(x), dtype=np.float64),
         'fwhm': 0, 'peak': 0, 'parg': 0, 'mnmx': 0}
 
-    irngs = range(RIR[ins][0], RIR[ins][1])
-    nrng = len(irngs)
-
     # > extract rings
-    for i, l in enumerate(irngs):
-        if ins == 'hot3':
-            msk = tmplt3 == l
-        else:
-            msk = tmplt == l
-        riv[i] = np.sum(im[msk]) / np.sum(msk)
+    riv = extract_rings(im, tmplt3 if ins == 'hot3' else tmplt, l0=RIR[ins][0],
+                        l1=RIR[ins][1]).astype(np.float64)
+    nrng = len(riv)
 
     r = Cntd['sinsrt'][range(nrng)]
     re = x
@@ -208,14 +288,17 @@ def estimate_fwhm(fim, vois, Cntd, insert='water'):
         res['mnmx'] = np.min(riv)
     res['r'] = r
 
-    fig, ax = plt.subplots(2, 1)
-    ax[0].plot(res['r'], riv, 'o')
-    ax[0].plot(x, res['y'])
-    ax[1].plot(x, res['dy'])
-    ax[0].set_title('Insert {}: FWHM = {} mm'.format(ins, round(res['fwhm'], 2)))
-    ax[0].set_ylabel('Bq/ML')
-    ax[1].set_ylabel('Bq/ML')
-    ax[1].set_xlabel('distance from insert centre [mm]')
+    if plot:
+        from matplotlib import pyplot as plt
+
+        fig, ax = plt.subplots(2, 1)
+        ax[0].plot(res['r'], riv, 'o')
+        ax[0].plot(x, res['y'])
+        ax[1].plot(x, res['dy'])
+        ax[0].set_title('Insert {}: FWHM = {} mm'.format(ins, round(res['fwhm'], 2)))
+        ax[0].set_ylabel('Bq/ML')
+        ax[1].set_ylabel('Bq/ML')
+        ax[1].set_xlabel('distance from insert centre [mm]')
 
     res['r_values'] = riv
     return res
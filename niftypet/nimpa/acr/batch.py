@@ -0,0 +1,185 @@
+"""
+Batch QC of ACR/Jaszczak PET phantom scans: preprocessing, shared
+templates, registration, sampling and standard analysis of many scans.
+"""
+__author__ = "Pawel Markiewicz"
+__copyright__ = "Copyright 2021-23"
+import csv
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from pathlib import Path, PurePath
+
+import numpy as np
+
+from ..prc import imio, regseg
+from .analysis import estimate_fwhm, standard_analysis
+from .ioaux import extract_reso_part, get_paths, rods_contrast, sampling_masks
+from .params import get_params
+from .proc import preproc
+from .store import template_store
+
+log = logging.getLogger(__name__)
+
+
+def _scan_dict(scan):
+    '''standardise the scan input: path to the QNT PET or dictionary of NAC/QNT PET'''
+    if isinstance(scan, (str, PurePath)):
+        scan = {'qnt': scan}
+    elif not isinstance(scan, dict) or 'qnt' not in scan:
+        raise ValueError('unrecognised scan input: ' + repr(scan))
+    scan = dict(scan)
+    scan.setdefault('id', Path(scan['qnt']).name.split('.nii')[0])
+    return scan
+
+
+def _map(fn, args, max_workers):
+    '''map `fn` over the `args` tuples in a process pool (serial if `max_workers=0`)'''
+    if max_workers == 0 or not args:
+        return [fn(*a) for a in args]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(fn, *zip(*args)))
+
+
+def _qc_preproc(scan, Cntd, opth):
+    '''preprocess the NAC (if given) and QNT PET of a single scan'''
+    try:
+        if scan.get('nac'):
+            preproc(scan['nac'], Cntd, outpath=opth, mode='nac')
+        preproc(scan['qnt'], Cntd, outpath=opth, mode='qnt', reftrim=Cntd.get('fnacup', ''))
+        get_paths(Cntd, outpath=opth)
+    except Exception as e:
+        log.exception(f"preprocessing failed for scan {scan['id']}")
+        return None, repr(e)
+    return Cntd, None
+
+
+def _row_value(v):
+    '''table value of a metric'''
+    return v.item() if isinstance(v, np.generic) else v
+
+
+def _qc_analysis(scan, Cntd, opts):
+    '''register templates, sample and analyse a single preprocessed scan'''
+    row = {'scan': scan['id'], 'error': None}
+    if not opts['headless']:
+        import matplotlib
+        matplotlib.use('Agg')
+
+    try:
+        dipy_kw = {
+            'rfwhm': Cntd['fwhm_tmpl'], 'ffwhm': Cntd['fwhm_tmpl'], 'sigmas': Cntd['dipy_sgms'],
+            'factors': Cntd['dipy_fcts'], 'verbose': False}
+
+        # > core/main part of the phantom (NAC PET if available)
+        fref = Cntd['fnacup'] if 'fnacup' in Cntd else Cntd['fqntup']
+        regseg.affine_dipy(fref, Cntd['out']['facrad'], faffine=Cntd['out']['faff'],
+                           outpath=os.path.dirname(Cntd['out']['faff']),
+                           level_iters=Cntd['dipy_itrs'], **dipy_kw)
+
+        # > resolution rods
+        extract_reso_part(Cntd)
+        regseg.affine_dipy(Cntd['out']['fpet_res'], Cntd['out']['fresdQmu'],
+                           faffine=Cntd['out']['faff_res'],
+                           outpath=os.path.dirname(Cntd['out']['faff_res']),
+                           level_iters=Cntd['dipy_rods_itrs'], **dipy_kw)
+
+        # > sampling and the standard analysis
+        masks = sampling_masks(Cntd)
+        sa = standard_analysis(Cntd['fqntup'], masks, fwhm=opts['fwhm'],
+                               patient_weight=opts['patient_weight'],
+                               simulated_dose=opts['simulated_dose'], zoffset=opts['zoffset'])
+        row.update({k: _row_value(v) for k, v in sa.items()})
+
+        im = imio.getnii(Cntd['fqntup'])
+        rods = rods_contrast(Cntd, masks, im)
+        for nom, c, r in zip(Cntd['rods_nom'], rods['contrast'], rods['ratios']):
+            row[f'rods_{nom}_contrast'] = _row_value(c)
+            row[f'rods_{nom}_ratio'] = _row_value(r)
+
+        for ins in opts['fwhm_inserts']:
+            res = estimate_fwhm(im, masks, Cntd, insert=ins, plot=not opts['headless'])
+            row[f'fwhm_{ins}'] = _row_value(res['fwhm'])
+            if not opts['headless']:
+                from matplotlib import pyplot as plt
+                plt.savefig(os.path.join(Cntd['opth'], f'acr-fwhm-{ins}.png'))
+                plt.close('all')
+
+    except Exception as e:
+        log.exception(f"analysis failed for scan {scan['id']}")
+        row['error'] = repr(e)
+
+    return row
+
+
+def batch_qc(scans, outpath, cpath=None, store=None, fwhm=4., patient_weight=70,
+             simulated_dose=220, zoffset=0, fwhm_inserts=('water', 'air', 'bone'),
+             max_workers=None, headless=True, fcsv=None):
+    '''
+    Batch QC of ACR phantom scans.  The templates are shared across the scans
+    through the template store and the per-scan preprocessing, registration
+    and analysis run in a process pool.
+    Arguments:
+        scans:      list of scans, each given as the path to the QNT PET (DICOM
+                    folder or NIfTI) or a dictionary with the keys 'qnt', and
+                    optionally 'nac' (NAC PET for the core registration) and 'id'.
+        outpath:    output folder; each scan is processed in its 'id' subfolder.
+        cpath:      path of custom ACR design files (see `get_params`).
+        store:      folder of the template store (see `template_store`).
+        fwhm, patient_weight, simulated_dose, zoffset: see `standard_analysis`.
+        fwhm_inserts: inserts for the resolution (FWHM) estimates.
+        max_workers: number of processes (`0` for serial processing).
+        headless:   no plotting and no matplotlib import; otherwise the
+                    resolution estimate figures are saved for each scan.
+        fcsv:       output CSV file of the results table (default in `outpath`).
+    Returns dictionary of the table columns, rows (one per scan) and the CSV file.
+    '''
+    scans = [_scan_dict(s) for s in scans]
+    if len({s['id'] for s in scans}) != len(scans):
+        raise ValueError('the scan IDs are not unique')
+
+    outpath = Path(outpath)
+    imio.create_dir(outpath)
+    Cntd0 = get_params(cpath)
+
+    # > preprocessing
+    args = [(s, deepcopy(Cntd0), outpath / s['id']) for s in scans]
+    pre = _map(_qc_preproc, args, max_workers)
+
+    # > templates generated once for all the scans (point the scans to the store)
+    for i, (s, (Cntd, _)) in enumerate(zip(scans, pre)):
+        if Cntd is not None:
+            try:
+                template_store(Cntd, store=store)
+            except Exception as e:
+                log.exception(f"templates failed for scan {s['id']}")
+                pre[i] = (None, repr(e))
+
+    # > registration and analysis
+    opts = {
+        'fwhm': fwhm, 'patient_weight': patient_weight, 'simulated_dose': simulated_dose,
+        'zoffset': zoffset, 'fwhm_inserts': tuple(fwhm_inserts), 'headless': headless}
+    args = [(s, Cntd, opts) for s, (Cntd, _) in zip(scans, pre) if Cntd is not None]
+    rows = {r['scan']: r for r in _map(_qc_analysis, args, max_workers)}
+    rows = [rows.get(s['id'], {'scan': s['id'], 'error': err}) for s, (_, err) in zip(scans, pre)]
+
+    return qc_table(rows, fcsv=outpath / 'acr-qc.csv' if fcsv is None else fcsv)
+
+
+def qc_table(rows, fcsv=None):
+    '''
+    Put the QC rows (dictionaries) together into a table with the union of all
+    columns (in the order of appearance), and save it to CSV file `fcsv`.
+    '''
+    cols = []
+    for r in rows:
+        cols += [k for k in r if k not in cols]
+
+    if fcsv is not None:
+        with open(fcsv, 'w', newline='') as f:
+            wrt = csv.DictWriter(f, fieldnames=cols)
+            wrt.writeheader()
+            wrt.writerows(rows)
+
+    return {'columns': cols, 'rows': rows, 'fcsv': fcsv}
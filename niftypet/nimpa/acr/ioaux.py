@@ -2,19 +2,14 @@
 __author__ = "Pawel Markiewicz"
 __copyright__ = "Copyright 2021-23"
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path, PurePath
 
-import dipy.align as align
 import nibabel as nib
 import numpy as np
 
-try:
-    import matplotlib.patches as patches
-    import matplotlib.pyplot as plt
-except ImportError:
-    pass
-
-from ..prc import imio
+from ..prc import imio, regseg
 
 # INPUT/OUTPUT
 
@@ -216,14 +211,55 @@ def extract_reso_part(Cntd, offset=15, forced=False):
         return None
 
 
-def sampling_masks(Cntd, use_stored=False):
+# > pending asynchronous writes of the sampling masks (file path: future)
+_PENDING = {}
+_PERSIST_POOL = None
+
+
+def _save_mask(im, A, fpth):
+    '''save the label mask (NIfTI orientation) as uint16 NIfTI file (atomically)'''
+    fd, ftmp = tempfile.mkstemp(suffix='.nii.gz', dir=os.path.dirname(fpth))
+    os.close(fd)
+    try:
+        nib.save(nib.Nifti1Image(im.astype(np.uint16, copy=False), A), ftmp)
+        os.replace(ftmp, fpth)
+    finally:
+        if os.path.isfile(ftmp):
+            os.remove(ftmp)
+
+
+def wait_masks(fpths=None):
+    '''
+    Wait for the asynchronous writes of the sampling masks (see `sampling_masks`)
+    to finish, for the given mask files or all of them.
+    '''
+    for f in list(_PENDING) if fpths is None else [os.fspath(f) for f in fpths]:
+        if f in _PENDING:
+            try:
+                _PENDING[f].result()
+            finally:
+                _PENDING.pop(f, None)
+
+
+def sampling_masks(Cntd, use_stored=False, persist=True):
     ''' get the sampling masks for analysis of the ACR phantom
+        The templates sharing the same affine are resampled (nearest neighbour)
+        with one sampling grid and kept in memory as uint16 label arrays.
+        persist: save the masks to NIfTI files (True), in a background thread
+        ('async', see `wait_masks`) or not at all (False).
     '''
+    global _PERSIST_POOL
 
     if 'fqntup' in Cntd and Path(Cntd['fqntup']).is_file():
         fimup = str(Cntd['fqntup'])
     else:
         raise ValueError('Upscaled and trimmed ACR PET image cannot be found')
+    if persist not in (True, False, 'async'):
+        raise ValueError('unrecognised persist option: ' + repr(persist))
+
+    # > orientation of the PET image (as given by `getnii`)
+    geom = get_geom(Cntd)
+    fl = tuple(slice(None, None, -f) for f in geom['flip'])
 
     # prepare output folder
     smpl_dir = os.path.join(os.path.dirname(Cntd['out']['fmuf']), 'sampling_masks')
@@ -234,6 +270,10 @@ def sampling_masks(Cntd, use_stored=False):
     # > made by registering the templates to PET space.
     vois = {}
 
+    # > templates (and their output in PET space) grouped by the affine and
+    # > geometry, so that the sampling grid is computed once for each group
+    fvois = {}
+    groups = {}
     for t in (t for t in Cntd['out'] if t[:4] == 'fst_'):
         fpth = Cntd['out'][t]
 
@@ -243,35 +283,39 @@ def sampling_masks(Cntd, use_stored=False):
             raise ValueError('The sampling template file does not exists.')
 
         # template in PET space
-        fvois = os.path.join(smpl_dir, os.path.basename(fpth).split('.nii.gz')[0] + '_dipy.nii.gz')
-
-        # if the resampled template does not exist, resample it
-        if not use_stored or not os.path.isfile(fvois):
-            if t == 'fst_res':
-                faff = Cntd['out']['faff_res']
-            else:
-                faff = Cntd['out']['faff']
-
-            print('i> using this affine for resampling:\n   ', faff)
-
-            affine = np.load(faff)
-
-            static, static_affine, moving, moving_affine, between_affine = (
-                align._public._handle_pipeline_inputs(fpth, fimup, moving_affine=None,
-                                                      static_affine=None, starting_affine=affine))
+        fvois[t] = os.path.join(smpl_dir,
+                                os.path.basename(fpth).split('.nii.gz')[0] + '_dipy.nii.gz')
 
-            affine_map = align._public.AffineMap(between_affine, static.shape, static_affine,
-                                                 moving.shape, moving_affine)
-
-            rsmpl = affine_map.transform(moving, interpolation='nearest')
-
-            smpl_nii = nib.Nifti1Image(np.int32(rsmpl), static_affine)
-            nib.save(smpl_nii, fvois)
-
-            del moving, static
-
-        vois[t] = imio.getnii(fvois)
+        # > stored masks (once any pending write is finished)
+        wait_masks([fvois[t]])
+        if use_stored and os.path.isfile(fvois[t]):
+            vois[t] = imio.getnii(fvois[t]).astype(np.uint16, copy=False)
+            continue
 
+        # if the resampled template does not exist, resample it
+        faff = Cntd['out']['faff_res'] if t == 'fst_res' else Cntd['out']['faff']
+        hdr = nib.load(fpth).header
+        key = (str(faff), hdr.get_data_shape(), hdr.get_best_affine().tobytes())
+        groups.setdefault(key, []).append(t)
+
+    for (faff, _, _), tmpls in groups.items():
+        print('i> using this affine for resampling:\n   ', faff)
+        rsmpl = regseg.resample_batch(fimup, [Cntd['out'][t] for t in tmpls], faff=faff, intrp=0,
+                                      save=False)
+        for t, im in zip(tmpls, rsmpl['im']):
+            im = im.astype(np.uint16, copy=False)
+            if persist == 'async':
+                if _PERSIST_POOL is None:
+                    _PERSIST_POOL = ThreadPoolExecutor(max_workers=1)
+                _PENDING[fvois[t]] = _PERSIST_POOL.submit(_save_mask, im, geom['affine'],
+                                                          fvois[t])
+            elif persist:
+                _save_mask(im, geom['affine'], fvois[t])
+
+            # > the mask in the orientation of `getnii`
+            vois[t] = np.ascontiguousarray(im[fl].transpose(geom['transpose']))
+
+    for t in fvois:
         # > masks/vois for standard analysis of the ACR phantom
         # > also get the axial range of each concentric VOIs
 
@@ -320,17 +364,70 @@ def sampling_masks(Cntd, use_stored=False):
     return vois
 
 
-def zmask(masks, key, Cntd, axial_offset=8, width_mm=10, z_start_idx=None, level=None):
+def get_geom(Cntd):
+    '''
+    Get the geometry of the upscaled and trimmed QNT PET image (shape, voxel
+    size, affine and orientation as given by `getnii`) from its header only,
+    cached in `Cntd['geom']` for the repeated sampling.
+    '''
+    if 'fqntup' not in Cntd:
+        raise ValueError('Upscaled and trimmed ACR PET image cannot be found')
+    fim = os.fspath(Cntd['fqntup'])
+
+    geom = Cntd.get('geom')
+    if geom is None or geom['fim'] != fim:
+        if not os.path.isfile(fim):
+            raise ValueError('Upscaled and trimmed ACR PET image cannot be found')
+        nim = nib.load(fim)
+        ornt = nib.io_orientation(nim.affine)
+        trnsp = tuple(np.flip(np.argsort(ornt[:, 0])))
+        ndim = nim.header.get('dim')[0]
+        geom = {
+            'fim': fim, 'affine': nim.affine, 'transpose': trnsp,
+            'flip': tuple(np.int8(ornt[:, 1])),
+            'voxsize': nim.header.get('pixdim')[1:ndim + 1][np.array(trnsp)],
+            'shape': tuple(int(d) for d in nim.header.get('dim')[1:ndim + 1][np.array(trnsp)])}
+        Cntd['geom'] = geom
+    return geom
+
+
+# > label ranges (template, first and last label) of the standard ACR sub-masks
+ZMSK_LABELS = {
+    'msk_bckg': ('fst_ibckg', 200, 204), 'msk_i1': ('fst_insrt', 10, 14),
+    'msk_i2': ('fst_insrt', 20, 24), 'msk_i3': ('fst_insrt3', 30, 34),
+    'msk_i4': ('fst_insrt', 40, 44), 'msk_w': ('fst_insrt', 50, 54),
+    'msk_a': ('fst_insrt', 70, 74), 'msk_b': ('fst_insrt', 90, 94)}
+
+
+class ZMasks(dict):
+    '''
+    Dictionary of the axial sub-masks given by `zmask`.  The standard ACR
+    sub-masks (see `ZMSK_LABELS`) are derived from the masked label templates
+    on first access and then kept.
+    '''
+    def __missing__(self, key):
+        if key not in ZMSK_LABELS or ZMSK_LABELS[key][0] not in self:
+            raise KeyError(key)
+        t, l0, l1 = ZMSK_LABELS[key]
+        msk = (self[t] >= l0) & (self[t] <= l1)
+        self[key] = msk
+        return msk
+
+
+def zmask(masks, key, Cntd, axial_offset=8, width_mm=10, z_start_idx=None, level=None,
+          crop=False):
     '''
     Obtain a sub-mask for the standard ACR analysis using 1 cm slice.
     Arguments:
         width_mm: axial width of the ROI mask (in mm)
+        crop:     if True, the masked templates are views of `masks` cropped to
+                  the bounding box ('bbox') of their labels within the axial
+                  slice, instead of full-size arrays; the sampling functions
+                  crop the full-size image to 'bbox' accordingly.
     '''
 
-    if 'fqntup' in Cntd and Path(Cntd['fqntup']).is_file():
-        imupd = imio.getnii(Cntd['fqntup'], output='all')
-    else:
-        raise ValueError('Upscaled and trimmed ACR PET image cannot be found')
+    # > image geometry without reloading the image
+    geom = get_geom(Cntd)
 
     if level is None:
         zax = np.sum(masks[key], axis=(1, 2))
@@ -339,81 +436,90 @@ def zmask(masks, key, Cntd, axial_offset=8, width_mm=10, z_start_idx=None, level
     zax = np.where(zax > 0)[0]
 
     # width of axial voxel extension
-    width_vox = int(np.round(width_mm / imupd['voxsize'][0]))
+    width_vox = int(np.round(width_mm / geom['voxsize'][0]))
 
     # the range
     z0 = zax[0] + axial_offset
     z1 = zax[-1] - axial_offset # wip: maybe -width_vox
 
-    msk = np.zeros(masks[key].shape, dtype=bool)
-
     if z_start_idx is None:
         z_start_idx = z0
 
-    msk[z_start_idx:z_start_idx + width_vox, ...] = True
-
-    zmasks = {
-        'z0': z0, 'z1': z1, 'zax': zax, 'width_vox': width_vox, 'z_start_idx': z_start_idx,
-        'msk': msk}
-    zmasks[key] = masks[key] * msk
-
-    if key == 'fst_insrt':
-        # 6 cm diameter ROI for ACR background
-        msk_bck = (masks['fst_ibckg'] >= 200) & (masks['fst_ibckg'] < 205) * zmasks['msk']
-        # all the inserts
-        msk_i1 = (masks['fst_insrt'] <= 14) & (masks['fst_insrt'] >= 10) * zmasks['msk']
-        msk_i2 = (masks['fst_insrt'] <= 24) & (masks['fst_insrt'] >= 20) * zmasks['msk']
-        msk_i3 = (masks['fst_insrt3'] <= 34) & (masks['fst_insrt3'] >= 30) * zmasks['msk']
-        msk_i4 = (masks['fst_insrt'] <= 44) & (masks['fst_insrt'] >= 40) * zmasks['msk']
-        msk_w = (masks['fst_insrt'] <= 54) & (masks['fst_insrt'] >= 50) * zmasks['msk']
-        msk_a = (masks['fst_insrt'] <= 74) & (masks['fst_insrt'] >= 70) * zmasks['msk']
-        msk_b = (masks['fst_insrt'] <= 94) & (masks['fst_insrt'] >= 90) * zmasks['msk']
-
-        zmasks['msk_bckg'] = msk_bck
-        zmasks['msk_i1'] = msk_i1
-        zmasks['msk_i2'] = msk_i2
-        zmasks['msk_i3'] = msk_i3
-        zmasks['msk_i4'] = msk_i4
-        zmasks['msk_w'] = msk_w
-        zmasks['msk_a'] = msk_a
-        zmasks['msk_b'] = msk_b
-
-        zmasks['fst_ibckg'] = masks['fst_ibckg'] * msk
-
-        zmasks[key + '3'] = masks[key + '3'] * msk
+    zmasks = ZMasks(z0=z0, z1=z1, zax=zax, width_vox=width_vox, z_start_idx=z_start_idx)
+
+    # > masked templates (the insert templates include the background and 3rd insert)
+    tmpls = [key] + (['fst_ibckg', key + '3'] if key == 'fst_insrt' else [])
+    zsl = slice(z_start_idx, z_start_idx + width_vox)
+
+    if crop:
+        # > transaxial bounding box of all the labels within the axial slice
+        lbl = np.zeros(masks[key].shape[1:], dtype=bool)
+        for t in tmpls:
+            lbl |= np.any(masks[t][zsl], axis=0)
+        iy, ix = np.where(np.any(lbl, axis=1))[0], np.where(np.any(lbl, axis=0))[0]
+        bbox = (zsl, slice(iy[0], iy[-1] + 1) if len(iy) else slice(0, 0),
+                slice(ix[0], ix[-1] + 1) if len(ix) else slice(0, 0))
+        zmasks.update({t: masks[t][bbox] for t in tmpls})
+        zmasks.update(bbox=bbox, shape=masks[key].shape,
+                      msk=np.ones(zmasks[key].shape, dtype=bool))
+    else:
+        msk = np.zeros(masks[key].shape, dtype=bool)
+        msk[zsl, ...] = True
+        zmasks['msk'] = msk
+        zmasks.update({t: masks[t] * msk for t in tmpls})
 
     return zmasks
 
 
+def zcrop(im, masks):
+    '''
+    Crop the full-size image to the bounding box of the cropped sub-masks from
+    `zmask` (as a view); other images and masks are returned unchanged.
+    '''
+    if 'bbox' in masks and im.shape == tuple(masks['shape']):
+        return im[masks['bbox']]
+    return im
+
+
 def extract_rings(img, tmpl, l0=None, l1=None):
     """
     extract average ROI ring values from PET image using the high resolution templates.
+    All the ring averages (labels `l0` to `l1-1`) are obtained at once by grouped
+    sums (`bincount`) over the template voxels of the rings.  The image can also
+    be a sequence (or 4D array) of images sampled with the same template, giving
+    a 2D array of rings x images.
     """
 
-    tmpl = np.int32(tmpl)
-
-    # unique ring labels (id values)
-    urs = np.unique(tmpl)
+    tmpl = np.asanyarray(tmpl)
+    if not np.issubdtype(tmpl.dtype, np.integer):
+        tmpl = np.int32(tmpl)
 
     if l0 is None:
-        l0 = np.min(urs)
+        l0 = int(np.min(tmpl))
     if l1 is None:
-        l1 = np.max(urs) + 1
-
-    # rings ids (labels)
-    irngs = range(l0, l1)
+        l1 = int(np.max(tmpl)) + 1
 
     # number of rings (labels)
-    nrng = len(irngs)
+    nrng = l1 - l0
+
+    # > template voxels of the rings and their ring indices
+    sel = (tmpl >= l0) & (tmpl < l1)
+    idx = tmpl[sel].astype(np.intp) - l0
+    cnt = np.bincount(idx, minlength=nrng)
+
+    multi = not (isinstance(img, np.ndarray) and img.ndim == tmpl.ndim)
+    imgs = list(img) if multi else [img]
+    nimg = len(imgs)
 
-    # initialise array for storing average voxel values for any label
-    vrngs = np.zeros(nrng, dtype=np.float32)
+    # > ring sums of all the images in one go (ring indices offset for each image)
+    sums = np.bincount((idx + nrng * np.arange(nimg)[:, None]).ravel(),
+                       weights=np.concatenate([np.asanyarray(im)[sel] for im in imgs]),
+                       minlength=nrng * nimg).reshape(nimg, nrng)
 
-    for i, l in enumerate(irngs):
-        msk = tmpl == l
-        vrngs[i] = np.sum(img[msk]) / np.sum(msk)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vrngs = (sums / cnt).T.astype(np.float32)
 
-    return vrngs
+    return vrngs if multi else vrngs[:, 0]
 
 
 def plot_hotins(im, masks, Cntd, inserts=None, axes=None, ylim=None, colour='k', marker_sz=3.5,
@@ -427,6 +533,11 @@ def plot_hotins(im, masks, Cntd, inserts=None, axes=None, ylim=None, colour='k',
               (1: the biggest, 4: the smallest)
       draw_back: if True, draws insert walls in the background
     """
+    import matplotlib.patches as patches
+    import matplotlib.pyplot as plt
+
+    im = zcrop(im, masks)
+
     if inserts is None:
         inserts = [1, 2, 3, 4]
 
@@ -481,6 +592,11 @@ def plot_hotins(im, masks, Cntd, inserts=None, axes=None, ylim=None, colour='k',
 def plot_coldins(im, Cntd, masks, ylim=None, line_style='.-', colour='k', axes=None,
                  draw_bckg=True):
     """plot sampling rings in cold insert regions of water, air and bone"""
+    import matplotlib.patches as patches
+    import matplotlib.pyplot as plt
+
+    im = zcrop(im, masks)
+
     if axes is None:
         _, axs = plt.subplots(1, 3)
     else:
@@ -561,6 +677,11 @@ def plot_coldins(im, Cntd, masks, ylim=None, line_style='.-', colour='k', axes=N
 def plot_uniformity(im, Cntd, masks, inserts_area=True, uniform_area=True, ylim=None,
                     ring_draw_ymin=None, ring_drw_ymax=None, grid=False, axis=None):
     """plot the uniformity regions using 18 sampling rings"""
+    import matplotlib.patches as patches
+    import matplotlib.pyplot as plt
+
+    im = zcrop(im, masks)
+
     if axis is None:
         _, ax = plt.subplots(1)
     else:
@@ -597,14 +718,14 @@ def plot_uniformity(im, Cntd, masks, inserts_area=True, uniform_area=True, ylim=
     plt.show()
 
 
-def plot_rods(Cntd, masks, im, color='k', ylim=None, pick_rods=None, draw_rods=True,
-              contrast_ref=None, line_style='.-', out_raw=False):
+def rods_contrast(Cntd, masks, im, pick_rods=None, contrast_ref=None):
     """
-    Calculate the resolution curves for each set of rod diameters.
-    Return the contrast for each rod set.
+    Calculate the resolution curves for each set of rod diameters (no plotting).
+    Returns dictionary of the contrast and ratio for each rod set, and the raw
+    ring values for each selected rod set.
     """
 
-    # pick the rods for which to plot the recovery
+    # pick the rods for which to calculate the recovery
     if pick_rods is None:
         pick_rods = range(0, len(Cntd['rods_nrngs']))
 
@@ -615,18 +736,14 @@ def plot_rods(Cntd, masks, im, color='k', ylim=None, pick_rods=None, draw_rods=T
     # raw values for each ring and selected rod
     rawval = np.zeros((len(pick_rods), np.max(Cntd['rods_nrngs'][pick_rods])), dtype=np.float32)
 
-    # sampling
-    for k, (nrng, off, rad) in enumerate(
-            zip(Cntd['rods_nrngs'][pick_rods], Cntd['rods_off'][pick_rods],
-                Cntd['rods_rad'][pick_rods])):
-
-        print(f'# sampling rings {nrng} with offset {off} and radius {rad}')
+    # > sampling of all the rings of the selected rods at once
+    nrngs, offs = Cntd['rods_nrngs'][pick_rods], Cntd['rods_off'][pick_rods]
+    l0 = np.min(offs)
+    vall = extract_rings(zcrop(im, masks), masks['fst_res'], l0=l0, l1=np.max(offs + nrngs))
 
-        vrng = np.zeros(nrng, dtype=np.float32)
-        for i in range(nrng):
-            msk = masks['fst_res'] == i + off
-            vrng[i] = np.sum(im[msk]) / np.sum(msk)
+    for k, (nrng, off) in enumerate(zip(nrngs, offs)):
 
+        vrng = vall[off - l0:off - l0 + nrng]
         rawval[k, :nrng] = vrng
 
         ratios[k] = vrng[-1] / vrng[0]
@@ -635,7 +752,30 @@ def plot_rods(Cntd, masks, im, color='k', ylim=None, pick_rods=None, draw_rods=T
         else:
             cntrst[k] = (vrng[-1] - vrng[0]) / contrast_ref
 
-        plt.plot(Cntd['rods_rngc'][:nrng], vrng, line_style, color=color)
+    return {'contrast': cntrst, 'ratios': ratios, 'rawval': rawval}
+
+
+def plot_rods(Cntd, masks, im, color='k', ylim=None, pick_rods=None, draw_rods=True,
+              contrast_ref=None, line_style='.-', out_raw=False):
+    """
+    Calculate the resolution curves for each set of rod diameters.
+    Return the contrast for each rod set.
+    """
+    import matplotlib.pyplot as plt
+
+    # pick the rods for which to plot the recovery
+    if pick_rods is None:
+        pick_rods = range(0, len(Cntd['rods_nrngs']))
+
+    rods = rods_contrast(Cntd, masks, im, pick_rods=pick_rods, contrast_ref=contrast_ref)
+
+    for k, (nrng, off, rad) in enumerate(
+            zip(Cntd['rods_nrngs'][pick_rods], Cntd['rods_off'][pick_rods],
+                Cntd['rods_rad'][pick_rods])):
+
+        print(f'# sampling rings {nrng} with offset {off} and radius {rad}')
+
+        plt.plot(Cntd['rods_rngc'][:nrng], rods['rawval'][k, :nrng], line_style, color=color)
 
     if draw_rods:
         for rx in Cntd['rods_rad'][pick_rods]:
@@ -646,4 +786,4 @@ def plot_rods(Cntd, masks, im, color='k', ylim=None, pick_rods=None, draw_rods=T
     plt.title('ACR resolution rods')
     plt.show()
 
-    return rawval if out_raw else (cntrst, ratios)
+    return rods['rawval'] if out_raw else (rods['contrast'], rods['ratios'])
@@ -0,0 +1,156 @@
+"""
+ACR/Jaszczak PET phantom templates as axially extruded slabs.
+A slab template is a list of unique 2D transaxial slices, each with its
+axial extent (run length), which is enough to describe the phantom design
+without the full high-resolution 3D array.
+"""
+__author__ = "Pawel Markiewicz"
+__copyright__ = "Copyright 2021-23"
+from os import fspath
+
+import nibabel as nib
+import numpy as np
+import scipy.ndimage as ndi
+from nibabel.openers import Opener
+
+
+def slab(parts, dtype=None):
+    '''
+    Create slab template from the list of `parts` given as tuples of
+    (2D slice, axial extent in voxels); the 2D slice can be `None` for zero
+    (empty) parts.  The first part is the top (first axial index).
+    '''
+    shp = next((s.shape for s, _ in parts if s is not None), None)
+    if shp is None:
+        raise ValueError('at least one of the slab parts needs a 2D slice')
+    if any(s is not None and s.shape != shp for s, _ in parts):
+        raise ValueError('all the 2D slices of the slab need to be of the same shape')
+    if dtype is None:
+        dtype = np.result_type(*[s.dtype for s, _ in parts if s is not None])
+    return {
+        'slices': [s for s, k in parts if k > 0], 'k': [int(k) for _, k in parts if k > 0],
+        'shape2d': shp, 'dtype': np.dtype(dtype)}
+
+
+def slab_shape(slb):
+    '''shape of the full 3D array of the slab template'''
+    return (sum(slb['k']),) + tuple(slb['shape2d'])
+
+
+def slab_pad(slb, pad):
+    '''pad the slab with zeros (`pad` as in `np.pad` for the 3D array)'''
+    (z0, z1), ypad, xpad = pad
+    out = slab([(None if s is None else np.pad(s, (ypad, xpad)), k)
+                for s, k in [(None, z0)] + list(zip(slb['slices'], slb['k'])) + [(None, z1)]],
+               dtype=slb['dtype'])
+    shp = tuple(n + sum(p) for n, p in zip(slb['shape2d'], (ypad, xpad)))
+    out['shape2d'] = shp
+    return out
+
+
+def slab_flip(slb):
+    '''flip the slab axially (up-side down)'''
+    return dict(slb, slices=slb['slices'][::-1], k=slb['k'][::-1])
+
+
+def _slab_slice(slb, s):
+    '''the 2D slice of the slab (with zeros for `None`)'''
+    return np.zeros(slb['shape2d'], dtype=slb['dtype']) if s is None else s.astype(slb['dtype'])
+
+
+def slab_array(slb):
+    '''materialise the full 3D array of the slab template'''
+    out = np.empty(slab_shape(slb), dtype=slb['dtype'])
+    z = 0
+    for s, k in zip(slb['slices'], slb['k']):
+        out[z:z + k] = _slab_slice(slb, s)
+        z += k
+    return out
+
+
+def slab_index(slb):
+    '''part index for each axial position of the full 3D array'''
+    return np.repeat(np.arange(len(slb['k'])), slb['k'])
+
+
+def slab_zoom(slb, zoom, order=1):
+    '''
+    Zoom the slab template as `ndi.zoom(slab_array(slb), zoom, order=1,
+    mode='constant')` does, but directly from the 2D slices: each unique slice
+    is zoomed once in 2D and the axial linear interpolation combines the
+    zoomed slices (trilinear interpolation is separable).
+    '''
+    if order != 1:
+        raise ValueError('only linear interpolation is supported for slab zooming')
+
+    nz = sum(slb['k'])
+    onz = int(round(nz * zoom))
+
+    # > 2D zoomed unique slices
+    zsl = [
+        None if s is None else ndi.zoom(s.astype(np.float64), zoom, order=1, mode='constant')
+        for s in slb['slices']]
+    oshp = next(s.shape for s in zsl if s is not None)
+
+    # > axial sampling coordinates as in `ndi.zoom` (corners aligned)
+    zc = np.arange(onz) * ((nz-1) / (onz-1) if onz > 1 else 0)
+    z0 = np.floor(zc).astype(np.int64)
+    w1 = zc - z0
+    z1 = np.minimum(z0 + 1, nz - 1)
+    idx = slab_index(slb)
+
+    out = np.zeros((onz,) + oshp, dtype=slb['dtype'])
+    intg = np.issubdtype(slb['dtype'], np.integer)
+    for i in range(onz):
+        p0, p1 = idx[z0[i]], idx[z1[i]]
+        acc = np.zeros(oshp)
+        if zsl[p0] is not None:
+            acc += (1 - w1[i]) * zsl[p0]
+        if zsl[p1] is not None and w1[i] > 0:
+            acc += w1[i] * zsl[p1]
+        out[i] = np.rint(acc) if intg else acc
+    return out
+
+
+def slab2nii(slb, A, fnii, descrip='', trnsp=None, flip=None):
+    '''
+    Save the slab template to NIfTI file as `imio.array2nii` would do with
+    the full 3D array, but streaming the axial slices one after another.
+    '''
+    trnsp = tuple(trnsp) if trnsp else (2, 1, 0)
+    flip = tuple(flip) if flip else (-1, -1, -1)
+    if trnsp[2] != 0:
+        from ..prc import imio
+        return imio.array2nii(slab_array(slb), A, fnii, descrip=descrip, trnsp=trnsp, flip=flip)
+
+    shp = slab_shape(slb)
+    dtype = slb['dtype']
+
+    # > header as NiBabel makes it for the full image
+    img = nib.Nifti1Image(np.zeros((1, 1, 1), dtype=dtype), A, dtype=dtype)
+    img.update_header()
+    hdr = img.header
+    hdr.set_data_shape(tuple(shp[t] for t in trnsp))
+    hdr.set_sform(None, code='scanner')
+    vals = [_slab_slice(slb, s) for s in slb['slices']]
+    hdr['cal_max'] = max(v.max() for v in vals)
+    hdr['cal_min'] = min(v.min() for v in vals)
+    hdr['descrip'] = descrip
+    # > no scaling of the stored values (as written by NiBabel)
+    hdr['scl_slope'], hdr['scl_inter'] = 1, 0
+
+    # > transaxial axes of the NIfTI planes and flipping (as in `array2nii`)
+    t2d = (trnsp[0] - 1, trnsp[1] - 1)
+    fl2d = (slice(None, None, -flip[0]), slice(None, None, -flip[1]))
+    parts = list(zip(vals, slb['k']))
+    if flip[2] == 1:
+        parts = parts[::-1]
+
+    # > (compressed) file opened as NiBabel does for saving
+    with Opener(fspath(fnii), 'wb') as f:
+        hdr.write_to(f)
+        f.write(b'\x00' * (int(hdr['vox_offset']) - f.tell()))
+        for v, k in parts:
+            blk = v.transpose(t2d)[fl2d].tobytes(order='F')
+            for _ in range(k):
+                f.write(blk)
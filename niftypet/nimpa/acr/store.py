@@ -0,0 +1,160 @@
+"""
+Store of ACR/Jaszczak PET phantom templates shared across phantom scans.
+Templates are kept in entries keyed by the hash of the PNG designs and the
+template generation parameters, so they are only generated once.
+"""
+__author__ = "Pawel Markiewicz"
+__copyright__ = "Copyright 2021-23"
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from niftypet.ninst.tools import path_resources
+
+from . import templates
+
+log = logging.getLogger(__name__)
+
+# > version of the template generation; increment when the templates change
+TMPL_VERSION = 1
+
+# > template kinds: generating function, the design PNG keys and the output keys
+TMPL_KINDS = OrderedDict([
+    ('mumap', (templates.create_mumap_core, (
+        'fmcap0', 'fmcap1', 'fmcap2', 'fbscrw', 'fscrws', 'flid0', 'flid1', 'finsrt', 'fbinsrt',
+        'fmain', 'fbttm'), ('facrmu', 'facrdmu'))),
+    ('nac', (templates.create_nac_core, ('fcap', 'fins', 'fbig', 'frng'), ('facrad',))),
+    ('reso', (templates.create_reso, ('frespng', 'frenpng', 'fresWpng', 'frenWpng'),
+              ('fresomu', 'fresdmu', 'fresdWmu', 'fresdQmu'))),
+    ('sampl_reso', (templates.create_sampl_reso, ('fs_rods',), ('fst_res',))),
+    ('sampl', (templates.create_sampl, ('fs_bckg', 'fs_ibckg', 'fs_air', 'fs_h2o', 'fs_bone',
+                                        'fs_hot1', 'fs_hot2', 'fs_hot3', 'fs_hot4'),
+               ('fst_insrt', 'fst_insrt3', 'fst_ibckg')))])
+
+# > prefixes of the scalar constants from `get_params` used for the templates
+TMPL_PARAMS = ('vxysz', 'vxsz', 'scl', 'scld', 'intord', 'rods_rotate', 'dpad', 'buff_rods_size',
+               'mu_', 'png_', 'ains', 'abck', 'aedg', 'k_', 'soff_')
+
+# > in-process LRU of the resolved store entries
+_ENTRIES = OrderedDict()
+_ENTRIES_MAX = 32
+
+
+@lru_cache(maxsize=256)
+def _file_hash(fpth, size, mtime):
+    '''SHA-1 of the file content (cached by the path, size and modification time)'''
+    h = hashlib.sha1()
+    with open(fpth, 'rb') as f:
+        for blk in iter(lambda: f.read(2**20), b''):
+            h.update(blk)
+    return h.hexdigest()
+
+
+def _ref_orient(Cntd, kind):
+    '''orientation (transpose and flip) of the reference PET image as used by `getnii`'''
+    if kind in ('mumap', 'nac') and 'fnacup' in Cntd and Path(Cntd['fnacup']).is_file():
+        fim = Cntd['fnacup']
+    elif 'fqntup' in Cntd and Path(Cntd['fqntup']).is_file():
+        fim = Cntd['fqntup']
+    else:
+        raise ValueError('Upscaled and trimmed ACR PET image cannot be found')
+    ornt = nib.io_orientation(nib.load(fim).affine)
+    return [int(t) for t in np.flip(np.argsort(ornt[:, 0]))], [int(f) for f in ornt[:, 1]]
+
+
+def tmpl_key(Cntd, kind):
+    '''
+    Get the hash key of the template `kind` from the design PNG files, the
+    template parameters of `Cntd` and the orientation of the reference image.
+    '''
+    _, fdsgn, _ = TMPL_KINDS[kind]
+    trnsp, flip = _ref_orient(Cntd, kind)
+    prms = {
+        k: (v.item() if isinstance(v, np.generic) else v)
+        for k, v in sorted(Cntd.items()) if k.startswith(TMPL_PARAMS) and
+        (v is None or isinstance(v, (int, float, np.number)))}
+    dsgn = {}
+    for k in fdsgn:
+        st = os.stat(Cntd[k])
+        dsgn[k] = _file_hash(os.fspath(Cntd[k]), st.st_size, st.st_mtime_ns)
+    key = {
+        'version': TMPL_VERSION, 'kind': kind, 'params': prms, 'design': dsgn,
+        'transpose': trnsp, 'flip': flip}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest(), key
+
+
+def _generate(Cntd, kind, edir, key):
+    '''generate the templates of `kind` and atomically publish them in `edir`'''
+    fgen, _, fout = TMPL_KINDS[kind]
+    tdir = tempfile.mkdtemp(prefix='.' + os.path.basename(edir) + '-', dir=os.path.dirname(edir))
+    try:
+        # > the templates are generated in a temporary folder of the store
+        Ctmp = dict(Cntd)
+        Ctmp['out'] = dict(Cntd['out'])
+        for f in fout:
+            Ctmp['out'][f] = os.path.join(tdir, os.path.basename(Cntd['out'][f]))
+        fgen(Ctmp)
+
+        with open(os.path.join(tdir, 'manifest.json'), 'w') as f:
+            json.dump(dict(key, files={f: os.path.basename(Ctmp['out'][f]) for f in fout}), f,
+                      indent=2)
+
+        # > publish the whole entry at once (other processes may have won the race)
+        try:
+            os.rename(tdir, edir)
+        except OSError:
+            if not os.path.isfile(os.path.join(edir, 'manifest.json')):
+                raise
+            log.info('template entry generated concurrently: ' + edir)
+    finally:
+        if os.path.isdir(tdir):
+            shutil.rmtree(tdir, ignore_errors=True)
+
+
+def template_store(Cntd, store=None, kinds=None):
+    '''
+    Get the ACR templates from the store, generating only the ones missing,
+    and point the template output paths in `Cntd['out']` to the store entries.
+    Arguments:
+        Cntd  - dictionary of constants with output paths (see `get_paths`)
+        store - folder of the template store (default in the NiftyPET resources)
+        kinds - template kinds to get (default all of `TMPL_KINDS`)
+    Returns dictionary of entry folders for each template kind.
+    '''
+    if store is None:
+        store = os.path.join(path_resources, 'acr_templates')
+    store = os.fspath(store)
+    os.makedirs(store, exist_ok=True)
+
+    out = {}
+    for kind in (kinds or TMPL_KINDS):
+        _, _, fout = TMPL_KINDS[kind]
+        h, key = tmpl_key(Cntd, kind)
+        edir = os.path.join(store, f'{kind}-{h[:16]}')
+
+        files = _ENTRIES.get((store, h))
+        if files is not None and all(os.path.isfile(f) for f in files.values()):
+            _ENTRIES.move_to_end((store, h))
+        else:
+            if not os.path.isfile(os.path.join(edir, 'manifest.json')):
+                log.info(f'generating {kind} templates in: ' + edir)
+                _generate(Cntd, kind, edir, key)
+            with open(os.path.join(edir, 'manifest.json')) as f:
+                files = {k: os.path.join(edir, v) for k, v in json.load(f)['files'].items()}
+            _ENTRIES[(store, h)] = files
+            if len(_ENTRIES) > _ENTRIES_MAX:
+                _ENTRIES.popitem(last=False)
+
+        Cntd['out'].update({f: files[f] for f in fout})
+        out[kind] = edir
+
+    return out
@@ -2,6 +2,7 @@
 __author__ = ("Pawel Markiewicz", "Casper da Costa-Luis")
 __copyright__ = "Copyright 2021-23"
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import imageio
@@ -10,6 +11,26 @@ import scipy.ndimage as ndi
 
 from niftypet import nimpa
 
+from . import slab
+
+
+def _nz(Cntd, k):
+    '''number of axial voxels for the phantom part thickness `Cntd[k]`'''
+    return int(np.round(Cntd[k] / Cntd['vxsz']))
+
+
+def _png_labels(fpng, off):
+    '''
+    Decode the PNG sampling design and convert its grey levels (apart from
+    255) to consecutive labels starting at `off`, using a look-up table.
+    '''
+    impng = imageio.imread(fpng)[..., 0]
+    lvl = np.flatnonzero(np.bincount(impng.ravel()))
+    lut = np.zeros(max(lvl[-1] + 1, 256), dtype=np.uint16)
+    lut[lvl] = off + np.arange(len(lvl))
+    lut[255:] = 0
+    return lut.take(impng)
+
 # MU-MAPs
 
 
@@ -79,19 +100,9 @@ def create_mumap_core(Cntd, return_raw=False):
     # > multiple slices according to the thickness of different part (axially)
 
     # > main cap with the three parts
-    k = int(np.round(Cntd['k_mcapA'] / Cntd['vxsz']))
-    mcapA = np.repeat(mcap0[None, ...], k, axis=0)
-
-    k = int(np.round(Cntd['k_mcapB'] / Cntd['vxsz']))
-    mcapB = np.repeat(mcap1[None, ...], k, axis=0)
-
-    k = int(np.round(Cntd['k_mcapC'] / Cntd['vxsz']))
-    tmp = (ascrws + mcap1)
-    mcapC = np.repeat(tmp[None, ...], k, axis=0)
-
-    k = int(np.round(Cntd['k_mcapD'] / Cntd['vxsz']))
-    tmp = (ascrws + mcap2 + bscrws)
-    mcapD = np.repeat(tmp[None, ...], k, axis=0)
+    parts = [(mcap0, _nz(Cntd, 'k_mcapA')), (mcap1, _nz(Cntd, 'k_mcapB')),
+             (ascrws + mcap1, _nz(Cntd, 'k_mcapC')),
+             (ascrws + mcap2 + bscrws, _nz(Cntd, 'k_mcapD'))]
 
     # matshow(mcapD[0,...], cmap='bone')
 
@@ -107,11 +118,7 @@ def create_mumap_core(Cntd, return_raw=False):
     lid1 = ndi.zoom(lid1, Cntd['scl'], output=None, order=Cntd['intord'], mode='constant')
     # matshow(lid1, cmap='bone', vmin=0.07, vmax=0.14)
 
-    k = int(np.round(Cntd['k_lidA'] / Cntd['vxsz']))
-    lidA = np.repeat(lid0[None, ...], k, axis=0)
-
-    k = int(np.round(Cntd['k_lidB'] / Cntd['vxsz']))
-    lidB = np.repeat(lid1[None, ...], k, axis=0)
+    parts += [(lid0, _nz(Cntd, 'k_lidA')), (lid1, _nz(Cntd, 'k_lidB'))]
 
     # > cylindrical inserts
     insrt = np.float32((insrt_png[..., 0] == Cntd['png_prspx']) * Cntd['mu_prspx']) + np.float32(
@@ -125,14 +132,7 @@ def create_mumap_core(Cntd, return_raw=False):
     insrtb = ndi.zoom(insrtb, Cntd['scl'], output=None, order=Cntd['intord'], mode='constant')
     # matshow(insrtb, cmap='bone', vmin=0.07, vmax=0.14)
 
-    k = int(np.round(Cntd['k_insrtA'] / Cntd['vxsz']))
-    insrtA = np.repeat(insrt[None, ...], k, axis=0)
-    '''
-    matshow(insrtA[0,...], cmap='bone', vmin=0.08, vmax=0.12)
-    '''
-
-    k = int(np.round(Cntd['k_insrtB'] / Cntd['vxsz']))
-    insrtB = np.repeat(insrtb[None, ...], k, axis=0)
+    parts += [(insrt, _nz(Cntd, 'k_insrtA')), (insrtb, _nz(Cntd, 'k_insrtB'))]
 
     # > main compartment
     main = np.float32((main_png[..., 0] == Cntd['png_prspx']) * Cntd['mu_prspx']) + np.float32(
@@ -144,32 +144,26 @@ def create_mumap_core(Cntd, return_raw=False):
     bttm = ndi.zoom(bttm, Cntd['scl'], output=None, order=Cntd['intord'], mode='constant')
     # matshow(bttm, cmap='bone', vmin=0.07, vmax=0.14)
 
-    k = int(np.round(Cntd['k_contA'] / Cntd['vxsz']))
-    contA = np.repeat(main[None, ...], k, axis=0)
-
-    k = int(np.round(Cntd['k_contB'] / Cntd['vxsz']))
-    contB = np.repeat(bttm[None, ...], k, axis=0)
+    parts += [(main, _nz(Cntd, 'k_contA')), (bttm, _nz(Cntd, 'k_contB'))]
 
     # > ASSEMBLE ALL PARTS
-    # > whole container - concatenate all the bits together
-    acr = np.concatenate((mcapA, mcapB, mcapC, mcapD, lidA, lidB, insrtA, insrtB, contA, contB),
-                         axis=0)
+    # > whole container as an axially extruded slab (no full 3D array)
+    acr = slab.slab(parts, dtype=np.float32)
 
     # > pad the image to make the dims even
-    acr = np.pad(acr, ((0, 0), (Cntd['dpad'], Cntd['dpad'] + 1), (Cntd['dpad'], Cntd['dpad'] + 1)),
-                 constant_values=((0, 0), (0, 0), (0, 0)))
+    dpad = ((0, 0), (Cntd['dpad'], Cntd['dpad'] + 1), (Cntd['dpad'], Cntd['dpad'] + 1))
+    acr = slab.slab_pad(acr, dpad)
 
     # > make it up-side down (as it is scanned)
-    acr = acr[::-1, :, :]
+    acr = slab.slab_flip(acr)
 
     # > get the affine and the save to NIfTI
-    imxys = acr.shape[2]
-    imzys = acr.shape[0]
+    imzys, _, imxys = slab.slab_shape(acr)
     affine = np.array([[-Cntd['vxsz'], 0., 0., .5 * imxys * Cntd['vxsz']],
                        [0., Cntd['vxsz'], 0., -.5 * imxys * Cntd['vxsz']],
                        [0., 0., Cntd['vxsz'], -.5 * imzys * Cntd['vxsz']], [0., 0., 0., 1.]])
 
-    nimpa.array2nii(
+    slab.slab2nii(
         acr, affine, Cntd['out']['facrmu'],
         trnsp=(imupd['transpose'].index(0), imupd['transpose'].index(1),
                imupd['transpose'].index(2)), flip=imupd['flip'])
@@ -182,7 +176,7 @@ def create_mumap_core(Cntd, return_raw=False):
 
     # > scale down the image; used for reducing the registration time
 
-    acrd = ndi.zoom(acr, 1 / Cntd['scld'], output=None, order=1, mode='constant')
+    acrd = slab.slab_zoom(acr, 1 / Cntd['scld'])
 
     # > affine
     imxys = acrd.shape[2]
@@ -215,7 +209,7 @@ def create_mumap_core(Cntd, return_raw=False):
     matshow(a[...,550], vmin=0.07, vmax=0.14, cmap='bone')
     matshow(a[...,430], vmin=0.07, vmax=0.14, cmap='bone')
     '''
-    return {'acrd': acrd, 'acr': acr} if return_raw else None
+    return {'acrd': acrd, 'acr': slab.slab_array(acr)} if return_raw else None
 
 
 def create_nac_core(Cntd, return_raw=False):
@@ -261,46 +255,25 @@ def create_nac_core(Cntd, return_raw=False):
     '''
 
     # > put unique slices together with k number representing the thickness
-    # > variables with underscore act as zero-fillers
-    k = int(np.round(Cntd['k_mcapA'] / Cntd['vxsz'])) + int(
-        np.round(Cntd['k_mcapB'] / Cntd['vxsz'])) + int(np.round(Cntd['k_mcapC'] / Cntd['vxsz']))
-    cap_ = np.zeros((k,) + cap.shape, dtype=np.float32)
-
-    k = int(np.round(Cntd['k_mcapD'] / Cntd['vxsz']))
-    capa = np.repeat(cap[None, ...], k, axis=0)
-
-    k = int(np.round(Cntd['k_lidA'] / Cntd['vxsz'])) + int(np.round(Cntd['k_lidB'] / Cntd['vxsz']))
-    lid_ = np.zeros((k,) + cap.shape, dtype=np.float32)
-
-    k = int(np.round(Cntd['k_insrtA'] / Cntd['vxsz']))
-    insa = np.repeat(ins[None, ...], k, axis=0)
-
-    k = int(np.round(Cntd['k_unfrm'] / Cntd['vxsz'])) + int(
-        np.round(Cntd['k_insrtB'] / Cntd['vxsz']))
-    biga = np.repeat(big[None, ...], k, axis=0)
-
-    k = int(np.round(Cntd['k_rodsend'] / Cntd['vxsz']))
-    gapa = np.repeat(rng[None, ...], k, axis=0)
-
-    k = int(np.round(Cntd['k_rods'] / Cntd['vxsz']))
-    resa = np.repeat(big[None, ...], k, axis=0)
-
-    k = int(np.round(Cntd['k_contB'] / Cntd['vxsz']))
-    btm_ = np.zeros((k,) + cap.shape, dtype=np.float32)
-
-    # > 3D assembly
-    acra = np.concatenate((cap_, capa, lid_, insa, biga, gapa, resa, gapa, btm_), axis=0)
+    # > `None` slices act as zero-fillers
+    k = _nz(Cntd, 'k_rodsend')
+    acra = slab.slab([(None, sum(_nz(Cntd, k_) for k_ in ('k_mcapA', 'k_mcapB', 'k_mcapC'))),
+                      (cap, _nz(Cntd, 'k_mcapD')),
+                      (None, _nz(Cntd, 'k_lidA') + _nz(Cntd, 'k_lidB')),
+                      (ins, _nz(Cntd, 'k_insrtA')),
+                      (big, _nz(Cntd, 'k_unfrm') + _nz(Cntd, 'k_insrtB')), (rng, k),
+                      (big, _nz(Cntd, 'k_rods')), (rng, k), (None, _nz(Cntd, 'k_contB'))],
+                     dtype=np.float32)
 
     # > pad the image to make the dims even
-    acra = np.pad(acra,
-                  ((0, 0), (Cntd['dpad'], Cntd['dpad'] + 1), (Cntd['dpad'], Cntd['dpad'] + 1)),
-                  constant_values=((0, 0), (0, 0), (0, 0)))
+    dpad = ((0, 0), (Cntd['dpad'], Cntd['dpad'] + 1), (Cntd['dpad'], Cntd['dpad'] + 1))
+    acra = slab.slab_pad(acra, dpad)
 
     # > make it up-side down (as it is scanned)
-    acra = acra[::-1, :, :]
+    acra = slab.slab_flip(acra)
 
-    # > scale down
-    acrad = ndi.zoom(acra, 1 / Cntd['scld'], output=None, order=1, mode='constant')
+    # > scale down directly from the unique slices
+    acrad = slab.slab_zoom(acra, 1 / Cntd['scld'])
 
     # > affine
     imxys = acrad.shape[2]
@@ -391,43 +364,27 @@ def create_reso(Cntd, return_raw=False):
     renW = ndi.zoom(renW, Cntd['scl'], output=None, order=Cntd['intord'], mode='constant')
     resW = ndi.zoom(resW, Cntd['scl'], output=None, order=Cntd['intord'], mode='constant')
 
-    # > rod ends
-    k = int(np.round(Cntd['k_rodsend'] / Cntd['vxsz']))
-    ren = np.repeat(ren[None, ...], k, axis=0)
-    renW = np.repeat(renW[None, ...], k, axis=0)
-    '''
-    matshow(ren[0,...])
-    matshow(renW[0,...])
-    '''
-
-    # > rods themselves
-    k = int(np.round(Cntd['k_rods'] / Cntd['vxsz']))
-    res = np.repeat(res[None, ...], k, axis=0)
-    resW = np.repeat(resW[None, ...], k, axis=0)
+    # > rod ends and the rods themselves
+    ke = _nz(Cntd, 'k_rodsend')
+    kr = _nz(Cntd, 'k_rods')
 
     # > create a buffer for registration purposes
     # > as a margin between the rods end and the uniform part
-    bsz = Cntd['buff_rods_size']
-    buff = resW.copy()
-    buff = buff[:bsz, ...]
-    buff[:] = 0
+    bsz = min(Cntd['buff_rods_size'], kr)
+
+    dpad = ((1, 0), (Cntd['dpad'], Cntd['dpad'] + 1), (Cntd['dpad'], Cntd['dpad'] + 1))
 
     # > put all together
-    reso = np.concatenate((ren, res, ren, buff), axis=0)
-    # reso = np.pad( reso, ((1,0), (0,1),(0,1)), constant_values=((0,0), (0,0), (0, 0)) )
-    reso = np.pad(reso,
-                  ((1, 0), (Cntd['dpad'], Cntd['dpad'] + 1), (Cntd['dpad'], Cntd['dpad'] + 1)),
-                  constant_values=((0, 0), (0, 0), (0, 0)))
+    reso = slab.slab_pad(slab.slab([(ren, ke), (res, kr), (ren, ke), (None, bsz)]), dpad)
 
     # nimpa.imscroll(res, view='c')
 
-    imxys = reso.shape[2]
-    imzys = reso.shape[0]
+    imzys, _, imxys = slab.slab_shape(reso)
     affine = np.array([[-Cntd['vxsz'], 0., 0., .5 * imxys * Cntd['vxsz']],
                        [0., Cntd['vxsz'], 0., -.5 * imxys * Cntd['vxsz']],
                        [0., 0., Cntd['vxsz'], -.5 * imzys * Cntd['vxsz']], [0., 0., 0., 1.]])
 
-    nimpa.array2nii(
+    slab.slab2nii(
         reso,                                                            # [::-1, :, :],
         affine,
         Cntd['out']['fresomu'],
@@ -438,7 +395,7 @@ def create_reso(Cntd, return_raw=False):
     # nimpa.imscroll(fresomu, view='t')
 
     # > scale down
-    resd = ndi.zoom(reso, 1 / Cntd['scld'], output=None, order=1, mode='constant')
+    resd = slab.slab_zoom(reso, 1 / Cntd['scld'])
 
     # > affine
     imxys = resd.shape[2]
@@ -454,16 +411,11 @@ def create_reso(Cntd, return_raw=False):
         trnsp=(imupd['transpose'].index(0), imupd['transpose'].index(1),
                imupd['transpose'].index(2)), flip=imupd['flip'])
 
-    # > joining bits together for rods in water
-    resoW = np.concatenate((renW, resW, renW, buff), axis=0)
-    # > padding for even dims
-    # resoW = np.pad( resoW, ((1,0), (0,1),(0,1)), constant_values=((0,0), (0,0), (0, 0)) )
-    resoW = np.pad(resoW,
-                   ((1, 0), (Cntd['dpad'], Cntd['dpad'] + 1), (Cntd['dpad'], Cntd['dpad'] + 1)),
-                   constant_values=((0, 0), (0, 0), (0, 0)))
+    # > joining bits together for rods in water (padded for even dims)
+    resoW = slab.slab_pad(slab.slab([(renW, ke), (resW, kr), (renW, ke), (None, bsz)]), dpad)
 
     # > scale down
-    resdW = ndi.zoom(resoW, 1 / Cntd['scld'], output=None, order=1, mode='constant')
+    resdW = slab.slab_zoom(resoW, 1 / Cntd['scld'])
 
     nimpa.array2nii(
         resdW, affined, Cntd['out']['fresdWmu'],
@@ -473,7 +425,7 @@ def create_reso(Cntd, return_raw=False):
     # > FOR registration using QNT reconstruction
 
     # > the extra part of the background at the bottom of the resolution bit after truncation.
-    renB = renW[:bsz, ...].copy()
+    renB = renW.copy()
     renB[renB > 0] = 100
 
     renW[renW > Cntd['mu_water']] = 0
@@ -482,17 +434,12 @@ def create_reso(Cntd, return_raw=False):
     resW[resW > Cntd['mu_water']] = 0
     resW[resW == Cntd['mu_water']] = 100
 
-    # > joining bits together for rods in water
-    resoW = np.concatenate((renW, resW, renW, renB), axis=0)
-    # resoW = np.concatenate((renW, resW, renW), axis=0)
-
-    # > padding for even dims
-    resoW = np.pad(resoW,
-                   ((1, 0), (Cntd['dpad'], Cntd['dpad'] + 1), (Cntd['dpad'], Cntd['dpad'] + 1)),
-                   constant_values=((0, 0), (0, 0), (0, 0)))
+    # > joining bits together for rods in water and padding for even dims
+    resoW = slab.slab_pad(
+        slab.slab([(renW, ke), (resW, kr), (renW, ke), (renB, min(bsz, ke))]), dpad)
 
     # > scale down
-    resdW = ndi.zoom(resoW, 1 / Cntd['scld'], output=None, order=1, mode='constant')
+    resdW = slab.slab_zoom(resoW, 1 / Cntd['scld'])
 
     nimpa.array2nii(
         resdW, affined, Cntd['out']['fresdQmu'],
@@ -500,7 +447,9 @@ def create_reso(Cntd, return_raw=False):
                imupd['transpose'].index(2)), flip=imupd['flip'])
 
     if return_raw:
-        return {'resoW': resoW, 'resdW': resdW, 'resd': resd, 'reso': reso}
+        return {
+            'resoW': slab.slab_array(resoW), 'resdW': resdW, 'resd': resd,
+            'reso': slab.slab_array(reso)}
 
 
 # =======================================================================
@@ -596,39 +545,27 @@ def create_sampl_reso(Cntd, return_raw=False):
 
     srods = ndi.zoom(srods, Cntd['scl'], output=None, order=Cntd['intord'], mode='constant')
 
-    # > rod ends
-    k = int(np.round(Cntd['k_rodsend'] / Cntd['vxsz']))
-    srend = np.zeros((k,) + srods.shape, dtype=np.uint8)
-
-    # > rods themselves
-    k = int(np.round(Cntd['k_rods'] / Cntd['vxsz']))
-    srods = np.repeat(srods[None, ...], k, axis=0)
-
-    sres = np.concatenate((srend, srods, srend), axis=0)
-    sres = np.pad(sres, ((1, 0), (0, 1), (0, 1)), constant_values=((0, 0), (0, 0), (0, 0)))
+    # > empty rod ends and the rods themselves
+    k = _nz(Cntd, 'k_rodsend')
+    sres = slab.slab([(None, k), (srods, _nz(Cntd, 'k_rods')), (None, k)], dtype=np.uint16)
+    sres = slab.slab_pad(sres, ((1, 0), (0, 1), (0, 1)))
 
-    imxys = sres.shape[2]
-    imzys = sres.shape[0]
+    imzys, _, imxys = slab.slab_shape(sres)
     affine = np.array([[-Cntd['vxsz'], 0., 0., .5 * imxys * Cntd['vxsz']],
                        [0., Cntd['vxsz'], 0., -.5 * imxys * Cntd['vxsz']],
                        [0., 0., Cntd['vxsz'], -.5 * imzys * Cntd['vxsz']], [0., 0., 0., 1.]])
 
-    nimpa.array2nii(
+    slab.slab2nii(
         sres, affine, Cntd['out']['fst_res'],
         trnsp=(imupd['transpose'].index(0), imupd['transpose'].index(1),
                imupd['transpose'].index(2)), flip=imupd['flip'])
 
-    if return_raw:
-        del srods, srend
-        return sres
-    else:
-        del srods, sres, srend
-        return None
+    return slab.slab_array(sres) if return_raw else None
 
 
 def create_sampl(Cntd, return_raw=False):
     """Create template of sampling rings for the inserts."""
-    if all(os.path.isfile(Cntd['out'][f] for f in ('fst_insrt', 'fst_insrt3', 'fst_ibckg'))):
+    if all(os.path.isfile(Cntd['out'][f]) for f in ('fst_insrt', 'fst_insrt3', 'fst_ibckg')):
         if return_raw:
             return {
                 'allsmplng': Cntd['out']['fst_insrt'], 'insrt3smplng': Cntd['out']['fst_insrt3'],
@@ -654,20 +591,14 @@ def create_sampl(Cntd, return_raw=False):
     # > converted and combined in fewer templates
     insrts = None
 
-    tmpl = (k for k in Cntd if k[:3] == 'fs_')
-    for k in tmpl:
-        off = Cntd['soff_' + k[3:]]
-        if off is None: continue
-        print('file: {} >> offset = {}'.format(k, off))
+    # > the designs decoded concurrently and converted to labels
+    tmpl = [k for k in Cntd if k[:3] == 'fs_' and Cntd['soff_' + k[3:]] is not None]
+    with ThreadPoolExecutor() as executor:
+        arrs = list(executor.map(_png_labels, [Cntd[k] for k in tmpl],
+                                 [Cntd['soff_' + k[3:]] for k in tmpl]))
 
-        impng = imageio.imread(Cntd[k])
-
-        # > array for conversion of labels
-        arr = np.zeros(impng[..., 0].shape, dtype=np.uint16)
-
-        for i, v in enumerate(np.unique(impng[..., 0])):
-            if v < 255:
-                arr += np.uint16((impng[..., 0] == v) * (off+i))
+    for k, arr in zip(tmpl, arrs):
+        print('file: {} >> offset = {}'.format(k, Cntd['soff_' + k[3:]]))
 
         # > assemble all the templates together apart from hot3 which is
         # > overlapping, hence separate
@@ -709,57 +640,27 @@ def create_sampl(Cntd, return_raw=False):
     ibckg = ndi.zoom(ibckg, Cntd['scl'], output=None, order=Cntd['intord'], mode='constant')
     bckg = ndi.zoom(bckg, Cntd['scl'], output=None, order=Cntd['intord'], mode='constant')
 
-    # > padding with zeros
-    up_ = np.zeros((ku,) + insrts.shape, dtype=np.uint16)
-    ibtm_ = np.zeros((kb,) + insrts.shape, dtype=np.uint16)
-    btm_ = np.zeros((kl + kr,) + insrts.shape, dtype=np.uint16)
-
-    # > repeat according to the axial dimensions
-    insrts = np.repeat(insrts[None, ...], ki, axis=0)
-    insrt3 = np.repeat(insrt3[None, ...], ki, axis=0)
-    ibckg = np.repeat(ibckg[None, ...], ki, axis=0)
-    bckg = np.repeat(bckg[None, ...], kuni, axis=0)
-
-    allsmplng = np.concatenate((up_, insrts, ibtm_, bckg, btm_), axis=0)
-
-    insrt3smplng = np.concatenate((up_, insrt3, ibtm_, bckg, btm_), axis=0)
-
-    ibckgsmplng = np.concatenate((up_, ibckg, ibtm_, bckg, btm_), axis=0)
-
-    # > pad the image to make the dims even
-    allsmplng = np.pad(allsmplng, ((0, 0), (0, 1), (0, 1)),
-                       constant_values=((0, 0), (0, 0), (0, 0)))
-    insrt3smplng = np.pad(insrt3smplng, ((0, 0), (0, 1), (0, 1)),
-                          constant_values=((0, 0), (0, 0), (0, 0)))
-    ibckgsmplng = np.pad(ibckgsmplng, ((0, 0), (0, 1), (0, 1)),
-                         constant_values=((0, 0), (0, 0), (0, 0)))
-
-    # > make it up-side down (as it is scanned)
-    allsmplng = allsmplng[::-1, :, :]
-    insrt3smplng = insrt3smplng[::-1, :, :]
-    ibckgsmplng = ibckgsmplng[::-1, :, :]
+    # > slabs of the inserts according to the axial dimensions with zero padding
+    # > (`None`), padded to make the dims even and up-side down (as it is scanned)
+    smplng = {}
+    for k, im in (('allsmplng', insrts), ('insrt3smplng', insrt3), ('ibckgsmplng', ibckg)):
+        smplng[k] = slab.slab_flip(
+            slab.slab_pad(
+                slab.slab([(None, ku), (im, ki), (None, kb), (bckg, kuni), (None, kl + kr)],
+                          dtype=np.uint16), ((0, 0), (0, 1), (0, 1))))
 
     # > get the affine and save to NIfTI
-    imxys = ibckgsmplng.shape[2]
-    imzys = ibckgsmplng.shape[0]
+    imzys, _, imxys = slab.slab_shape(smplng['ibckgsmplng'])
     affine = np.array([[-Cntd['vxsz'], 0., 0., .5 * imxys * Cntd['vxsz']],
                        [0., Cntd['vxsz'], 0., -.5 * imxys * Cntd['vxsz']],
                        [0., 0., Cntd['vxsz'], -.5 * imzys * Cntd['vxsz']], [0., 0., 0., 1.]])
 
-    nimpa.array2nii(
-        allsmplng, affine, Cntd['out']['fst_insrt'],
-        trnsp=(imupd['transpose'].index(0), imupd['transpose'].index(1),
-               imupd['transpose'].index(2)), flip=imupd['flip'])
-
-    nimpa.array2nii(
-        insrt3smplng, affine, Cntd['out']['fst_insrt3'],
-        trnsp=(imupd['transpose'].index(0), imupd['transpose'].index(1),
-               imupd['transpose'].index(2)), flip=imupd['flip'])
-
-    nimpa.array2nii(
-        ibckgsmplng, affine, Cntd['out']['fst_ibckg'],
-        trnsp=(imupd['transpose'].index(0), imupd['transpose'].index(1),
-               imupd['transpose'].index(2)), flip=imupd['flip'])
+    for k, f in (('allsmplng', 'fst_insrt'), ('insrt3smplng', 'fst_insrt3'),
+                 ('ibckgsmplng', 'fst_ibckg')):
+        slab.slab2nii(
+            smplng[k], affine, Cntd['out'][f],
+            trnsp=(imupd['transpose'].index(0), imupd['transpose'].index(1),
+                   imupd['transpose'].index(2)), flip=imupd['flip'])
 
     if return_raw:
-        return {'allsmplng': allsmplng, 'insrt3smplng': insrt3smplng, 'ibckgsmplng': ibckgsmplng}
+        return {k: slab.slab_array(v) for k, v in smplng.items()}
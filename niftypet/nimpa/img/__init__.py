@@ -1,6 +1,26 @@
 # initialise the module folder
-__all__ = [
-    'create_disk', 'get_cylinder', 'imdiff', 'imscroll', 'profile_points', 'pifa2nii', 'nii2pifa']
+from importlib import import_module
 
-from .gen import create_disk, get_cylinder, imdiff, imscroll, profile_points
-from .signa import nii2pifa, pifa2nii
+# > public names of each submodule, imported on first access (PEP 562)
+_SUBMODULES = {
+    'gen': ('create_disk', 'get_cylinder', 'imdiff', 'imscroll', 'profile_points', 'rasterise'),
+    'signa': ('pifa2nii', 'nii2pifa')}
+
+__all__ = [k for names in _SUBMODULES.values() for k in names]
+
+_LAZY = {k: '.' + mod for mod, names in _SUBMODULES.items() for k in names}
+
+
+def __getattr__(name):
+    '''import the submodule of the public name only when it is used'''
+    if name in _SUBMODULES:
+        return import_module('.' + name, __name__)
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    val = getattr(import_module(_LAZY[name], __name__), name)
+    globals()[name] = val
+    return val
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | set(_SUBMODULES))
@@ -4,23 +4,21 @@ Generates images.
 """
 import logging
 import math
+import os
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 
+import nibabel as nib
 import numpy as np
 import scipy.ndimage as ndi
 
-try:
-    from miutil.plot import imscroll
-except ImportError as err: # NOQA: F841
-
-    def imscroll(*_, **__):
-        """delay matplotlib import error for later"""
-        raise err  # NOQA: F821
-
+log = logging.getLogger(__name__)
 
-from ..prc import imio
 
-log = logging.getLogger(__name__)
+def imscroll(*args, **kwargs):
+    """delay matplotlib import (and its error) for later; see `miutil.plot.imscroll`"""
+    from miutil.plot import imscroll
+    return imscroll(*args, **kwargs)
 
 
 def absmax(a):
@@ -29,32 +27,109 @@ def absmax(a):
     return np.where(-amin > amax, amin, amax)
 
 
-def create_disk(shape_in, r=1, a=0, b=0, gen_scale=1, threshold=None):
-    if len(shape_in) == 2:
-        shape = (1,) + shape_in
-    elif len(shape_in) == 3:
-        shape = shape_in
-
-    imsk = np.zeros((gen_scale * shape[1], gen_scale * shape[2]), dtype=np.float32)
-    for t in np.arange(0, math.pi, math.pi / (gen_scale*1000)):
-        x = gen_scale * r * np.cos(t) + gen_scale*a
-        y = gen_scale * r * np.sin(t) + gen_scale*b
-
-        for ys in np.arange(-y + 2*b*gen_scale, y, 0.5):
-            v = 0.5 * gen_scale * shape[1] - np.ceil(ys)
-            u = 0.5 * gen_scale * shape[2] + np.floor(x)
-            imsk[v.astype(np.int16), u.astype(np.int16)] = 1.
+def _disk_cover(shape, vxsz, r, xo, yo, r_in, ss):
+    '''
+    Partial volume coverage of the disk (or annulus for `r_in` > 0) within its
+    bounding box in the 2D image grid, as (row slice, column slice, coverage).
+    Only the voxels crossed by the edge are supersampled (`ss` x `ss` points).
+    '''
+    ny, nx = shape
+    vy, vx = vxsz
+
+    # > voxel centres relative to the disk centre (y pointing up, as in `get_cylinder`)
+    yc = (.5*ny - np.arange(ny) - .5) * vy - yo
+    xc = (np.arange(nx) - .5*nx + .5) * vx - xo
+    iy = np.flatnonzero(np.abs(yc) < r + vy)
+    ix = np.flatnonzero(np.abs(xc) < r + vx)
+    if not len(iy) or not len(ix):
+        return slice(0, 0), slice(0, 0), np.zeros((0, 0), dtype=np.float32)
+    rows, cols = slice(iy[0], iy[-1] + 1), slice(ix[0], ix[-1] + 1)
+    dy, dx = yc[rows, None], xc[None, cols]
+    d = np.hypot(dy, dx)
+
+    # > half diagonal of the voxel and the sub-voxel sampling offsets
+    hd = .5 * math.hypot(vy, vx)
+    ofs = (np.arange(ss) + .5) / ss - .5
+    oy, ox = (a.ravel() for a in np.meshgrid(ofs * vy, ofs * vx, indexing='ij'))
+
+    cov = np.zeros(d.shape, dtype=np.float32)
+    for rr, sgn in ((r, 1), (r_in, -1)):
+        if rr <= 0:
+            continue
+        cov[d <= rr - hd] += sgn
+        edge = np.nonzero((d > rr - hd) & (d < rr + hd))
+        sy = dy[edge[0], 0][:, None] + oy
+        sx = dx[0, edge[1]][:, None] + ox
+        cov[edge] += sgn * np.mean(sy**2 + sx**2 <= rr**2, axis=1)
+
+    return rows, cols, cov
+
+
+def rasterise(shape, shapes, voxsize=1., supersample=8, labels=False, dtype=None):
+    '''
+    Rasterise disks, annuli and cylinders into one image with the partial
+    volume coverage computed from the distance field (supersampled at the
+    edges; `supersample=1` for voxel centres only).
+    Arguments:
+        shape:  2D or 3D image shape (z, y, x).
+        shapes: dictionary (or list of them) of the shapes with the keys:
+                'r' (radius), and optionally 'xo', 'yo' (transaxial centre),
+                'r_in' (inner radius of annulus), 'z' (axial range (z0, z1) in
+                voxels; the whole image if not given) and 'val' (intensity or
+                label, default 1).  The dimensions are in the units of `voxsize`.
+        voxsize: voxel size, scalar or for each dimension.
+        labels: if True, the label image of the shape values in the voxels
+                covered at least by half (later shapes overwrite earlier ones);
+                otherwise the sum of the values weighted by the coverage.
+        dtype:  output data type (default float32 or uint16 for labels).
+    Returns the image; the 3D images with all the shapes through the whole
+    image are broadcast (read-only) views of one 2D image along z.
+    '''
+    shapes = [shapes] if isinstance(shapes, dict) else list(shapes)
+    shape = tuple(shape)
+    if len(shape) not in (2, 3):
+        raise ValueError('the image shape has to be 2D or 3D')
+    if dtype is None:
+        dtype = np.uint16 if labels else np.float32
+    vxsz = np.broadcast_to(np.asanyarray(voxsize, dtype=np.float64), (len(shape),))[-2:]
+
+    # > one 2D image unless some shapes are only in part of the axial range
+    zview = len(shape) == 2 or all(s.get('z') is None for s in shapes)
+    im = np.zeros(shape[-2:] if zview else shape, dtype=dtype)
+
+    for s in shapes:
+        rows, cols, cov = _disk_cover(shape[-2:], vxsz, s['r'], s.get('xo', 0), s.get('yo', 0),
+                                      s.get('r_in', 0), supersample)
+        sub = im[..., rows, cols] if zview else im[slice(*(s.get('z') or (None,))), rows, cols]
+        if labels:
+            sub[..., cov >= .5] = s.get('val', 1)
+        else:
+            sub += (s.get('val', 1) * cov).astype(dtype)
+
+    if zview and len(shape) == 3:
+        return np.broadcast_to(im, shape)
+    return im
+
+
+def create_disk(shape_in, r=1, a=0, b=0, gen_scale=1, threshold=None, zview=False):
+    '''
+    Disk of radius `r` centred at (`a`, `b`) (in voxels) with the partial volume
+    coverage supersampled `gen_scale` times (voxel centres only for 1).
+    For 3D `shape_in` the disk is repeated axially (`zview=True` for a read-only
+    broadcast view instead of a copy).
+    '''
+    if len(shape_in) not in (2, 3):
+        raise ValueError('the image shape has to be 2D or 3D')
 
-    if gen_scale > 1:
-        imsk = ndi.interpolation.zoom(imsk, gen_scale**-1, order=1)
+    imsk = rasterise(shape_in[-2:], {'r': r, 'xo': a, 'yo': b}, supersample=gen_scale)
 
     if threshold:
         imsk = imsk > threshold
 
     if len(shape_in) == 3:
-        return np.repeat(imsk.reshape((1, shape[1], shape[1])), shape[0], axis=0)
-    elif len(shape_in) == 2:
-        return imsk
+        imsk = np.broadcast_to(imsk, tuple(shape_in))
+        return imsk if zview else imsk.copy()
+    return imsk
 
 
 def get_cylinder(
@@ -65,7 +140,9 @@ def get_cylinder(
         gpu_dim=False,
         mask=True,
         two_d=False,
-        nangle=2*360):
+        nangle=None,
+        supersample=1,
+        zview=False):
 
     ''' Output image with a uniform cylinder of intensity = `unival`.
         A better version of generating disk/cylinder in a given image space.
@@ -73,26 +150,23 @@ def get_cylinder(
         Cnt:    dictionary containing constants for the image space
         rad:    radius
         xo, yo: transaxial centre
+        nangle: unused (kept for compatibility)
+        supersample: partial volume supersampling (1: voxel centres only);
+                the mask includes voxels covered at least by half.
+        zview:  read-only broadcast view along z instead of a copy
     '''
 
     if mask: unival = 1
 
-    imdsk = np.zeros((1, Cnt['SZ_IMY'], Cnt['SZ_IMX']), dtype=np.float32)
-
-    for t in np.arange(0, math.pi, math.pi / nangle):
-        x = xo + rad * math.cos(t)
-        y = yo + rad * math.sin(t)
-        yf = np.arange(-y + 2*yo, y, Cnt['SZ_VOXY'] / 2)
-        v = np.int32(.5 * Cnt['SZ_IMX'] - np.ceil(yf / Cnt['SZ_VOXY']))
-        u = np.int32(.5 * Cnt['SZ_IMY'] + np.floor(x / Cnt['SZ_VOXY']))
-        imdsk[0, v, u] = unival
+    imdsk = rasterise((Cnt['SZ_IMY'], Cnt['SZ_IMX']), {'r': rad, 'xo': xo, 'yo': yo},
+                      voxsize=Cnt['SZ_VOXY'], supersample=supersample)
 
-    if two_d:
-        imdsk = np.squeeze(imdsk)
-    else:
-        imdsk = np.repeat(imdsk, Cnt['SZ_IMZ'], axis=0)
+    imdsk = imdsk >= .5 if mask else unival * imdsk
 
-    if mask: imdsk = imdsk.astype(dtype=bool)
+    if not two_d:
+        imdsk = np.broadcast_to(imdsk, (Cnt['SZ_IMZ'],) + imdsk.shape)
+        if not zview:
+            imdsk = imdsk.copy()
 
     if gpu_dim and not two_d:
         return np.transpose(imdsk, (1, 2, 0))
@@ -100,109 +174,176 @@ def get_cylinder(
         return imdsk
 
 
-def profile_points(im, p0, p1, steps=100):
-    p = np.array([p1[0] - p0[0], p1[1] - p0[1]])
-    nrm = np.sum(p**2)**.5
-    p = p / nrm
-
+def profile_points(im, p0, p1, steps=100, order=0, width=1):
+    '''
+    Sample the image `im` (2D or 3D) along the line segments from `p0` to `p1`
+    with `steps` equidistant points.
+    Arguments:
+        p0, p1: start and end points given as (x, y) for 2D or (x, y, z) for 3D
+                images (i.e., reversed order of the image axes), or arrays of
+                them (lines x 2 or 3) for sampling many lines at once.
+        order:  interpolation order (0: nearest neighbour, 1: linear, 3: cubic)
+                as in `scipy.ndimage.map_coordinates`.
+        width:  number of parallel lines (1 voxel apart, perpendicular to the
+                line within the transaxial plane) for averaging the profile.
+    Returns the profile (steps,) for single points or (lines x steps) array.
+    '''
+    p0 = np.asanyarray(p0, dtype=np.float64)
+    p1 = np.asanyarray(p1, dtype=np.float64)
+    single = p0.ndim == 1 and p1.ndim == 1
+    p0, p1 = np.broadcast_arrays(np.atleast_2d(p0), np.atleast_2d(p1))
+    if p0.shape[1] != im.ndim or im.ndim not in (2, 3):
+        raise ValueError('the points have to match the image dimensions (2D or 3D)')
+
+    # > unit directions and the sampling points (steps x lines x dims)
+    p = p1 - p0
+    nrm = np.sum(p**2, axis=1)**.5
+    p = p / nrm[:, None]
     tt = np.linspace(0, nrm, steps)
-    profile = np.zeros(len(tt), dtype=im.dtype)
+    pts = tt[..., None] * p + p0
+
+    if width > 1:
+        # > transaxial normals of the lines (x for lines along z)
+        nv = np.zeros_like(p)
+        nv[:, 0], nv[:, 1] = -p[:, 1], p[:, 0]
+        nn = np.sum(nv**2, axis=1)**.5
+        nv[nn == 0, 0], nn[nn == 0] = 1, 1
+        ofs = np.arange(width) - (width-1) / 2
+        pts = pts[None] + ofs[:, None, None, None] * (nv / nn[:, None])
+    pts = pts.T[::-1] # image axes first, lines, steps (, width)
+
+    if order == 0:
+        # > nearest voxels clipped to the image (as `mode='nearest'` for interpolation)
+        prf = im[tuple(
+            np.clip(np.rint(p), 0, n - 1).astype(np.intp) for p, n in zip(pts, im.shape))]
+    else:
+        prf = ndi.map_coordinates(im, pts.reshape(im.ndim, -1), order=order,
+                                  mode='nearest').reshape(pts.shape[1:])
+    if width > 1:
+        prf = prf.mean(axis=-1)
+    prf = prf.astype(im.dtype, copy=False)
 
-    c = 0
-    for t in tt:
-        u = t * p[0] + p0[0]
-        v = t * p[1] + p0[1]
+    return prf[0] if single else prf
 
-        profile[c] = im[int(round(v)), int(round(u))]
-        c += 1
 
-    return profile
+# ----------------------------------------------------------------------------------------------------------------------------
+def _imdiff_src(im):
+    '''
+    Input of `imdiff` as (image dimensions, frame shape, number of frames, reader)
+    with the reader of z-slabs `(frame, z0, z1)` oriented as in `getnii`;
+    NIfTI files and memory-mapped arrays are read only by the slabs.
+    '''
+    if isinstance(im, dict):
+        im = im['im']
+
+    if isinstance(im, (str, pathlib.PurePath)):
+        nim = nib.load(os.fspath(im))
+        prx = nim.dataobj
+        if len(prx.shape) not in (3, 4):
+            raise ValueError('the input images have to be 3D or 4D')
+        nfrm = prx.shape[3] if len(prx.shape) == 4 else 1
+        # > orientation as in `getnii` (flipped and transposed)
+        ornt = nib.io_orientation(nim.affine)
+        trnsp = tuple(int(t) for t in np.flip(np.argsort(ornt[:, 0])))
+        flip = [int(f) for f in ornt[:, 1]]
+        nz = prx.shape[trnsp[0]]
+
+        def read(t, z0, z1):
+            idx = [slice(None)] * 3
+            idx[trnsp[0]] = slice(z0, z1) if flip[trnsp[0]] < 0 else slice(nz - z1, nz - z0)
+            slab = np.asanyarray(prx[tuple(idx) + ((t,) if len(prx.shape) == 4 else ())])
+            return slab[::-flip[0], ::-flip[1], ::-flip[2]].transpose(trnsp)
+
+        fshape = tuple(prx.shape[i] for i in trnsp)
+        return 4 if nfrm > 1 else 3, fshape, nfrm, read
+
+    if not isinstance(im, (np.ndarray, np.generic)) or im.ndim not in (3, 4):
+        raise ValueError('the input images have to be 3D or 4D files or arrays')
+    if im.ndim == 3:
+        return 3, im.shape, 1, lambda t, z0, z1: im[z0:z1]
+    # > this assumes that axis 0 encodes image frames (e.g., along time)
+    return 4, im.shape[1:], im.shape[0], lambda t, z0, z1: im[t, z0:z1]
+
+
+def _diff_chunk(ref, new, thrs):
+    '''
+    One fused pass over the chunk of the reference/new images: the number of
+    voxels above the threshold `thrs`, the sums of absolute and relative
+    absolute differences and their maximum within these voxels, and the
+    smallest reference value of these voxels.
+    '''
+    msk = ref > thrs
+    r = ref[msk]
+    d = np.abs(r - new[msk])
+    if not d.size:
+        return 0, 0., 0., 0., np.inf
+    return (d.size, d.sum(dtype=np.float64), (d / np.abs(r)).sum(dtype=np.float64), d.max(),
+            r.min())
 
 
-# ----------------------------------------------------------------------------------------------------------------------------
-def imdiff(imref, imnew, verbose=False, plot=False, cmap='bwr'):
+def imdiff(imref, imnew, verbose=False, plot=False, cmap='bwr', chunk=None, max_workers=None):
     """
     Compare the new image (imnew) to the reference image (imref),
     returning (and optional plotting) the difference.
+    The images (NIfTI files, Numpy or memory-mapped arrays or dictionaries)
+    are compared in chunks of single frames or of `chunk` slices of them
+    (z-slabs) across a thread pool of `max_workers`, reading only the chunks
+    from files.  The mean absolute percentage (relative) difference (MAPE),
+    mean absolute error (MAE) and maximum absolute difference (MAD) are
+    computed within the voxels above 0.1% of the maximum of the reference
+    (for each frame).  In the z-slab mode, each slab is first compared above
+    0.1% of its own maximum (not higher than the frame threshold), and only
+    the slabs with the reference values counted below the frame threshold
+    are read again.
     """
-    if isinstance(imref, (str, pathlib.Path)):
-        imref = imio.getnii(imref)
-        log.info('using NIfTI files as image input for the reference')
-    elif isinstance(imref, (np.ndarray, np.generic)):
-        log.info('using Numpy arrays as input for the reference image')
-    elif isinstance(imref, dict):
-        imref = imref['im']
-        log.info('using the input dictionary with an image for reference')
-
-    if isinstance(imnew, str):
-        imnew = imio.getnii(imnew)
-        log.info('using NIfTI files as input for the new image')
-    elif isinstance(imnew, (np.ndarray, np.generic)):
-        log.info('using Numpy arrays as input for the new image')
-    elif isinstance(imnew, dict):
-        imnew = imnew['im']
-        log.info('using the input dictionary with a new image for comparison')
-
-    # -----------------------------------------------------------------------------------
-    # MAXIMUM PROJECTION IMAGE
-    if plot:
-        import matplotlib.pyplot as plt
-
-        # > threshold percentage used in plotting (helps ignoring singular hot values)
-        maxproj_thrshl = 0.7
-
-        # > maximum projection along axis ax
-        def maxproj(imdiff, ax):
-            # > maximum projection image
-            imp = np.max(imdiff, axis=ax)
-            # > minimum projection image
-            imn = np.min(imdiff, axis=ax)
-            # > max mask
-            mmsk = imp > abs(imn)
-            # > form the highest intensity projection image (positive and negative)
-            im = imn.copy()
-            im[mmsk] = imp[mmsk]
-            # > maximum/minimum value in the difference image for a symmetrical colour map
-            valmax = max(np.max(imp), np.min(imn))
-            return im, valmax
-
-    # -----------------------------------------------------------------------------------
-
-    if imnew.ndim == 3 and imref.ndim == 3 and imnew.shape == imref.shape:
-        imnew = imnew[np.newaxis, ...]
-        imref = imref[np.newaxis, ...]
-        log.info('using 3D images as input')
-        Nim = 1
-    elif imnew.ndim == 4 and imref.ndim == 4 and imnew.shape == imref.shape:
-        log.info('using 4D images as input')
-        # > this assumes that axis 0 encodes image frames (e.g., along time)
-        Nim = imnew.shape[0]
-    else:
+    ndim, shape, Nim, rdref = _imdiff_src(imref)
+    ndimn, shapen, Nimn, rdnew = _imdiff_src(imnew)
+    if (ndim, shape, Nim) != (ndimn, shapen, Nimn):
         raise ValueError('the input images have to be of the same dimensions and shape')
-
-    mape = np.zeros(Nim)
-    mae = np.zeros(Nim)
-    mad = np.zeros(Nim)
-
-    for i in range(Nim):
-        # > maximum voxel value of reference image
-        mx = np.max(imref[i, ...])
-
-        # > create a image mask based on the max the 0.1% value
-        msk = imref[i, ...] > 0.001 * mx
-
-        # > image difference
-        imdiff = imref[i, ...] - imnew[i, ...]
-
+    log.info(f'using {ndim}D images as input')
+
+    nz = shape[0]
+    chunk = nz if not chunk else min(int(chunk), nz)
+    slabs = [(t, z, min(z + chunk, nz)) for t in range(Nim) for z in range(0, nz, chunk)]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def diff(s):
+            ref = rdref(*s)
+            m = np.max(ref)
+            return m, _diff_chunk(ref, rdnew(*s), 0.001 * m)
+
+        slbmx, stats = zip(*executor.map(diff, slabs))
+        stats = list(stats)
+        if chunk < nz:
+            # > the mask threshold from the maximum of each reference frame
+            mx = np.full(Nim, -np.inf)
+            for (t, _, _), m in zip(slabs, slbmx):
+                mx[t] = max(mx[t], m)
+
+            # > the slabs with voxels below the frame threshold compared again
+            def rediff(s):
+                return _diff_chunk(rdref(*s), rdnew(*s), 0.001 * mx[s[0]])
+
+            redo = [i for i, s in enumerate(slabs) if stats[i][4] <= 0.001 * mx[s[0]]]
+            for i, st in zip(redo, executor.map(rediff, [slabs[i] for i in redo])):
+                stats[i] = st
+
+        # > partial sums of each frame
+        sums = np.zeros((Nim, 3))
+        mad = np.zeros(Nim)
+        for (t, _, _), (n, sae, sape, mxd, _) in zip(slabs, stats):
+            sums[t] += n, sae, sape
+            mad[t] = max(mad[t], mxd)
+
+    with np.errstate(invalid='ignore'):
         # > mean absolute percentage difference
-        mape[i] = np.mean(abs(imdiff[msk] / imref[i, msk])) * 100
-
+        mape = sums[:, 2] / sums[:, 0] * 100
         # > mean absolute error
-        mae[i] = np.mean(abs(imdiff[msk]))
-
-        # > maximum absolute difference
-        mad[i] = np.max(abs(imdiff[msk]))
+        mae = sums[:, 1] / sums[:, 0]
+    # > maximum absolute difference
+    mad[sums[:, 0] == 0] = np.nan
 
+    for i in range(Nim):
         if verbose:
             print('---------------------------------------------------------------')
             print('>> frame {}: mean absolute relative image difference [%]:'.format(i))
@@ -215,33 +356,57 @@ def imdiff(imref, imnew, verbose=False, plot=False, cmap='bwr'):
             print(mad[i])
 
         if plot:
+            _plot_diff(rdref(i, 0, nz) - rdnew(i, 0, nz), cmap)
 
-            fig = plt.figure(figsize=(12, 6))
-            fig.suptitle('maximum absolute difference projection along 3 axes', fontsize=12,
-                         fontweight='bold')
+    if Nim > 1:
+        out = {'mape': mape, 'mae': mae, 'mad': mad}
+    else:
+        out = {'mape': mape[0], 'mae': mae[0], 'mad': mad[0]}
 
-            im, valmax = maxproj(imdiff, 0)
+    return out
 
-            plt.subplot(131)
-            plt.imshow(im, cmap=cmap, vmax=maxproj_thrshl * valmax, vmin=-maxproj_thrshl * valmax)
-            plt.colorbar()
 
-            im, valmax = maxproj(imdiff, 1)
+def _plot_diff(imdiff, cmap='bwr'):
+    '''plot the maximum absolute difference projections of one frame along the 3 axes'''
+    import matplotlib.pyplot as plt
 
-            plt.subplot(132)
-            plt.imshow(im, cmap=cmap, vmax=maxproj_thrshl * valmax, vmin=-maxproj_thrshl * valmax)
-            # plt.colorbar()
+    # > threshold percentage used in plotting (helps ignoring singular hot values)
+    maxproj_thrshl = 0.7
 
-            im, valmax = maxproj(imdiff, 2)
-            plt.subplot(133)
-            plt.imshow(im, cmap=cmap, vmax=maxproj_thrshl * valmax, vmin=-maxproj_thrshl * valmax)
-            # plt.colorbar()
+    # > maximum projection along axis ax
+    def maxproj(imdiff, ax):
+        # > maximum projection image
+        imp = np.max(imdiff, axis=ax)
+        # > minimum projection image
+        imn = np.min(imdiff, axis=ax)
+        # > max mask
+        mmsk = imp > abs(imn)
+        # > form the highest intensity projection image (positive and negative)
+        im = imn.copy()
+        im[mmsk] = imp[mmsk]
+        # > maximum/minimum value in the difference image for a symmetrical colour map
+        valmax = max(np.max(imp), np.min(imn))
+        return im, valmax
 
-            plt.show()
+    fig = plt.figure(figsize=(12, 6))
+    fig.suptitle('maximum absolute difference projection along 3 axes', fontsize=12,
+                 fontweight='bold')
 
-    if Nim > 1:
-        out = {'mape': mape, 'mae': mae, 'mad': mad}
-    else:
-        out = {'mape': mape[0], 'mae': mae[0], 'mad': mad[0]}
+    im, valmax = maxproj(imdiff, 0)
 
-    return out
+    plt.subplot(131)
+    plt.imshow(im, cmap=cmap, vmax=maxproj_thrshl * valmax, vmin=-maxproj_thrshl * valmax)
+    plt.colorbar()
+
+    im, valmax = maxproj(imdiff, 1)
+
+    plt.subplot(132)
+    plt.imshow(im, cmap=cmap, vmax=maxproj_thrshl * valmax, vmin=-maxproj_thrshl * valmax)
+    # plt.colorbar()
+
+    im, valmax = maxproj(imdiff, 2)
+    plt.subplot(133)
+    plt.imshow(im, cmap=cmap, vmax=maxproj_thrshl * valmax, vmin=-maxproj_thrshl * valmax)
+    # plt.colorbar()
+
+    plt.show()
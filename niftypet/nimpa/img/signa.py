@@ -13,16 +13,27 @@ import nibabel as nib
 import numpy as np
 
 from ..prc import imio
+from .gen import _imdiff_src
 
 SZ_VXZ = 2.78      # Signa default axial voxel size
+SLAB_NZ = 16       # default number of axial slices in the slabs of PIFA I/O
 
 
-def pifa2nii(fpifa, fnii=None, outpath=None):
+def _slabs(dset, slab=None):
+    '''axial slabs (slices) of the PIFA dataset, aligned with its HDF5 chunks if any'''
+    if slab is None:
+        slab = dset.chunks[0] if dset.chunks else SLAB_NZ
+    nz = dset.shape[0]
+    return [slice(z, min(z + slab, nz)) for z in range(0, nz, slab)]
+
+
+def pifa2nii(fpifa, fnii=None, outpath=None, slab=None):
     ''' Convert the GE PIFA file format to NIfTI. For generating PIFA
         file in the same space as the PET reconstructed image, a NIfTI
         file of the reconstruction needs to be provided as `fnii`.
 
         The NIfTI file needs to represent the whole FOV of 60 cm.
+        The mu-map is read by axial slabs of `slab` slices.
     '''
 
     fpifa = Path(fpifa)
@@ -42,22 +53,22 @@ def pifa2nii(fpifa, fnii=None, outpath=None):
     imio.create_dir(pifadir)
 
     # > read the HDF5 file
-    fh = h5py.File(fpifa, 'r')
-
-    # > Diameter of the transaxial FOV
-    DFOV = fh['HeaderData/ctacDfov'][0]
-
-    # > PIFA x-y voxel size
-    SZ_IMX = fh['HeaderData/xMatrix'][0]
-    SZ_IMZ = fh['HeaderData/zMatrix'][0]
-    # ZLOCAT = fh['HeaderData/tableLocation'][0] # << check if this is really correct
-    SP_VXY = DFOV / SZ_IMX
-
-    # > the mu-map in units of 1/mm
-    mu_dat = np.array(fh['PifaData'])
-
-    # > transpose the data for NIfTI output
-    data = np.transpose(mu_dat[:, ::-1, :], (2, 1, 0))
+    with h5py.File(fpifa, 'r') as fh:
+        # > Diameter of the transaxial FOV
+        DFOV = fh['HeaderData/ctacDfov'][0]
+
+        # > PIFA x-y voxel size
+        SZ_IMX = fh['HeaderData/xMatrix'][0]
+        SZ_IMZ = fh['HeaderData/zMatrix'][0]
+        # ZLOCAT = fh['HeaderData/tableLocation'][0] # << check if this is really correct
+        SP_VXY = DFOV / SZ_IMX
+
+        # > the mu-map in units of 1/mm transposed for NIfTI output
+        # > (copied by slabs into the output in the NIfTI (Fortran) order)
+        dset = fh['PifaData']
+        data = np.empty(dset.shape[::-1], dtype=dset.dtype, order='F')
+        for z in _slabs(dset, slab):
+            data[..., z] = np.transpose(dset[z][:, ::-1, :], (2, 1, 0))
 
     # > if affine is not provided through the NIfTI
     if affine is None:
@@ -90,10 +101,14 @@ def pifa2nii(fpifa, fnii=None, outpath=None):
     return fout
 
 
-def nii2pifa(fnii, fpifa, outpath=None, bed_mask_thresh=0.2):
+def nii2pifa(fnii, fpifa, outpath=None, bed_mask_thresh=0.2, slab=None, arrays=True):
     '''
     Convert a newly generated PIFA NIfTI `fnii` file to the
     GE PIFA file format using the original PIFA file `fpifa`.
+    The mu-map and the PIFA data are processed by axial slabs of `slab`
+    slices into the copied files, which are then reopened and verified
+    slab by slab; the new and original PIFA arrays are output only for
+    `arrays=True` (otherwise the peak memory is of about one slab).
     '''
 
     fpifa = Path(fpifa)
@@ -115,34 +130,54 @@ def nii2pifa(fnii, fpifa, outpath=None, bed_mask_thresh=0.2):
     shutil.copyfile(fpifa, fpifa_n)
     shutil.copyfile(fpifa_ivv, fpifa_ivv_n)
 
-    with h5py.File(fpifa_n, 'r+') as fh, h5py.File(fpifa_ivv_n, 'r+') as fh_ivv:
-        # > get all the components of original PIFA
-        pifa = np.array(fh['PifaData'])
-        pifa_ivv = np.array(fh_ivv['PifaData'])
-        bed = pifa - pifa_ivv
-        msk_bed = bed > bed_mask_thresh * np.max(bed)
+    # > the new mu-map read by slabs (oriented as in `getnii`)
+    dim, shape, _, read = _imdiff_src(fnii)
+    if dim != 3:
+        raise ValueError('the NIfTI mu-map has to be 3D')
+    nz = shape[0]
 
-        # > make the new mu-map to PIFA
-        newpifa_ivv = 0.1 * imio.getnii(fnii)
-        # > flip the z-axis (in GE systems it's the other way round)
-        # > and set to zero the voxels which belong to the bed/table
-        newpifa_ivv = newpifa_ivv[::-1, ...] * ~msk_bed
+    def blend(dset, dset_ivv, z, bedmax):
+        '''the original PIFA slab and the new PIFA slabs (object and object with the bed)'''
+        pifa = dset[z]
+        bed = pifa - dset_ivv[z]
+        msk_bed = bed > bed_mask_thresh * bedmax
 
-        # > blend the bed and object
-        newpifa = np.maximum(bed, newpifa_ivv)
-
-        fh['PifaData'][...] = newpifa
-        fh_ivv['PifaData'][...] = newpifa_ivv
-
-    # > check if edited:
-    with h5py.File(fpifa_n, 'r') as fcheck:
-        dcheck = fcheck['PifaData'][...]
-    if not np.allclose(dcheck, newpifa):
-        raise ValueError('the CT modification did not work')
+        # > the mu-map slab with the z-axis flipped (in GE systems it's the other way round)
+        # > and set to zero in the voxels which belong to the bed/table
+        newpifa_ivv = 0.1 * read(0, nz - z.stop, nz - z.start)[::-1] * ~msk_bed
 
-    with h5py.File(fpifa_ivv_n, 'r') as fcheck:
-        dcheck = fcheck['PifaData'][...]
-    if not np.allclose(dcheck, newpifa_ivv):
-        raise ValueError('the CT modification did not work')
-
-    return {'fpifa': fpifa_n, 'fpifa_ivv': fpifa_ivv_n, 'pifa': newpifa, 'opifa': pifa}
+        # > blend the bed and object
+        return pifa, np.maximum(bed, newpifa_ivv), newpifa_ivv
+
+    out = {'fpifa': fpifa_n, 'fpifa_ivv': fpifa_ivv_n}
+    with h5py.File(fpifa, 'r') as fo, h5py.File(fpifa_ivv, 'r') as fo_ivv:
+        dset, dset_ivv = fo['PifaData'], fo_ivv['PifaData']
+        if shape != dset.shape or dset_ivv.shape != dset.shape:
+            raise ValueError('the NIfTI and PIFA images are of different shapes')
+        slabs = _slabs(dset, slab)
+
+        # > the bed/table is the difference of the original PIFA components
+        bedmax = max(np.max(dset[z] - dset_ivv[z]) for z in slabs)
+
+        with h5py.File(fpifa_n, 'r+') as fh, h5py.File(fpifa_ivv_n, 'r+') as fh_ivv:
+            for z in slabs:
+                pifa, newpifa, newpifa_ivv = blend(dset, dset_ivv, z, bedmax)
+                fh['PifaData'][z] = newpifa
+                fh_ivv['PifaData'][z] = newpifa_ivv
+
+                if arrays:
+                    if 'pifa' not in out:
+                        out['pifa'] = np.empty(dset.shape, dtype=newpifa.dtype)
+                        out['opifa'] = np.empty(dset.shape, dtype=dset.dtype)
+                    out['pifa'][z] = newpifa
+                    out['opifa'][z] = pifa
+
+        # > check if edited (the closed files reopened)
+        with h5py.File(fpifa_n, 'r') as fh, h5py.File(fpifa_ivv_n, 'r') as fh_ivv:
+            for z in slabs:
+                _, newpifa, newpifa_ivv = blend(dset, dset_ivv, z, bedmax)
+                if not (np.allclose(fh['PifaData'][z], newpifa)
+                        and np.allclose(fh_ivv['PifaData'][z], newpifa_ivv)):
+                    raise ValueError('the CT modification did not work')
+
+    return out
@@ -1,81 +1,43 @@
 # initialise the module folder
-__all__ = [
-    # imio
-    'array2nii', 'create_dir', 'dcm2im', 'dcm2nii', 'dcmanonym', 'dcminfo', 'dcmsort', 'fwhm2sig',
-    'mgh2nii', 'getmgh', 'getnii', 'getnii_descr', 'nii_gzip', 'nii_ugzip', 'niisort', 'orientnii',
-    'pick_t1w', 'time_stamp', 'rem_chars', 'isdcm', 'dcmdir',
-    # prc
-    'bias_field_correction', 'centre_mass_img', 'centre_mass_rel', 'centre_mass_corr', 'ct2mu',
-    'im_cut', 'imsmooth', 'imtrimup',
-    'iyang', 'nii_modify', 'pet2pet_rigid', 'psf_gaussian', 'psf_measured', 'pvc_iyang',
-    # num
-    'conv_separable', 'isub', 'nlm',
-    # regseg
-    'aff_dist', 'affine_dipy', 'affine_fsl', 'affine_niftyreg',
-    'coreg_spm', 'coreg_vinci', 'create_mask', 'dice_coeff', 'dice_coeff_multiclass',
-    'imfill', 'motion_reg', 'realign_mltp_spm', 'resample_fsl', 'resample_dipy',
-    'resample_mltp_spm', 'resample_niftyreg', 'resample_spm',
-    'resample_vinci'] # yapf: disable
+from importlib import import_module
 
-from .imio import (
-    array2nii,
-    create_dir,
-    dcm2im,
-    dcm2nii,
-    dcmanonym,
-    dcmdir,
-    dcminfo,
-    dcmsort,
-    fwhm2sig,
-    getmgh,
-    getnii,
-    getnii_descr,
-    isdcm,
-    mgh2nii,
-    nii_gzip,
-    nii_ugzip,
-    niisort,
-    orientnii,
-    pick_t1w,
-    rem_chars,
-    time_stamp,
-)
-from .num import conv_separable, isub, nlm
+# > public names of each submodule, imported on first access (PEP 562)
+_SUBMODULES = {
+    'imio': (
+        'array2nii', 'create_dir', 'dcm2im', 'dcm2nii', 'dcmanonym', 'dcminfo', 'dcmsort',
+        'fwhm2sig', 'mgh2nii', 'getmgh', 'getnii', 'getnii_descr', 'nii_gzip', 'nii_ugzip',
+        'nii_update_hdr', 'niisort', 'orientnii', 'pick_t1w', 'time_stamp', 'rem_chars', 'isdcm',
+        'dcmdir'),
+    # will be deprecated
+    'prc': (
+        'bias_field_correction', 'centre_mass_img', 'centre_mass_rel', 'centre_mass_corr',
+        'ct2mu', 'im_cut', 'imsmooth', 'imtrimup', 'iyang', 'nii_modify', 'pet2pet_rigid',
+        'psf_gaussian', 'psf_kernel', 'psf_measured', 'pvc_iyang', 'pvc_session',
+        'roi_labels'),
+    'num': ('conv_separable', 'isub', 'nlm'),
+    'regmi': ('affine_mi',),
+    'regseg': (
+        'aff_dist', 'aff_rigid_params', 'affine_dipy', 'affine_fsl', 'affine_niftyreg',
+        'coreg_spm', 'coreg_vinci', 'create_mask', 'dice_coeff', 'dice_coeff_multiclass',
+        'dipy_regctx', 'imfill', 'motion_reg', 'motion_reg_dipy', 'realign_mltp_spm',
+        'resample_apply', 'resample_batch', 'resample_fsl', 'resample_dipy', 'resample_plan',
+        'resample_mltp_spm', 'resample_niftyreg', 'resample_spm', 'resample_vinci')}
 
-# will be deprecated
-from .prc import (
-    bias_field_correction,
-    centre_mass_corr,
-    centre_mass_img,
-    centre_mass_rel,
-    ct2mu,
-    im_cut,
-    imsmooth,
-    imtrimup,
-    iyang,
-    nii_modify,
-    pet2pet_rigid,
-    psf_gaussian,
-    psf_measured,
-    pvc_iyang,
-)
-from .regseg import (
-    aff_dist,
-    affine_dipy,
-    affine_fsl,
-    affine_niftyreg,
-    coreg_spm,
-    coreg_vinci,
-    create_mask,
-    dice_coeff,
-    dice_coeff_multiclass,
-    imfill,
-    motion_reg,
-    realign_mltp_spm,
-    resample_dipy,
-    resample_fsl,
-    resample_mltp_spm,
-    resample_niftyreg,
-    resample_spm,
-    resample_vinci,
-)
+__all__ = [k for names in _SUBMODULES.values() for k in names]
+
+_LAZY = {k: '.' + mod for mod, names in _SUBMODULES.items() for k in names}
+
+
+def __getattr__(name):
+    '''import the submodule of the public name only when it is used'''
+    if name in _SUBMODULES:
+        return import_module('.' + name, __name__)
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    val = getattr(import_module(_LAZY[name], __name__), name)
+    globals()[name] = val
+    return val
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | set(_SUBMODULES))
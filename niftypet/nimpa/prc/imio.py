@@ -1,18 +1,19 @@
 """image input/output functionalities."""
 import datetime
+import gzip
 import logging
 import numbers
 import os
 import pathlib
 import re
 import shutil
+import tempfile
 from pathlib import Path
 from subprocess import run
 from textwrap import dedent
 
 import nibabel as nib
 import numpy as np
-import pydicom as dcm
 from miutil.fdio import create_dir, hasext
 from miutil.imio.nii import getnii  # NOQA: F401 # yapf: disable
 from miutil.imio.nii import nii_gzip  # NOQA: F401 # yapf: disable
@@ -20,9 +21,6 @@ from miutil.imio.nii import nii_ugzip  # NOQA: F401 # yapf: disable
 from miutil.imio.nii import niisort  # NOQA: F401 # yapf: disable
 from miutil.imio.nii import array2nii
 
-# > NiftyPET resources
-from .. import resources as rs
-
 log = logging.getLogger(__name__)
 
 # > possible extensions for DICOM files
@@ -62,6 +60,7 @@ def rem_chars(txt, replacement_char='_'):
 
 
 def isdcm(f):
+    import pydicom as dcm
     try:
         dcm.dcmread(f)
     except Exception:
@@ -200,6 +199,81 @@ def getnii_descr(fim):
     return rcndic
 
 
+def nii_update_hdr(fnii, affine=None, descrip=None, fout=None, chunk_size=2**24):
+    '''
+    Update the affine (qform and sform) and/or the description of an existing
+    NIfTI file without decoding or re-casting the voxel data.
+    Arguments:
+        fnii:   the input NIfTI file (*.nii or *.nii.gz)
+        affine: new 4x4 affine matrix for both qform and sform; the existing
+                transform codes are kept (or set to 'aligned' if unset)
+        descrip: new content of the `descrip` header field
+        fout:   output NIfTI file; if None, the input file is updated in place.
+                The output is compressed if its name ends with '.gz'.
+        chunk_size: the size in bytes of the chunks used when streaming the
+                voxel data from the input to the output file
+    Return:
+        the path of the updated NIfTI file.
+    Note:
+        The header is rewritten in place for uncompressed files, otherwise the
+        byte stream after the header (extensions and voxel data) is copied
+        chunk-wise into the new file, so the memory use is bounded by
+        `chunk_size` regardless of the image size.
+    '''
+    fnii = Path(fnii)
+    if not fnii.is_file():
+        raise IOError('the input NIfTI file does not exist')
+
+    fout = fnii if fout is None else Path(fout)
+    ingz = hasext(fnii, 'gz')
+    outgz = hasext(fout, 'gz')
+    fopen_in = gzip.open if ingz else open
+
+    # > read the raw header from the file (the header of a loaded image has
+    # > the data scaling reset, which must not be written back)
+    hdr_class = nib.load(fnii).header_class
+    with fopen_in(fnii, 'rb') as f:
+        hdr = hdr_class.from_fileobj(f)
+    if affine is not None:
+        affine = np.asanyarray(affine, dtype=np.float64)
+        if affine.shape != (4, 4):
+            raise ValueError('Affine should be a 4x4 array.')
+        hdr.set_qform(affine, code=None)
+        hdr.set_sform(affine, code=None)
+    if descrip is not None:
+        hdr['descrip'] = descrip
+    hblk = hdr.binaryblock
+
+    # > in-place rewrite of the header bytes for uncompressed NIfTI
+    if fout == fnii and not ingz:
+        with open(fnii, 'r+b') as f:
+            f.write(hblk)
+        return fout
+
+    # > stream the rest of the file into a temporary file next to
+    # > the output and then move it atomically into place
+    opth = fout.parent
+    create_dir(opth)
+    fd, ftmp = tempfile.mkstemp(dir=opth, prefix='.' + fout.name, suffix='.tmp')
+    os.close(fd)
+    try:
+        with fopen_in(fnii, 'rb') as fi, open(ftmp, 'wb') as fraw:
+            fo = gzip.GzipFile(fileobj=fraw, mode='wb', filename='') if outgz else fraw
+            try:
+                fi.read(len(hblk))
+                fo.write(hblk)
+                shutil.copyfileobj(fi, fo, chunk_size)
+            finally:
+                if outgz:
+                    fo.close()
+        os.replace(ftmp, fout)
+    finally:
+        if os.path.isfile(ftmp):
+            os.remove(ftmp)
+
+    return fout
+
+
 def orientnii(imfile, Cnt=None):
     '''Get the orientation from NIfTI sform.  Not fully functional yet.'''
 
@@ -251,6 +325,8 @@ def dcminfo(dcmvar, Cnt=None, output='class', t1_name='mprage'):
         'detail' gives most relevant tags in dictionary
       t1_name(str): helps identify T1w MR image present in series or file names
     """
+    import pydicom as dcm
+
     if Cnt is None:
         Cnt = {}
 
@@ -616,6 +692,7 @@ def dcmsort(folder, copy_series=False, Cnt=None, outpath=None, grouping='t+d'):
                     or by acquisition and series times plus series description
                     ('a+t+d'), or using series instance unique id ('d+suid').
     '''
+    import pydicom as dcm
 
     # > insure that `folder` is Path object
     folder = Path(folder)
@@ -902,6 +979,8 @@ def dcmanonym(dcmpth, displayonly=False, patient='anonymised', physician='anonym
         > dob:      patient's date of birth.
         > Cnt:      dictionary of constants (containing logging variable)
     '''
+    import pydicom as dcm
+
     # > check if the dictionary of constant is given
     if Cnt is None:
         Cnt = {}
@@ -1049,6 +1128,8 @@ def dcm2nii(
         return fimout
 
     if not executable:
+        # > NiftyPET resources
+        from .. import resources as rs
         executable = getattr(rs, 'DCM2NIIX', None)
         if not executable:
             import dcm2niix
@@ -1088,6 +1169,8 @@ def dcm2im(fpth):
     Get the DICOM files from 'fpth' into an image with the affine transformation.
     fpth can be a list of DICOM files or a path (string) to the folder with DICOM files.
     '''
+    import pydicom as dcm
+
     # possible DICOM file extensions
     ext = 'dcm', 'ima'
 
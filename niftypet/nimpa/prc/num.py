@@ -1,4 +1,5 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import scipy.ndimage as ndi
@@ -15,18 +16,43 @@ log = logging.getLogger(__name__)
 FLOAT_MAX = np.float32(np.inf)
 
 
-def conv_separable(vol, knl, dev_id=0, output=None, sync=True):
+def conv_separable(vol, knl, dev_id=0, output=None, sync=True, max_workers=None):
     """
     Args:
       vol(ndarray): Can be any number of dimensions `ndim`
-        (GPU requires `ndim <= 3`).
+        (GPU requires `ndim <= 3`), or `ndim + 1` for a series of frames
+        (along the first axis) all convolved with the same kernel.
       knl(ndarray): `ndim` x `width` separable kernel
         (GPU requires `width <= 17`).
       dev_id(int or bool): GPU device ID to try [default: 0].
         Set to `False` to force CPU fallback.
+      max_workers(int): number of threads for convolving the frames on the CPU.
     """
-    assert vol.ndim == len(knl)
     assert knl.ndim == 2
+    assert vol.ndim in (len(knl), len(knl) + 1)
+    if vol.ndim > len(knl):
+        # > frames convolved into one preallocated output
+        if output is None:
+            output = np.empty(vol.shape, dtype=vol.dtype)
+        elif output.shape != vol.shape:
+            raise IndexError(f"output shape must be {vol.shape}: got {output.shape}")
+
+        gpu = improc is not None and dev_id is not False
+
+        def conv_frame(i):
+            if gpu:
+                output[i] = conv_separable(vol[i], knl, dev_id=dev_id, sync=sync)
+            else:
+                conv_separable(vol[i], knl, dev_id=False, output=output[i])
+
+        if gpu:
+            for i in range(len(vol)):
+                conv_frame(i)
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(conv_frame, range(len(vol))))
+        return output
+
     if len(knl) > 3 or knl.shape[1] > 17:
         log.warning("kernel larger than 3 x 17 not supported on GPU")
         dev_id = False
@@ -52,8 +78,7 @@ def conv_separable(vol, knl, dev_id=0, output=None, sync=True):
     else:
         log.debug("CPU conv")
         for dim in range(len(knl)):
-            h = knl[dim].reshape((1,) * dim + (-1,) + (1,) * (len(knl) - dim - 1))
-            vol = ndi.convolve(vol, h, output=output, mode='constant', cval=0.)
+            vol = ndi.convolve1d(vol, knl[dim], axis=dim, output=output, mode='constant', cval=0.)
         return vol
 
 
@@ -8,9 +8,11 @@ import os
 import pathlib
 import re
 import sys
+from functools import lru_cache
 from pathlib import Path, PurePath
 from subprocess import run
 from textwrap import dedent
+from time import time
 from warnings import warn
 
 import nibabel as nib
@@ -48,21 +50,12 @@ def num(s):
         return float(s)
 
 
-def psf_gaussian(vx_size=(1, 1, 1), fwhm=(6, 5, 5), hradius=8):
-    '''
-    Separable kernels for Gaussian convolution executed on the GPU device
-    The output kernels are in this order: z, y, x
-    '''
-
-    # if voxel size is given as scalar, interpret it as an isotropic
-    # voxel size.
-    if isinstance(vx_size, (float, int)):
-        vx_size = [vx_size, vx_size, vx_size]
+# > maximum number of cached PSF kernels (see `psf_kernel`)
+PSF_CACHE_SIZE = 64
 
-    # the same for the Gaussian kernel
-    if isinstance(fwhm, (float, int)):
-        fwhm = [fwhm, fwhm, fwhm]
 
+def _gauss_krnl(vx_size, fwhm, hradius):
+    '''separable Gaussian kernels (z, y, x) for 3-tuples of voxel size and FWHM'''
     # avoid zeros in FWHM
     fwhm = [x + 1e-3 * (x <= 0) for x in fwhm]
 
@@ -81,26 +74,73 @@ def psf_gaussian(vx_size=(1, 1, 1), fwhm=(6, 5, 5), hradius=8):
     yKrnl /= np.sum(yKrnl)
     zKrnl /= np.sum(zKrnl)
 
-    krnl = np.array([zKrnl, yKrnl, xKrnl], dtype=np.float32)
+    return np.array([zKrnl, yKrnl, xKrnl], dtype=np.float32)
 
-    # for checking if the normalisation worked
-    # np.prod( np.sum(krnl,axis=1) )
 
-    # return all kernels together
-    return krnl
-
-
-# ----------------------------------------------------------------------
-def psf_measured(scanner='mmr', scale=1):
-    if scanner == 'mmr':
+@lru_cache(maxsize=PSF_CACHE_SIZE)
+def _psf_cached(vx_size, fwhm, hradius, scanner, scale):
+    '''the cached (read-only) kernels of `psf_kernel` for the normalised key'''
+    if scanner is None:
+        krnl = _gauss_krnl(vx_size, fwhm, hradius)
+    elif scanner == 'mmr':
         # file name for the mMR's PSF and chosen scale
         fdat = os.fspath(
             resources.files("niftypet.nimpa").resolve() / "auxdata" / f"PSF-17_scl-{scale:d}.npy")
         # transaxial and axial PSF
         Hxy, Hz = np.load(fdat)
-        return np.array([Hz, Hxy, Hxy], dtype=np.float32)
-    raise NameError(f'Unsupported scanner ({scanner}):'
-                    ' only Siemens mMR (mmr) is currently supported')
+        krnl = np.array([Hz, Hxy, Hxy], dtype=np.float32)
+    else:
+        raise NameError(f'Unsupported scanner ({scanner}):'
+                        ' only Siemens mMR (mmr) is currently supported')
+
+    krnl.setflags(write=False)
+    return krnl
+
+
+def _psf_scanner(scanner, scale):
+    '''the cached measured PSF of the `scanner` for an integral `scale`'''
+    if scanner != 'mmr':
+        raise NameError(f'Unsupported scanner ({scanner}):'
+                        ' only Siemens mMR (mmr) is currently supported')
+    if scale != int(scale):
+        raise ValueError(f'the PSF scale has to be an integer: got {scale}')
+    return _psf_cached(None, None, None, scanner, int(scale))
+
+
+def psf_kernel(vx_size=(1, 1, 1), fwhm=(6, 5, 5), hradius=8, scanner=None, scale=1):
+    '''
+    PSF factory: separable kernels (z, y, x) cached for the voxel size, FWHM
+    and kernel radius (Gaussian PSF) or for the `scanner` and `scale`
+    (measured PSF), so that repeated smoothing does not rebuild the kernels
+    or re-read the PSF files.  `hradius=None` extends the radius beyond 8 if
+    needed to fit the PSF.  The cache is bounded (`PSF_CACHE_SIZE`) and the
+    returned kernels are read-only (shared).
+    '''
+    if scanner is not None:
+        return _psf_scanner(scanner, scale)
+
+    # if voxel size (or FWHM) is given as scalar, interpret it as isotropic
+    vx_size = tuple(float(v) for v in np.broadcast_to(vx_size, (3,)))
+    fwhm = tuple(float(f) for f in np.broadcast_to(fwhm, (3,)))
+    if hradius is None:
+        # > check if the GPU kernel size (17, radius=8) will be sufficient to fit the PSF
+        hradius = max(8, int(2 * max(fwhm) / min(vx_size) + 1) // 2)
+    return _psf_cached(vx_size, fwhm, int(hradius), None, None)
+
+
+def psf_gaussian(vx_size=(1, 1, 1), fwhm=(6, 5, 5), hradius=8):
+    '''
+    Separable kernels for Gaussian convolution executed on the GPU device
+    The output kernels are in this order: z, y, x
+    (a copy of the cached kernels, see `psf_kernel`)
+    '''
+    return psf_kernel(vx_size=vx_size, fwhm=fwhm, hradius=hradius).copy()
+
+
+# ----------------------------------------------------------------------
+def psf_measured(scanner='mmr', scale=1):
+    '''measured PSF of the scanner (a copy of the cached kernels, see `psf_kernel`)'''
+    return _psf_scanner(scanner, scale).copy()
 
 
 # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
@@ -108,13 +148,23 @@ def psf_measured(scanner='mmr', scale=1):
 # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
 
 
+def psf_fwhm(fwhm, voxsize):
+    '''
+    Gaussian PSF kernels (z,y,x) as used by `imsmooth` for the FWHM and voxel
+    size, with the kernel radius extended beyond 8 if needed to fit the PSF.
+    '''
+    return psf_kernel(vx_size=voxsize, fwhm=fwhm, hradius=None)
+
+
 def imsmooth(fim, fwhm=4, psf=None, voxsize=None, fout='', output='image', output_array=None,
-             gpu=None, dev_id=0, sync=True, Cnt=None):
+             gpu=None, dev_id=0, sync=True, Cnt=None, max_workers=None):
     '''
     Smooth image using Gaussian filter with either the PSF or FWHM given
     as an option.  By default FWHM = 4 is used with voxel size assumed 1 mm.
     Arguments:
-    - fim:  can be a NIfTI image file or Numpy array
+    - fim:  can be a NIfTI image file or Numpy array; 4D (dynamic) images are
+            smoothed frame by frame with the same kernel into one output
+            (4D NIfTI for file input)
     - fwhm: the width at half max of the Gaussian kernel (z,y,x)
     - psf:  the point spread function for each direction (z,y,x) given as a
             Numpy matrix of 3x17 and used on the GPU as separable kernel
@@ -125,6 +175,8 @@ def imsmooth(fim, fwhm=4, psf=None, voxsize=None, fout='', output='image', outpu
       (set to `False` to force disable GPU)
     - sync: whether to `cudaDeviceSynchronize()` after GPU operations
     - gpu: ignored
+    - max_workers: number of threads for smoothing the frames of 4D images
+      on the CPU
     '''
     if gpu is not None:
         warn("gpu is automatic", DeprecationWarning, stacklevel=2)
@@ -155,14 +207,10 @@ def imsmooth(fim, fwhm=4, psf=None, voxsize=None, fout='', output='image', outpu
         elif voxsize is None and Cnt is None:
             raise ValueError('the correct voxel size has to be provided')
 
-        # > check if the GPU kernel size (17, radius=8) will be sufficient to fit the PSF
-        if np.any(2 * (fwhm / np.min(voxsize)) > (17 - 1)):
-            hradius = (2 * (fwhm / np.min(voxsize)) + 1) // 2
-            psf = psf_gaussian(vx_size=voxsize, fwhm=fwhm, hradius=hradius)
-        else:
-            psf = psf_gaussian(vx_size=voxsize, fwhm=fwhm)
+        psf = psf_fwhm(fwhm, voxsize)
 
-    imsmo = conv_separable(im, psf, output=output_array, dev_id=dev_id, sync=sync)
+    imsmo = conv_separable(im, psf, output=output_array, dev_id=dev_id, sync=sync,
+                           max_workers=max_workers)
 
     # output dictionary
     dctout = {}
@@ -171,7 +219,8 @@ def imsmooth(fim, fwhm=4, psf=None, voxsize=None, fout='', output='image', outpu
 
     if isfile and fout == '':
         if hasext(fim, 'nii.gz'):
-            fout = fim.split('.nii.gz')[0] + '_smo' + str(fwhm).replace('.', '-') + '.nii.gz'
+            fout = os.fspath(fim).split('.nii.gz')[0] + '_smo' + str(fwhm).replace(
+                '.', '-') + '.nii.gz'
         else:
             fout = os.path.splitext(fim)[0] + '_smo' + str(fwhm).replace(
                 '.', '-') + os.path.splitext(fim)[1]
@@ -614,45 +663,138 @@ def imtrimup(fims, refim='', affine=None, flip=None, trnsp=None, scale=2, divdim
 
 
 # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
-def iyang(imgIn, krnl, imgSeg, Cnt, itr=5):
+def roi_labels(prc, pvcroi):
+    '''
+    ROI label image for the PVC: the regions of `pvcroi` (lists of the
+    parcellation labels) are numbered 1, 2, ... and the rest is 0.  The
+    parcellation image `prc` is remapped through a look-up table of labels
+    (the later regions take the labels repeated in `pvcroi`).
+    '''
+    prc = np.asanyarray(prc)
+    lmax = max([int(m) for r in pvcroi for m in r] + [0])
+
+    # > look-up table with the last entry for all other values
+    lut = np.zeros(lmax + 2, dtype=prc.dtype)
+    for k, r in enumerate(pvcroi):
+        lut[np.asarray(r, dtype=np.intp)] = k + 1
+
+    idx = np.clip(prc, 0, lmax + 1).astype(np.intp)
+    idx[idx != prc] = lmax + 1
+    return lut[idx]
+
+
+def _roi_index(imgSeg):
+    '''
+    Flat region index of the segmentation (regions 0...m and m+1 for any other
+    values), the region voxel counts and the mask of voxels outside regions.
+    '''
+    m = int(np.max(imgSeg))
+    seg = imgSeg.ravel()
+    idx = seg.astype(np.intp)
+    out = (idx != seg) | (idx < 0)
+    idx[out] = m + 1
+    return idx, np.bincount(idx, minlength=m + 2), out if out.any() else None
+
+
+def _roi_means(img, idx, cnt):
+    '''
+    Regional means (all regions and the other values at the end) of the image
+    or of each frame of the image (frames x regions).
+    '''
+    img = img.reshape(-1, len(idx))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.array([np.bincount(idx, weights=f, minlength=len(cnt)) for f in img]) / cnt
+
+
+def iyang(imgIn, krnl, imgSeg, Cnt, itr=5, max_workers=None, tol=None, info=False):
     '''
     Partial volume correction using iterative Yang method.
     Arguments:
-        imgIn: input image which is blurred due to the PSF of the scanner
+        imgIn: input image which is blurred due to the PSF of the scanner;
+          dynamic (4D) images are corrected for all frames (along the first
+          axis) at once with the same segmentation and kernel
         krnl: shift invariant kernel of the PSF
         imgSeg: segmentation into regions starting with 0 (e.g., background)
           and then next integer numbers
-        itr: number of iteration (default 5)
+        itr: number of iteration (default 5), the maximum number if `tol` is given
+        max_workers: number of threads for convolving the frames on the CPU
+        tol: tolerance of the maximum relative change of the regional means
+          between iterations for stopping early
+        info: if True, also output the dictionary with the number of iterations
+          used ('itr'), the relative changes ('change') and the timing [s] ('time')
+          of each iteration
+    The regional operations use one index of the regions (grouped sums) and
+    the iterations reuse the preallocated image buffers.
+    Returns the corrected image and the regional means for each iteration,
+    (regions x iterations) or (frames x regions x iterations) for 4D images.
     '''
     dim = imgIn.shape
-    m = np.int32(np.max(imgSeg))
-    m_a = np.zeros((m + 1, itr), dtype=np.float32)
-
-    for jr in range(0, m + 1):
-        m_a[jr, 0] = np.mean(imgIn[imgSeg == jr])
-
-    # init output image
-    imgOut = np.copy(imgIn)
+    dyn = imgIn.ndim == imgSeg.ndim + 1
+    if dim[dyn:] != imgSeg.shape:
+        raise ValueError('the image and segmentation shapes do not match')
+    idx, cnt, out = _roi_index(imgSeg)
+    m = len(cnt) - 2
+    m_a = np.zeros((dim[0] if dyn else 1, m + 1, itr), dtype=np.float32)
+    stats = {'itr': 0, 'change': np.zeros(itr), 'time': np.zeros(itr)}
+
+    mprv = _roi_means(imgIn, idx, cnt)[:, :-1]
+    m_a[..., 0] = mprv
+
+    # > image buffers: output, piece-wise constant (PWC) and smoothed/correction images
+    dtype = np.result_type(imgIn.dtype, np.float32)
+    imgOut = np.array(imgIn, dtype=dtype)
+    imgPWC = np.empty(dim, dtype=dtype)
+    imgSmo = np.empty(dim, dtype=dtype)
+    msk = np.empty(dim, dtype=bool)
+    # > flat (frames x voxels) views
+    outF, pwcF = imgOut.reshape(-1, len(idx)), imgPWC.reshape(-1, len(idx))
 
     # iterative Yang algorithm:
     for i in range(0, itr):
         log.debug('PVC Yang iteration = {}'.format(i))
-        # piece-wise constant image
-        imgPWC = imgOut
-        imgPWC[imgPWC < 0] = 0
-        for jr in range(0, m + 1):
-            imgPWC[imgSeg == jr] = np.mean(imgPWC[imgSeg == jr])
-
-        # blur the piece-wise constant image
-        imgSmo = conv_separable(imgPWC, krnl, dev_id=Cnt['DEVID'])
-
-        # correction factors
-        imgCrr = np.ones(dim, dtype=np.float32)
-        imgCrr[imgSmo > 0] = imgPWC[imgSmo > 0] / imgSmo[imgSmo > 0]
-        imgOut = imgIn * imgCrr
-        for jr in range(0, m + 1):
-            m_a[jr, i] = np.mean(imgOut[imgSeg == jr])
+        t0 = time()
 
+        # piece-wise constant image
+        np.maximum(imgOut, 0, out=imgOut)
+        mns = _roi_means(imgOut, idx, cnt).astype(dtype)
+        for f in range(len(mns)):
+            np.take(mns[f], idx, out=pwcF[f])
+            if out is not None:
+                np.copyto(pwcF[f], outF[f], where=out)
+
+        # blur the piece-wise constant image (all frames)
+        imgSmo = conv_separable(imgPWC, krnl, dev_id=Cnt['DEVID'], output=imgSmo,
+                                max_workers=max_workers)
+
+        # correction factors (in place of the blurred image)
+        np.greater(imgSmo, 0, out=msk)
+        np.divide(imgPWC, imgSmo, out=imgSmo, where=msk)
+        np.copyto(imgSmo, 1, where=~msk)
+        np.multiply(imgIn, imgSmo, out=imgOut)
+
+        mcur = _roi_means(imgOut, idx, cnt)[:, :-1]
+        m_a[..., i] = mcur
+
+        # > maximum relative change of the regional means
+        with np.errstate(invalid='ignore', divide='ignore'):
+            chng = np.abs(mcur - mprv) / np.abs(mprv)
+        chng = chng[np.isfinite(chng)]
+        stats['change'][i] = chng.max() if chng.size else 0
+        mprv = mcur
+        stats['time'][i] = time() - t0
+        stats['itr'] = i + 1
+        log.debug('PVC Yang iteration {}: relative change {:.3g} ({:.3f} s)'.format(
+            i, stats['change'][i], stats['time'][i]))
+
+        if tol is not None and stats['change'][i] < tol:
+            log.info('PVC Yang converged after {} iterations'.format(i + 1))
+            break
+
+    n = stats['itr']
+    m_a = m_a[..., :n] if dyn else m_a[0, :, :n]
+    if info:
+        stats['change'], stats['time'] = stats['change'][:n], stats['time'][:n]
+        return imgOut, m_a, stats
     return imgOut, m_a
 
 
@@ -662,82 +804,67 @@ def iyang(imgIn, krnl, imgSeg, Cnt, itr=5):
 # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
 # G E T   P A R C E L L A T I O N S   F O R   P V C   A N D   R O I   E X T R A C T I O N
 # ------------------------------------------------------------------------------------------------------
-def pvc_iyang(
+def _pvc_pet(petin):
+    '''PET image, file path and affine of the PVC input (dictionary or NIfTI file)'''
+    if isinstance(petin, dict):
+        return petin['im'], petin['fpet'], petin['affine']
+    elif isinstance(petin, (str, pathlib.PurePath)) and os.path.isfile(petin):
+        imdct = imio.getnii(petin, output='all')
+        return imdct['im'], os.fspath(petin), imdct['affine']
+    raise IOError('e> unrecognised input PET file')
+
+
+def _pvc_static(fpet, outpath, fcomment=''):
+    '''frame-averaged (static) image of the dynamic PET file `fpet` for the registration'''
+    nii = nib.load(fpet)
+    hdr = nii.header.copy()
+    hdr.set_data_dtype(np.float32)
+    fstat = os.path.join(
+        outpath,
+        os.path.basename(fpet).split('.nii')[0] + '_static' + fcomment + '.nii.gz')
+    im = nii.get_fdata(dtype=np.float32).mean(axis=3)
+    nib.save(nib.Nifti1Image(im, nii.affine, hdr), fstat)
+    return fstat
+
+
+def pvc_session(
     petin,
     mrin,
     Cnt,
     pvcroi,
-    krnl,
-    itr=5,
     tool='niftyreg',
     faff=None,
     outpath='',
     fcomment='',
-    store_img=False,
     store_rois=False,
     matlab_eng_name='',
 ):
-    ''' Perform partial volume (PVC) correction of PET data (petin) using MRI data (mrin).
-        The PVC method uses iterative Yang method.
-        GPU based convolution is the key routine of the PVC.
-        Input:
-        -------
-        petin:  either a dictionary containing image data, file name and affine transform,
-                or a string of the path to the NIfTI file of the PET data.
-        mrin: a dictionary of MRI data, including the T1w image, which can be given
-                in DICOM (field 'T1DCM') or NIfTI (field 'T1nii').  The T1w image data
-                is needed for co-registration to PET if affine is not given in the text
-                file with its path in faff.
-        Cnt:    a dictionary of paths for third-party tools:
-                * dcm2niix: Cnt['DCM2NIIX']
-                * niftyreg, resample: Cnt['RESPATH']
-                * niftyreg, rigid-reg: Cnt['REGPATH']
-        pvcroi: list of regions (also a list) with number label to distinguish
-                the parcellations.  The numbers correspond to the image values
-                of the parcellated T1w image.  E.g.:
-                pvcroi = [
-                    [36], # ROI 1 (single parcellation region)
-                    [35], # ROI 2
-                    [39, 40, 72, 73, 74], # ROI 3 (multiple parcellation regions)
-                    ...
-                ]
-        kernel: the point spread function (PSF) specific for the camera and the object.
-                It is given as a 3x17 matrix, a 17-element kernel for each dimension (x,y,z).
-                It is used in the GPU-based convolution using separable kernels.
-        outpath:path to the output of the resulting PVC images
-        faff:   a text file of the affine transformations needed to get the MRI into PET space.
-                If not provided, it will be obtained from the performed rigid transformation.
-                For this the MR T1w image is required.  If faff and T1w image are not provided,
-                it will results in exception/error.
-        fcomment:a string used in naming the produced files, helpful for distinguishing them.
-        tool:   co-registration tool.  By default it is NiftyReg, but SPM is also
-                possible (needs Matlab engine and more validation)
-        itr:    number of iterations used by the PVC.  5-10 should be enough (5 default)
     '''
-    # get all the input image properties
-    if isinstance(petin, dict):
-        im = petin['im']
-        fpet = petin['fpet']
-        B = petin['affine']
-    elif isinstance(petin, str) and os.path.isfile(petin):
-        imdct = imio.getnii(petin, output='all')
-        im = imdct['im']
-        B = imdct['affine']
-        fpet = petin
-    else:
-        raise IOError('e> unrecognised input PET file')
+    Prepare the parcellation of a subject for the PVC of many PET images in
+    the same geometry (e.g., longitudinal or repeated scans): the T1w image
+    is registered to the PET `petin` and the parcellation is resampled to
+    it, and the ROI label image for `pvcroi` is compiled (see `roi_labels`),
+    all once.  The returned session (a dictionary) is then passed to
+    `pvc_iyang` with the keyword `session`; see `pvc_iyang` for the arguments.
+    For dynamic (4D) PET files, the T1w image is registered to and the
+    parcellation resampled on the frame-averaged image (saved in the
+    'PVC-preprocessed' folder).
+    '''
+    im, fpet, B = _pvc_pet(petin)
 
-    if im.ndim != 3:
+    if im.ndim not in (3, 4):
         raise IndexError(
-            'Only 3D images are expected in this method of partial volume correction.')
+            'Only 3D or 4D images are expected in this method of partial volume correction.')
+    shape = im.shape[-3:]
 
     # > avoid registration if the provided parcellation is already in PET space
     # > it is assumed so if the parcellation is given as a file path and no affine is given
     noreg = False
-    if isinstance(mrin, str) and os.path.isfile(mrin):
+    if isinstance(mrin, (str, pathlib.PurePath)) and os.path.isfile(mrin):
+        mrin = os.fspath(mrin)
         prcl_dir = os.path.dirname(mrin)
         tmpdct = imio.getnii(mrin, output='all')
-        if faff is None and tmpdct['shape'] == imdct['shape']:
+        if faff is None and tmpdct['shape'] == shape:
             fprcu = mrin
             fprc = mrin
             noreg = True
@@ -762,12 +889,14 @@ def pvc_iyang(
     # > create folders
     imio.create_dir(oprcl)
     imio.create_dir(opvc)
-    if store_rois:
-        orois = os.path.join(opvc, 'ROIs')
-        imio.create_dir(orois)
 
-    # > output dictionary
-    outdct = {}
+    # > the session dictionary
+    sess = {'shape': shape, 'affine': B, 'pvcroi': pvcroi, 'opvc': opvc}
+
+    # > reference PET image for the registration and resampling (static)
+    fref = fpet
+    if not noreg and len(nib.load(fpet).shape) == 4:
+        fref = _pvc_static(fpet, oprcl, fcomment=fcomment)
 
     # =================================================================
     # > if affine transformation (faff) is not given then register T1 to PET
@@ -775,12 +904,12 @@ def pvc_iyang(
     if not noreg and faff is None:
         ft1w = imio.pick_t1w(mrin)
         if tool == 'spm':
-            regdct = regseg.coreg_spm(fpet, ft1w, matlab_eng_name=matlab_eng_name,
+            regdct = regseg.coreg_spm(fref, ft1w, matlab_eng_name=matlab_eng_name,
                                       fcomment=fcomment,
                                       outpath=os.path.join(outpath, 'PET', 'positioning'))
         elif tool == 'niftyreg':
             regdct = regseg.affine_niftyreg(
-                fpet,
+                fref,
                 ft1w,
                 outpath=os.path.join(outpath, 'PET', 'positioning'),
                 fcomment=fcomment,
@@ -799,6 +928,9 @@ def pvc_iyang(
                 rthrsh=0.05,
                 ffwhm=15.,                                           # millilitres
                 fthrsh=0.05)
+        elif tool == 'dipy':
+            regdct = regseg.affine_dipy(fref, ft1w, fcomment=fcomment,
+                                        outpath=os.path.join(outpath, 'PET', 'positioning'))
         faff = regdct['faff']
 
     # resample the T1/labels to upsampled PET
@@ -811,7 +943,7 @@ def pvc_iyang(
         if tool == 'niftyreg':
             if os.path.isfile(Cnt['RESPATH']):
                 cmd = [
-                    Cnt['RESPATH'], '-ref', fpet, '-flo', fprc, '-trans', faff, '-res', fprcu,
+                    Cnt['RESPATH'], '-ref', fref, '-flo', fprc, '-trans', faff, '-res', fprcu,
                     '-inter', '0']
                 if log.getEffectiveLevel() >= logging.INFO:
                     cmd.append('-voff')
@@ -820,7 +952,7 @@ def pvc_iyang(
                 raise IOError('e> path to resampling executable is incorrect!')
         elif tool == 'spm':
             regseg.resample_spm(
-                fpet,
+                fref,
                 fprc,
                 faff,
                 fimout=fprcu,
@@ -830,6 +962,9 @@ def pvc_iyang(
                 del_flo_uncmpr=True,
                 del_out_uncmpr=True,
             )
+        elif tool == 'dipy':
+            regseg.resample_batch(fref, [fprc], faff=faff, intrp=0, fimouts=[fprcu],
+                                  dtype_nifti=nib.load(fprc).get_data_dtype())
     # =================================================================
 
     # > get the parcellation labels in the upsampled PET space
@@ -841,44 +976,138 @@ def pvc_iyang(
 
     # --------------------------------------------------------------------------
     # > get the parcellation specific for PVC based on the current parcellations
-    imgroi = prcu.copy()
-    imgroi[:] = 0
-
-    # > number of segments, without the background
-    nSeg = len(pvcroi)
-
-    # > create the image of numbered parcellations
-    for k in range(nSeg):
-        for m in pvcroi[k]:
-            imgroi[prcu == m] = k + 1
+    # > (the image of numbered parcellations)
+    imgroi = roi_labels(prcu, pvcroi)
 
     # > save the PCV ROIs to a new NIfTI file
     if store_rois:
+        orois = os.path.join(opvc, 'ROIs')
+        imio.create_dir(orois)
         froi = os.path.join(orois, prcl_pth[1].split('.nii')[0] + '_PVC-ROIs-inPET.nii.gz')
         imio.array2nii(
             imgroi, prcdct['affine'], froi,
             trnsp=(prcdct['transpose'].index(0), prcdct['transpose'].index(1),
                    prcdct['transpose'].index(2)), flip=prcdct['flip'])
-        outdct['froi'] = froi
+        sess['froi'] = froi
     # --------------------------------------------------------------------------
 
+    sess.update(imroi=imgroi, fprc=fprcu, imprc=prcu)
+    if not noreg:
+        sess['faff'] = faff
+
+    return sess
+
+
+def pvc_iyang(
+    petin,
+    mrin,
+    Cnt,
+    pvcroi,
+    krnl,
+    itr=5,
+    tool='niftyreg',
+    faff=None,
+    outpath='',
+    fcomment='',
+    store_img=False,
+    store_rois=False,
+    matlab_eng_name='',
+    session=None,
+    max_workers=None,
+    tol=None,
+):
+    ''' Perform partial volume (PVC) correction of PET data (petin) using MRI data (mrin).
+        The PVC method uses iterative Yang method.
+        GPU based convolution is the key routine of the PVC.
+        Input:
+        -------
+        petin:  either a dictionary containing image data, file name and affine transform,
+                or a string of the path to the NIfTI file of the PET data.  Dynamic (4D)
+                PET images are corrected for all frames at once (see `iyang`).
+        mrin: a dictionary of MRI data, including the T1w image, which can be given
+                in DICOM (field 'T1DCM') or NIfTI (field 'T1nii').  The T1w image data
+                is needed for co-registration to PET if affine is not given in the text
+                file with its path in faff.
+        Cnt:    a dictionary of paths for third-party tools:
+                * dcm2niix: Cnt['DCM2NIIX']
+                * niftyreg, resample: Cnt['RESPATH']
+                * niftyreg, rigid-reg: Cnt['REGPATH']
+        pvcroi: list of regions (also a list) with number label to distinguish
+                the parcellations.  The numbers correspond to the image values
+                of the parcellated T1w image.  E.g.:
+                pvcroi = [
+                    [36], # ROI 1 (single parcellation region)
+                    [35], # ROI 2
+                    [39, 40, 72, 73, 74], # ROI 3 (multiple parcellation regions)
+                    ...
+                ]
+        kernel: the point spread function (PSF) specific for the camera and the object.
+                It is given as a 3x17 matrix, a 17-element kernel for each dimension (x,y,z).
+                It is used in the GPU-based convolution using separable kernels.
+        outpath:path to the output of the resulting PVC images
+        faff:   a text file of the affine transformations needed to get the MRI into PET space.
+                If not provided, it will be obtained from the performed rigid transformation.
+                For this the MR T1w image is required.  If faff and T1w image are not provided,
+                it will results in exception/error.
+        fcomment:a string used in naming the produced files, helpful for distinguishing them.
+        tool:   co-registration tool.  By default it is NiftyReg, but SPM is also
+                possible (needs Matlab engine and more validation), as well as DIPY
+                ('dipy'), for which the parcellations are resampled with the batch
+                resampler (`regseg.resample_batch`).
+        itr:    number of iterations used by the PVC.  5-10 should be enough (5 default);
+                the maximum number if `tol` is given.
+        tol:    tolerance of the relative change of the regional means for stopping
+                the PVC iterations early (see `iyang`).
+        session:the PVC session of the subject from `pvc_session` (the registered
+                parcellation and the ROI label image) for the PET images in the same
+                geometry; `mrin`, `pvcroi` and the registration options are then ignored.
+        max_workers: number of threads for the convolution of PET frames on the CPU.
+        Output dictionary includes the PVC image ('im'), the regional means for
+        each iteration ('m_a'; regions x iterations, or frames x regions x iterations),
+        the number of iterations used ('itr') and the relative change of the means
+        ('itr_change') and the time [s] ('itr_time') of each iteration.
+    '''
+    # get all the input image properties
+    im, fpet, B = _pvc_pet(petin)
+
+    if im.ndim not in (3, 4):
+        raise IndexError(
+            'Only 3D or 4D images are expected in this method of partial volume correction.')
+
+    if session is None:
+        # > the PET image as already loaded (not read again)
+        session = pvc_session({'im': im, 'fpet': fpet, 'affine': B}, mrin, Cnt, pvcroi,
+                              tool=tool, faff=faff, outpath=outpath, fcomment=fcomment,
+                              store_rois=store_rois, matlab_eng_name=matlab_eng_name)
+    elif im.shape[-3:] != session['shape'] or not np.allclose(B, session['affine']):
+        raise ValueError('the PET image geometry is different from that of the PVC session')
+
     # --------------------------------------------------------------------------
     # run iterative Yang PVC
-    imgpvc, m_a = iyang(im, krnl, imgroi, Cnt, itr=itr)
+    imgpvc, m_a, stats = iyang(im, krnl, session['imroi'], Cnt, itr=itr,
+                               max_workers=max_workers, tol=tol, info=True)
     # --------------------------------------------------------------------------
 
+    # > output dictionary
+    outdct = {}
+    if 'froi' in session:
+        outdct['froi'] = session['froi']
     outdct['im'] = imgpvc
-    outdct['imroi'] = imgroi
-    outdct['fprc'] = fprcu
-    outdct['imprc'] = prcu
-    if not noreg:
-        outdct['faff'] = faff
+    outdct['m_a'] = m_a
+    outdct['itr'] = stats['itr']
+    outdct['itr_change'] = stats['change']
+    outdct['itr_time'] = stats['time']
+    outdct['imroi'] = session['imroi']
+    outdct['fprc'] = session['fprc']
+    outdct['imprc'] = session['imprc']
+    if 'faff' in session:
+        outdct['faff'] = session['faff']
 
     if store_img:
         fpvc = os.path.join(
-            opvc,
+            session['opvc'],
             os.path.split(fpet)[1].split('.nii')[0] + '_PVC' + fcomment + '.nii.gz')
-        imio.array2nii(imgpvc[::-1, ::-1, :], B, fpvc, descrip='pvc=iY')
+        imio.array2nii(imgpvc[..., ::-1, ::-1, :], B, fpvc, descrip='pvc=iY')
         outdct['fpet'] = fpvc
 
     return outdct
@@ -1088,19 +1317,24 @@ def centre_mass_corr(img, Cnt=None, com=None, flip=None, outpath=None, fcomment=
     else:
         fnm = fsplt[1].split('.nii')[0] + fcomment + '.nii.gz'
 
-    # > save to NIfTI, first load
-    innii = nib.load(imdct['fim'])
+    fnew = os.path.join(opth, fnm)
 
-    # > get the data and flip if needed
-    imdata = innii.get_fdata()
-    if flip is not None:
+    if flip is None:
+        # > voxel data unchanged: rewrite only the header (affine and description)
+        imio.nii_update_hdr(imdct['fim'], affine=mA, descrip='NiftyPET: CoM-modified',
+                            fout=fnew)
+    else:
+        # > save to NIfTI, first load
+        innii = nib.load(imdct['fim'])
+
+        # > get the data and flip
+        imdata = innii.get_fdata()
         imdata = imdata[::flip[2], ::flip[1], ::flip[0], ...]
 
-    # > generate a new NIfTI image
-    fnew = os.path.join(opth, fnm)
-    innii.header['descrip'] = 'NiftyPET: CoM-modified'
-    newnii = nib.Nifti1Image(imdata, mA, innii.header)
-    nib.save(newnii, fnew)
+        # > generate a new NIfTI image
+        innii.header['descrip'] = 'NiftyPET: CoM-modified'
+        newnii = nib.Nifti1Image(imdata, mA, innii.header)
+        nib.save(newnii, fnew)
 
     return {'fim': fnew, 'com_rel': com_nii, 'com_abs': com}
 
@@ -1222,8 +1456,57 @@ def im_cut(im, i_cut, fout=None):
 # |____________________________________________________________________________|
 
 
+def _n4_sitk(fin, fn4, fmsk=None, shrink=1, threads=None):
+    '''
+    SimpleITK N4 bias field correction of a single image with the Otsu
+    object mask kept in memory (saved only to `fmsk` if given).  For
+    `shrink` > 1 the bias field is estimated on the image shrunk by the
+    factor and applied to the full resolution image.
+    '''
+    nthrd = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+    if threads:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+    try:
+        # > initialise the corrector
+        corrector = sitk.N4BiasFieldCorrectionImageFilter()
+        # numberFilltingLevels = 4
+
+        # read input file
+        im = sitk.ReadImage(str(fin))
+
+        # > create a object specific mask
+        msk = sitk.OtsuThreshold(im, 0, 1, 200)
+        if fmsk:
+            sitk.WriteImage(msk, fmsk)
+
+        # > cast to 32-bit float
+        im = sitk.Cast(im, sitk.sitkFloat32)
+
+        # ------------------------------------------
+        log.info('correcting bias field for {}'.format(fin))
+        if shrink > 1:
+            shrinks = [int(shrink)] * im.GetDimension()
+            corrector.Execute(sitk.Shrink(im, shrinks), sitk.Shrink(msk, shrinks))
+            n4out = im / sitk.Exp(corrector.GetLogBiasFieldAsImage(im))
+        else:
+            n4out = corrector.Execute(im, msk)
+        sitk.WriteImage(n4out, str(fn4))
+        # ------------------------------------------
+    finally:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(nthrd)
+
+
+def _n4_exe(cmd, threads=None):
+    '''run the N4 executable with the number of (ITK) threads'''
+    env = None
+    if threads:
+        env = dict(os.environ, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(threads))
+    run(cmd, env=env)
+
+
 def bias_field_correction(fmr, fimout='', outpath='', fcomment='_N4bias', executable='',
-                          exe_options=None, sitk_image_mask=True, verbose=False, Cnt=None):
+                          exe_options=None, sitk_image_mask=True, verbose=False, Cnt=None,
+                          max_workers=0, threads=None, shrink=1):
     ''' Correct for bias field in MR image(s) given in <fmr> as a string
         (single file) or as a list of strings (multiple files).
 
@@ -1241,8 +1524,14 @@ def bias_field_correction(fmr, fimout='', outpath='', fcomment='_N4bias', execut
                         used if it is available.
         - exe_options:  Options for the executable in the form of a list of
                         strings.
-        - sitk_image_mask:  Image masking will be used if SimpleITK is
-                            chosen.
+        - sitk_image_mask:  The object (Otsu) mask used with SimpleITK is
+                            saved and output; otherwise it is kept in memory.
+        - max_workers:  Number of parallel workers for multiple files (processes
+                        for SimpleITK, threads running the executable);
+                        `0` for serial processing.
+        - threads:      Number of (ITK) threads for each worker.
+        - shrink:       Shrink factor of the images for the N4 bias field
+                        estimation (faster for > 1).
     '''
     if exe_options is None:
         exe_options = []
@@ -1292,7 +1581,7 @@ def bias_field_correction(fmr, fimout='', outpath='', fcomment='_N4bias', execut
         n4opth = opth
         fcomment = ''
     elif outpath == '':
-        opth = os.path.dirname(fmr)
+        opth = os.path.dirname(fmr if isinstance(fmr, (str, pathlib.PurePath)) else fins[0])
         # > N4 bias correction specific folder
         n4opth = os.path.join(opth, 'N4bias')
     else:
@@ -1305,13 +1594,16 @@ def bias_field_correction(fmr, fimout='', outpath='', fcomment='_N4bias', execut
     outdct = {}
     # --------------------------------------------------------------------------
 
+    # > jobs: SimpleITK (function, arguments) or executable commands
+    sitk_jobs = []
+    exe_jobs = []
     for fin in fins:
         log.debug('input for bias correction:\n{}'.format(fin))
 
-        if fimout == '':
-            # split path
-            fspl = os.path.split(fin)
+        # split path
+        fspl = os.path.split(fin)
 
+        if fimout == '':
             # N4 bias correction file output paths
             fn4 = os.path.join(n4opth, fspl[1].split('.nii')[0] + fcomment + '.nii.gz')
         else:
@@ -1322,44 +1614,29 @@ def bias_field_correction(fmr, fimout='', outpath='', fcomment='_N4bias', execut
                 # =============================================
                 # SimpleITK Bias field correction for T1 and T2
                 # =============================================
-                # > initialise the corrector
-                corrector = sitk.N4BiasFieldCorrectionImageFilter()
-                # numberFilltingLevels = 4
-
-                # read input file
-                im = sitk.ReadImage(str(fin))
-
-                # > create a object specific mask
-                fmsk = os.path.join(n4opth, fspl[1].split('.nii')[0] + '_sitk_mask.nii.gz')
-                msk = sitk.OtsuThreshold(im, 0, 1, 200)
-                sitk.WriteImage(msk, fmsk)
-
-                # > cast to 32-bit float
-                im = sitk.Cast(im, sitk.sitkFloat32)
-
-                # ------------------------------------------
-                log.info('correcting bias field for {}'.format(fin))
-                n4out = corrector.Execute(im, msk)
-                sitk.WriteImage(n4out, fn4)
-                # ------------------------------------------
+                fmsk = None
                 if sitk_image_mask:
+                    fmsk = os.path.join(n4opth, fspl[1].split('.nii')[0] + '_sitk_mask.nii.gz')
                     outdct.setdefault('fmsk', [])
                     outdct['fmsk'].append(fmsk)
+                sitk_jobs.append((fin, fn4, fmsk, shrink, threads))
 
             elif os.path.basename(executable) == 'N4BiasFieldCorrection' and os.path.isfile(
                     executable):
                 cmd = [executable, '-i', fin, '-o', fn4]
                 if verbose and os.path.basename(executable) == 'N4BiasFieldCorrection':
                     cmd.extend(['-v', '1'])
+                if shrink > 1:
+                    cmd.extend(['-s', str(int(shrink))])
                 cmd.extend(exe_options)
-                run(cmd)
+                exe_jobs.append((cmd, threads))
                 if 'command' not in outdct:
                     outdct['command'] = []
                 outdct['command'].append(cmd)
             elif os.path.isfile(executable):
                 cmd = [executable]
                 cmd.extend(exe_options)
-                run(cmd)
+                exe_jobs.append((cmd, threads))
                 if 'command' not in outdct:
                     outdct['command'] = cmd
         else:
@@ -1369,6 +1646,22 @@ def bias_field_correction(fmr, fimout='', outpath='', fcomment='_N4bias', execut
         outdct.setdefault('fim', [])
         outdct['fim'].append(fn4)
 
+    # --------------------------------------------------------------------------
+    if max_workers == 0 or len(sitk_jobs) + len(exe_jobs) < 2:
+        for job in sitk_jobs:
+            _n4_sitk(*job)
+        for job in exe_jobs:
+            _n4_exe(*job)
+    else:
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        if sitk_jobs:
+            with ProcessPoolExecutor(max_workers=max_workers) as ex:
+                list(ex.map(_n4_sitk, *zip(*sitk_jobs)))
+        if exe_jobs:
+            with ThreadPoolExecutor(max_workers=max_workers) as ex:
+                list(ex.map(_n4_exe, *zip(*exe_jobs)))
+    # --------------------------------------------------------------------------
+
     if len(outdct['fim']) == 1:
         outdct['fim'] = outdct['fim'][0]
         if 'fmsk' in outdct:
@@ -0,0 +1,306 @@
+"""
+NIMPA: native rigid/affine image registration.
+Mutual information (MI) of a joint histogram with linear Parzen windowing
+for the floating image, analytic gradients and a Gaussian pyramid.
+"""
+import logging
+import os
+from os import fspath
+
+import nibabel as nib
+import numpy as np
+import scipy.ndimage as ndi
+from scipy.optimize import minimize
+
+from . import imio, prc
+from .num import conv_separable
+
+log = logging.getLogger(__name__)
+
+# > number of parameters for each transformation type
+NPRM = {'translation': 3, 'rigid': 6, 'affine': 12}
+
+
+def _mi_load(fim, shape=None):
+    '''
+    Load image (NIfTI file path, `create_mask` output dictionary or Numpy
+    array in the NIfTI orientation) as float32 in the NIfTI orientation.
+    '''
+    if isinstance(fim, dict) and 'fim' in fim:
+        fim = fim['fim']
+    if isinstance(fim, np.ndarray):
+        im, A = fim.astype(np.float32), None
+    else:
+        nii = nib.load(fspath(fim))
+        im, A = np.asanyarray(nii.dataobj, dtype=np.float32), nii.affine
+    if im.ndim != 3:
+        raise ValueError('only 3-D images are accepted for MI registration.')
+    if shape is not None and im.shape != tuple(shape):
+        raise ValueError('the mask and image shapes do not match.')
+    return im, A
+
+
+def _mi_smooth(im, vxsz, fwhm, dev_id=0):
+    '''Gaussian smoothing with the separable convolution (`fwhm` in mm)'''
+    if fwhm <= 0:
+        return im
+    # > the kernel is symmetric and hence the axis order is not relevant
+    psf = prc.psf_kernel(vx_size=vxsz, fwhm=fwhm, hradius=None)
+    return np.asarray(conv_separable(im, psf, dev_id=dev_id), dtype=np.float32)
+
+
+def _mi_pyramid(im, A, factors, sigmas, msk=None, dev_id=0):
+    '''
+    Gaussian pyramid (coarse to fine) of image `im` with affine `A`;
+    `sigmas` are given in voxels of the input image.
+    '''
+    vxsz = np.sqrt(np.sum(A[:3, :3]**2, axis=0))
+    lvls = []
+    for f, s in zip(factors, sigmas):
+        imf = _mi_smooth(im, vxsz, s * 2.3548 * np.min(vxsz), dev_id=dev_id)
+        sl = (slice(None, None, f),) * 3
+        lvls.append({
+            'im': np.ascontiguousarray(imf[sl]), 'affine': A @ np.diag([f, f, f, 1.]),
+            'msk': None if msk is None else np.ascontiguousarray(msk[sl] > 0)})
+    return lvls
+
+
+def _mi_transform(q, kind, c, rscl):
+    '''
+    Transformation matrix (4x4) for the parameters `q` about centre `c`
+    and the derivatives of the 3x3 part w.r.t. the (scaled) rotations.
+    '''
+    if kind == 'translation':
+        L, t, dL = np.eye(3), q[:3], []
+    elif kind == 'rigid':
+        a, b, g = q[:3] / rscl
+        ca, sa, cb, sb, cg, sg = np.cos(a), np.sin(a), np.cos(b), np.sin(b), np.cos(g), np.sin(g)
+        Rx = np.array([[1, 0, 0], [0, ca, -sa], [0, sa, ca]])
+        Ry = np.array([[cb, 0, sb], [0, 1, 0], [-sb, 0, cb]])
+        Rz = np.array([[cg, -sg, 0], [sg, cg, 0], [0, 0, 1]])
+        dRx = np.array([[0, 0, 0], [0, -sa, -ca], [0, ca, -sa]])
+        dRy = np.array([[-sb, 0, cb], [0, 0, 0], [-cb, 0, -sb]])
+        dRz = np.array([[-sg, -cg, 0], [cg, -sg, 0], [0, 0, 0]])
+        L = Rz @ Ry @ Rx
+        dL = [Rz @ Ry @ dRx / rscl, Rz @ dRy @ Rx / rscl, dRz @ Ry @ Rx / rscl]
+        t = q[3:]
+    elif kind == 'affine':
+        L, t, dL = np.eye(3) + q[:9].reshape(3, 3) / rscl, q[9:], []
+    else:
+        raise ValueError(f'unrecognised transformation type: {kind}')
+
+    T = np.eye(4)
+    T[:3, :3] = L
+    T[:3, 3] = c + t - L @ c
+    return T, dL
+
+
+def _mi_cost(q, kind, lvl, nbins, c, rscl):
+    '''negative MI and its analytic gradient w.r.t. the parameters `q`'''
+    T, dL = _mi_transform(q, kind, c, rscl)
+    yc = lvl['y'] - c
+
+    # > floating image voxel coordinates for the reference samples
+    M = lvl['Minv'] @ T
+    v = lvl['y'] @ M[:3, :3].T + M[:3, 3]
+    valid = np.all((v >= 0) & (v <= lvl['mlim']), axis=1)
+    vv = v[valid].T
+    if lvl['mmsk'] is not None:
+        valid[valid] = ndi.map_coordinates(lvl['mmsk'], vv, order=0, prefilter=False) > 0
+        vv = v[valid].T
+    N = vv.shape[1]
+    if N < nbins:
+        return 0., np.zeros_like(q)
+
+    m = ndi.map_coordinates(lvl['mim'], vv, order=1, prefilter=False)
+    gm = np.stack([ndi.map_coordinates(g, vv, order=1, prefilter=False) for g in lvl['mgrd']],
+                  axis=1)
+
+    # > joint histogram with linear Parzen window for the floating image
+    u = np.clip((m - lvl['mmin']) * lvl['mscl'], 0, nbins - 1 - 1e-6)
+    j0 = u.astype(np.int64)
+    f = u - j0
+    idx = lvl['sbin'][valid] * nbins + j0
+    P = (np.bincount(idx, 1 - f, nbins * nbins) +
+         np.bincount(idx + 1, f, nbins * nbins)).reshape(nbins, nbins) / N
+    Ps = P.sum(axis=1, keepdims=True)
+    Pm = P.sum(axis=0, keepdims=True)
+    nz = P > 0
+    LP = np.zeros_like(P)
+    LP[nz] = np.log(P[nz]) - np.log((Pm * np.ones_like(P))[nz])
+    mi = np.sum(P[nz] * (LP[nz] - np.log((Ps * np.ones_like(P))[nz])))
+
+    # > dMI/dx (world) for each sample
+    LP = LP.ravel()
+    w = ((LP[idx + 1] - LP[idx]) * lvl['mscl'] / N)[:, None] * (gm @ lvl['Minv'][:3, :3])
+    gt = w.sum(axis=0)
+    S = w.T @ yc[valid]
+
+    if kind == 'translation':
+        grd = gt
+    elif kind == 'rigid':
+        grd = np.concatenate(([np.sum(d * S) for d in dL], gt))
+    else:
+        grd = np.concatenate((S.ravel() / rscl, gt))
+
+    return -mi, -grd
+
+
+def _mi_levels(rlvls, flvls, nbins, sampling_proportion, seed):
+    '''reference samples and floating image interpolation data for each level'''
+    rng = np.random.default_rng(seed)
+    lvls = []
+    for rl, fl in zip(rlvls, flvls):
+        # > reference sample voxels (within the mask)
+        msk = np.ones(rl['im'].shape, dtype=bool) if rl['msk'] is None else rl['msk']
+        if sampling_proportion is not None:
+            msk = msk & (rng.random(msk.shape) < sampling_proportion)
+        ijk = np.argwhere(msk)
+        s = rl['im'][msk]
+        y = ijk @ rl['affine'][:3, :3].T + rl['affine'][:3, 3]
+
+        smin, smax = s.min(), s.max()
+        sbin = np.clip(((s - smin) * nbins / max(smax - smin, 1e-12)).astype(np.int64), 0,
+                       nbins - 1)
+
+        mim = fl['im']
+        mvals = mim if fl['msk'] is None else mim[fl['msk']]
+        mmin, mmax = mvals.min(), mvals.max()
+
+        lvls.append({
+            'y': y, 'sbin': sbin, 'mim': mim, 'mgrd': np.gradient(mim),
+            'mmsk': None if fl['msk'] is None else fl['msk'].astype(np.uint8),
+            'mlim': np.array(mim.shape) - 1, 'Minv': np.linalg.inv(fl['affine']), 'mmin': mmin,
+            'mscl': (nbins-1) / max(mmax - mmin, 1e-12)})
+    return lvls
+
+
+def affine_mi(
+    fref,
+    fflo,
+    nbins=32,
+    pipeline=('center_of_mass', 'rigid'),
+    level_iters=None,
+    sigmas=None,
+    factors=None,
+    sampling_proportion=None,
+    rmsk=None,
+    fmsk=None,
+    rfwhm=0.,
+    ffwhm=0.,
+    starting_affine=None,
+    outpath=None,
+    faffine=None,
+    pickname='ref',
+    fcomment='',
+    seed=0,
+    dev_id=0,
+    modify_nii=False,
+):
+    '''
+    Native rigid/affine registration of the floating image `fflo` to the
+    reference `fref` (NIfTI files) maximising mutual information.  The output
+    is as for `affine_dipy`, i.e., the affine maps the reference world
+    coordinates to those of the floating image.
+
+    Arguments:
+      nbins: number of histogram bins for each image.
+      pipeline: any of center_of_mass, translation, rigid, affine.
+      level_iters: max L-BFGS-B iterations for each level (coarse to fine).
+      sigmas: smoothing of each level in voxels (coarse to fine).
+      factors: down-sampling factor of each level (coarse to fine).
+      sampling_proportion: proportion of reference voxels used for the
+        metric (`None` for all voxels).
+      rmsk, fmsk: masks for the reference and floating images, as NIfTI
+        file paths or outputs of `create_mask` (or Numpy arrays in the NIfTI
+        orientation).
+      rfwhm, ffwhm: extra Gaussian smoothing of the images (mm).
+      starting_affine: initial affine (the centre of mass is then skipped).
+      seed: random seed for the voxel sampling.
+      dev_id: CUDA device for the pyramid convolutions (`False` for CPU).
+    '''
+    if level_iters is None:
+        level_iters = [200, 100, 50]
+    if sigmas is None:
+        sigmas = [3.0, 1.0, 0.0]
+    if factors is None:
+        factors = [4, 2, 1]
+    if not len(level_iters) == len(sigmas) == len(factors):
+        raise ValueError('level_iters, sigmas and factors must be of equal length')
+
+    # > output folder and the affine file
+    if outpath is None:
+        odir = os.path.join(os.path.dirname(fflo), 'affine-mi')
+    else:
+        odir = os.path.join(outpath, 'affine-mi')
+    imio.create_dir(odir)
+
+    if faffine is not None:
+        faff = faffine
+    elif pickname == 'ref':
+        faff = os.path.join(
+            odir, 'affine_mi_ref-' + os.path.basename(fref).split('.nii')[0] + fcomment + '.npy')
+    elif pickname == 'flo':
+        faff = os.path.join(
+            odir, 'affine_mi_flo-' + os.path.basename(fflo).split('.nii')[0] + fcomment + '.npy')
+
+    # > images and masks
+    rim, rA = _mi_load(fref)
+    fim, fA = _mi_load(fflo)
+    rm = None if rmsk is None else _mi_load(rmsk, shape=rim.shape)[0]
+    fm = None if fmsk is None else _mi_load(fmsk, shape=fim.shape)[0]
+
+    rim = _mi_smooth(rim, np.sqrt(np.sum(rA[:3, :3]**2, axis=0)), rfwhm, dev_id=dev_id)
+    fsm = _mi_smooth(fim, np.sqrt(np.sum(fA[:3, :3]**2, axis=0)), ffwhm, dev_id=dev_id)
+
+    lvls = _mi_levels(
+        _mi_pyramid(rim, rA, factors, sigmas, msk=rm, dev_id=dev_id),
+        _mi_pyramid(fsm, fA, factors, sigmas, msk=fm, dev_id=dev_id), nbins,
+        sampling_proportion, seed)
+
+    # > initial alignment of the centres of mass (world coordinates)
+    if starting_affine is not None:
+        A0 = np.array(starting_affine, dtype=np.float64)
+    else:
+        A0 = np.eye(4)
+        if 'center_of_mass' in pipeline:
+            for im, A, sgn in [(rim, rA, -1), (fsm, fA, 1)]:
+                com = np.array(ndi.center_of_mass(im if np.any(im) else np.ones_like(im)))
+                A0[:3, 3] += sgn * (A[:3, :3] @ com + A[:3, 3])
+
+    # > centre of rotations and scaling of the rotation/affine parameters
+    cfov = rA[:3, :3] @ ((np.array(rim.shape) - 1) / 2) + rA[:3, 3]
+    rscl = max(np.sqrt(np.mean(np.sum((lvls[-1]['y'] - cfov)**2, axis=1))), 1.)
+
+    mi = 0.
+    for kind in [p for p in pipeline if p in NPRM]:
+        # > reference samples transformed with the current affine
+        slvls = [dict(lvl, y=lvl['y'] @ A0[:3, :3].T + A0[:3, 3]) for lvl in lvls]
+        c = A0[:3, :3] @ cfov + A0[:3, 3]
+
+        q = np.zeros(NPRM[kind])
+        for f, lvl, itr in zip(factors, slvls, level_iters):
+            res = minimize(_mi_cost, q, args=(kind, lvl, nbins, c, rscl), jac=True,
+                           method='L-BFGS-B', options={'maxiter': itr, 'ftol': 1e-5, 'gtol': 1e-6})
+            q, mi = res.x, -res.fun
+            log.debug(f'{kind} at factor {f}: MI={mi:.4f} after {res.nit} iterations')
+
+        A0 = _mi_transform(q, kind, c, rscl)[0] @ A0
+
+    txaff = A0
+    np.save(faff, txaff)
+
+    # > floating image resampled to the reference
+    M = np.linalg.inv(fA) @ txaff @ rA
+    regim = ndi.affine_transform(fim, M[:3, :3], M[:3, 3], output_shape=rim.shape, order=1)
+
+    outdct = {'affine': txaff, 'faff': faff, 'regim': regim, 'mi': mi}
+
+    if modify_nii:
+        newaff = np.linalg.lstsq(txaff, fA, rcond=None)[0]
+        splt = os.path.basename(fflo).split('.nii')
+        fmodi = os.path.join(odir, splt[0] + '_affine-modified.nii' + splt[1])
+        imio.nii_update_hdr(fflo, affine=newaff, fout=fmodi)
+        outdct['fnii_mod'] = fmodi
+
+    return outdct
@@ -17,6 +17,10 @@ import numpy as np
 import scipy.ndimage as ndi
 from dipy.align import _public as align
 from dipy.align import affine_registration, center_of_mass, rigid, translation, affine
+from dipy.align.imaffine import MutualInformationMetric, transform_centers_of_mass
+from dipy.align.scalespace import IsotropicScaleSpace
+from dipy.align.transforms import AffineTransform3D, RigidTransform3D, TranslationTransform3D
+from dipy.core.optimize import Optimizer
 from miutil.fdio import hasext
 from spm12.regseg import resample_spm  # NOQA: F401 yapf: disable
 from spm12.regseg import coreg_spm
@@ -137,6 +141,124 @@ def aff_dist(A, pnt, offset=40):
     return max(dist)
 
 
+# ------------------------------------------------------------------------------
+# > DIPY transforms used in the cached (context) registration
+DIPY_TRANSFORMS = {
+    'translation': TranslationTransform3D, 'rigid': RigidTransform3D,
+    'affine': AffineTransform3D}
+
+
+def _dipy_nii(fnii, fwhm=0.):
+    '''load NIfTI image in the DIPY (nibabel) orientation as float64
+       and smooth it in memory if `fwhm`>0.
+    '''
+    nii = nib.load(fspath(fnii))
+    im = np.asanyarray(nii.dataobj, dtype=np.float32)
+    if im.ndim != 3:
+        raise ValueError('DIPY registration accepts only 3-D images.')
+    if fwhm > 0.:
+        # > the Gaussian kernel is symmetric, hence the axis order (x,y,z) is kept
+        im = prc.imsmooth(im, fwhm=fwhm, voxsize=nii.header.get_zooms()[:3])
+    return np.asarray(im, dtype=np.float64), nii.affine
+
+
+def _dipy_spacing(A):
+    '''voxel spacing from the grid-to-world affine `A`'''
+    return np.sqrt(np.sum(A[:3, :3]**2, axis=0))
+
+
+def dipy_regctx(fref, nbins=32, level_iters=None, sigmas=None, factors=None, rfwhm=8.,
+                sampling_proportion=None):
+    '''
+    Prepare the reference (static) image once for repeated DIPY registrations
+    of many floating images (e.g., dynamic frames) to the same reference.
+
+    The reference is smoothed in memory (no intermediate NIfTI file) and its
+    multi-resolution Gaussian pyramid is resampled to each level's grid and
+    kept in the returned context (a dictionary of Numpy arrays, so it can be
+    sent to worker processes).  The context is then passed to `affine_dipy`
+    with the keyword `regctx`.
+
+    Arguments:
+      fref: file path to the reference image.
+      nbins, level_iters, sigmas, factors: as in `affine_dipy`.
+      rfwhm: FWHM of the Gaussian smoothing of the reference.
+      sampling_proportion: proportion of voxels sampled for the MI metric
+        (`None` for dense sampling as in `affine_dipy`).
+    '''
+    if level_iters is None:
+        level_iters = [10000, 1000, 200]
+    if sigmas is None:
+        sigmas = [3.0, 1.0, 0.0]
+    if factors is None:
+        factors = [4, 2, 1]
+    if not len(level_iters) == len(sigmas) == len(factors):
+        raise ValueError('level_iters, sigmas and factors must be of equal length')
+
+    static, static_affine = _dipy_nii(fref, fwhm=rfwhm)
+
+    # > normalise to [0,1] as in DIPY's `AffineRegistration`
+    static = (static - static.min()) / (static.max() - static.min())
+
+    ss = IsotropicScaleSpace(static, factors, sigmas, image_grid2world=static_affine,
+                             input_spacing=_dipy_spacing(static_affine), mask0=False)
+
+    # > coarse to fine pyramid of the reference resampled to each level's grid
+    levels = []
+    for i, level in enumerate(range(len(factors) - 1, -1, -1)):
+        shape = tuple(ss.get_domain_shape(level))
+        g2w = ss.get_affine(level)
+        amap = align.AffineMap(None, domain_grid_shape=shape, domain_grid2world=g2w,
+                               codomain_grid_shape=static.shape,
+                               codomain_grid2world=static_affine)
+        levels.append({
+            'im': amap.transform(ss.get_image(level)), 'affine': g2w, 'iters': level_iters[i],
+            'level': level})
+
+    return {
+        'fref': fspath(fref), 'im': static, 'affine': static_affine, 'rfwhm': rfwhm,
+        'nbins': nbins, 'sampling_proportion': sampling_proportion, 'sigmas': list(sigmas),
+        'factors': list(factors), 'levels': levels}
+
+
+def _affine_dipy_ctx(regctx, moving, moving_affine, pipeline, starting_affine=None):
+    '''
+    Multi-resolution MI registration of the `moving` image to the reference
+    prepared in `regctx` (see `dipy_regctx`), following DIPY's
+    `affine_registration`.  Returns the affine mapping the reference to the
+    moving image world coordinates.
+    '''
+    moving = (moving - moving.min()) / (moving.max() - moving.min())
+    mss = IsotropicScaleSpace(moving, regctx['factors'], regctx['sigmas'],
+                              image_grid2world=moving_affine,
+                              input_spacing=_dipy_spacing(moving_affine), mask0=False)
+
+    # > the warm start (e.g., from the previous frame) skips the centre of mass
+    if starting_affine is None:
+        if 'center_of_mass' in pipeline:
+            starting_affine = transform_centers_of_mass(regctx['im'], regctx['affine'], moving,
+                                                        moving_affine).affine
+        else:
+            starting_affine = np.eye(4)
+
+    for p in pipeline:
+        if p == 'center_of_mass':
+            continue
+        transform = DIPY_TRANSFORMS[p]()
+        params0 = transform.get_identity_parameters()
+        for lvl in regctx['levels']:
+            metric = MutualInformationMetric(nbins=regctx['nbins'],
+                                             sampling_proportion=regctx['sampling_proportion'])
+            metric.setup(transform, lvl['im'], mss.get_image(lvl['level']),
+                         static_grid2world=lvl['affine'], moving_grid2world=moving_affine,
+                         starting_affine=starting_affine)
+            opt = Optimizer(metric.distance_and_gradient, params0, method='L-BFGS-B', jac=True,
+                            options={'gtol': 1e-4, 'maxfun': lvl['iters']})
+            starting_affine = transform.param_to_matrix(opt.xopt).dot(starting_affine)
+
+    return starting_affine
+
+
 # ------------------------------------------------------------------------------
 def affine_dipy(
     fref,
@@ -155,6 +277,8 @@ def affine_dipy(
     ffwhm=8.,
     verbose=True,
     modify_nii=False,
+    regctx=None,
+    starting_affine=None,
 ):
     """
     https://dipy.org/documentation/1.4.0./examples_built/affine_registration_3d/
@@ -170,9 +294,18 @@ def affine_dipy(
       pipeline: pick what goes to the pipeline: 
                 center_of_mass, translation, rigid, affine
                 (default is without affine, which is rigid-body only)
+      regctx: registration context of the reference from `dipy_regctx`;
+        when given, the reference is not reloaded/smoothed and its pyramid
+        is reused (`fref` may then be `None`, and `nbins`, `level_iters`,
+        `sigmas`, `factors` and `rfwhm` of the context are used instead).
+        The smoothed floating image is then kept in memory only.
+      starting_affine: initial affine (e.g., of the previous frame) for
+        warm start; the centre of mass alignment is then skipped.
     """
 
 
+    if regctx is not None:
+        fref = regctx['fref']
     if os.path.isfile(fref):
         fref = str(fref)
     if os.path.isfile(fflo):
@@ -180,7 +313,7 @@ def affine_dipy(
 
     # > go through possible pipeline components
     ppln = []
-    if 'center_of_mass' in pipeline:
+    if 'center_of_mass' in pipeline and starting_affine is None:
         ppln.append(center_of_mass)
     if 'translation' in pipeline:
         ppln.append(translation)
@@ -215,45 +348,52 @@ def affine_dipy(
                 odir,
                 'affine_dipy_flo-' + os.path.basename(fflo).split('.nii')[0] + fcomment + '.npy')
 
-    # > smoothing if needed:
-    if rfwhm > 0.:
-        fstatic = os.path.basename(fref).split('.nii')[0] + '_smth' + str(rfwhm).replace(
-            '.', '-') + 'mm.nii.gz'
-        fstatic = os.path.join(odir, fstatic)
-        _ = prc.imsmooth(fref, fwhm=rfwhm, fout=fstatic)
-    else:
-        fstatic = fref
+    if regctx is None:
+        # > smoothing if needed:
+        if rfwhm > 0.:
+            fstatic = os.path.basename(fref).split('.nii')[0] + '_smth' + str(rfwhm).replace(
+                '.', '-') + 'mm.nii.gz'
+            fstatic = os.path.join(odir, fstatic)
+            _ = prc.imsmooth(fref, fwhm=rfwhm, fout=fstatic)
+        else:
+            fstatic = fref
 
-    if ffwhm > 0.:
-        fmoving = os.path.basename(fflo).split('.nii')[0] + '_smth' + str(ffwhm).replace(
-            '.', '-') + 'mm.nii.gz'
-        fmoving = os.path.join(odir, fmoving)
-        _ = prc.imsmooth(fflo, fwhm=ffwhm, fout=fmoving)
+        if ffwhm > 0.:
+            fmoving = os.path.basename(fflo).split('.nii')[0] + '_smth' + str(ffwhm).replace(
+                '.', '-') + 'mm.nii.gz'
+            fmoving = os.path.join(odir, fmoving)
+            _ = prc.imsmooth(fflo, fwhm=ffwhm, fout=fmoving)
+        else:
+            fmoving = fflo
+
+        # --------------------------------------------------------------
+        txim, txaff = affine_registration(fmoving, fstatic, nbins=nbins, metric=metric,
+                                          pipeline=ppln, level_iters=level_iters,
+                                          sigmas=sigmas, factors=factors,
+                                          starting_affine=starting_affine)
+        # --------------------------------------------------------------
     else:
-        fmoving = fflo
+        # > reuse the reference pyramid, with the floating image kept in memory
+        moving, moving_affine = _dipy_nii(fflo, fwhm=ffwhm)
+        txaff = _affine_dipy_ctx(regctx, moving, moving_affine, pipeline,
+                                 starting_affine=starting_affine)
+        txim = align.AffineMap(txaff, domain_grid_shape=regctx['im'].shape,
+                               domain_grid2world=regctx['affine'],
+                               codomain_grid_shape=moving.shape,
+                               codomain_grid2world=moving_affine).transform(moving)
 
-    # ------------------------------------------------------------------
-    txim, txaff = affine_registration(fmoving, fstatic, nbins=nbins, metric=metric,
-                                      pipeline=ppln, level_iters=level_iters, sigmas=sigmas,
-                                      factors=factors)
-    # ------------------------------------------------------------------
     np.save(faff, txaff)
 
     outdct = {'affine': txaff, 'faff': faff, 'regim':txim}
 
     if modify_nii:
-        flo_d = imio.getnii(fflo ,output='all')
-        flo_a = flo_d['affine']
-        newaff = np.linalg.lstsq(txaff, flo_a)[0]
+        # > only the affine changes, hence the voxel data are not read
+        flo_a = imio.getnii(fflo, output='affine')
+        newaff = np.linalg.lstsq(txaff, flo_a, rcond=None)[0]
         splt = os.path.basename(fflo).split('.nii')
         fmodi = os.path.join(odir, splt[0]+'_affine-modified.nii'+splt[1])
 
-        imio.array2nii(
-            flo_d['im'],
-            newaff,
-            fmodi,
-            trnsp=flo_d['transpose'],
-            flip=flo_d['flip'])
+        imio.nii_update_hdr(fflo, affine=newaff, fout=fmodi)
 
         outdct['fnii_mod'] = fmodi
 
@@ -346,6 +486,171 @@ def resample_dipy(
     return {'fnii': fout, 'im': rsmpl}
 
 
+def resample_plan(fref, fflo, faff=None, chunk=16):
+    '''
+    Precompute the sampling grid and interpolation weights for resampling
+    images with the geometry of `fflo` to the reference `fref` through the
+    affine `faff` (as in `resample_dipy`: reference world to floating world).
+    The floating image is padded with one zero voxel on each side so that
+    samples outside the image need no checking; the nearest neighbour (NN)
+    indices and linear weights are computed lazily in `resample_apply`.
+
+    Arguments:
+      fref, fflo: NIfTI file paths (only the headers are read).
+      chunk: number of reference slices along the first array axis (NIfTI x)
+             processed at once.
+    '''
+    rnii = nib.load(fspath(fref))
+    fnii = nib.load(fspath(fflo))
+    if faff is None:
+        affine = np.eye(4)
+    elif isinstance(faff, (str, PurePath)) and hasext(faff, 'npy'):
+        affine = np.load(faff)
+    elif isinstance(faff, np.ndarray):
+        affine = faff
+    else:
+        raise ValueError('e> unrecognised affine matrix input')
+
+    # > reference voxel to floating voxel mapping
+    M = np.linalg.inv(fnii.affine) @ affine @ rnii.affine
+    return {
+        'shape': tuple(rnii.shape[:3]), 'affine': rnii.affine, 'flo_shape': tuple(fnii.shape[:3]),
+        'flo_affine': fnii.affine, 'M': M, 'chunk': chunk}
+
+
+def _rsmpl_coords(plan):
+    '''floating voxel coordinates (+1 for padding) for chunks along reference axis 0'''
+    shp = plan['shape']
+    M = plan['M']
+    jk = np.stack(np.meshgrid(np.arange(shp[1]), np.arange(shp[2]), indexing='ij'),
+                  axis=-1).reshape(-1, 2)
+    for i0 in range(0, shp[0], plan['chunk']):
+        i1 = min(i0 + plan['chunk'], shp[0])
+        ijk = np.concatenate((np.repeat(np.arange(i0, i1), len(jk))[:, None],
+                              np.tile(jk, (i1 - i0, 1))), axis=1)
+        yield ijk @ M[:3, :3].T + M[:3, 3] + 1
+
+
+def _rsmpl_weights(plan, intrp):
+    '''NN indices or linear base indices and weights into the padded floating image'''
+    key = 'nn' if intrp == 0 else 'lin'
+    if key in plan:
+        return plan[key]
+
+    pshp = np.array(plan['flo_shape']) + 2
+    strides = np.array([pshp[1] * pshp[2], pshp[2], 1])
+    idtype = np.int32 if np.prod(pshp) < 2**31 else np.int64
+    idx, frac = [], []
+    for v in _rsmpl_coords(plan):
+        if intrp == 0:
+            # > DIPY's rule: inside [0, n-1] and rounded with ties down
+            inside = np.all((v >= 1) & (v <= pshp - 2), axis=1)
+            i = np.floor(v)
+            i += (v - i) > .5
+        else:
+            # > partial corners within (-1, n) as in DIPY's trilinear interpolation
+            inside = np.all((v > 0) & (v < pshp - 1), axis=1)
+            i = np.floor(v)
+            frac.append(np.where(inside[:, None], v - i, 0).astype(np.float32))
+        idx.append(np.where(inside, (i * strides).sum(axis=1), 0).astype(idtype))
+
+    plan[key] = (np.concatenate(idx), np.concatenate(frac) if frac else None, strides)
+    return plan[key]
+
+
+def resample_apply(plan, im, intrp=1):
+    '''
+    Resample the floating image array `im` (NIfTI orientation) with the
+    precomputed `plan` (see `resample_plan`); intrp: 0-NN, 1-linear.
+    '''
+    if im.shape != plan['flo_shape']:
+        raise ValueError('the image does not match the geometry of the resampling plan')
+    if intrp not in (0, 1):
+        raise ValueError('e> unrecognised interpolation input')
+
+    idx, frac, strides = _rsmpl_weights(plan, intrp)
+    imp = np.pad(im, 1).ravel()
+
+    if intrp == 0:
+        return imp[idx].reshape(plan['shape'])
+
+    out = np.zeros(idx.shape, dtype=np.result_type(im.dtype, np.float32))
+    for c in np.ndindex(2, 2, 2):
+        w = np.prod([frac[:, d] if c[d] else 1 - frac[:, d] for d in range(3)], axis=0)
+        out += w * imp[idx + np.dot(c, strides)]
+    return out.reshape(plan['shape'])
+
+
+def resample_batch(
+    fref,
+    flos,
+    faff=None,
+    intrp=1,
+    outpath=None,
+    fimouts=None,
+    fcomment='',
+    dtype_nifti=np.float32,
+    plan=None,
+    max_workers=None,
+    save=True,
+):
+    '''
+    Resample many floating images (NIfTI files of the same geometry) to the
+    reference `fref` through the same affine `faff` (see `resample_dipy`).
+    The sampling grid and interpolation weights are computed once.
+
+    Arguments:
+      intrp: 0-NN or 1-linear, or a list with one value for each image
+        (e.g., NN for labels and linear for intensities).
+      fimouts: list of output file paths; otherwise named as in
+        `resample_dipy` (with the floating image names).
+      dtype_nifti: output data type, or a list with one for each image.
+      plan: the precomputed plan (from `resample_plan`) to reuse.
+      max_workers: number of threads for concurrent resampling and writing
+        (`0` for serial processing).
+      save: if False, the resampled images are only returned (no NIfTI output).
+    '''
+    flos = [flos] if isinstance(flos, (str, PurePath)) else list(flos)
+    nimg = len(flos)
+    intrp = intrp if isinstance(intrp, (list, tuple)) else [intrp] * nimg
+    dtype_nifti = dtype_nifti if isinstance(dtype_nifti, (list, tuple)) else [dtype_nifti] * nimg
+    if not len(intrp) == len(dtype_nifti) == nimg:
+        raise ValueError('the number of interpolation/data types does not match the images')
+
+    if plan is None:
+        plan = resample_plan(fref, flos[0], faff=faff)
+
+    if not save:
+        fimouts = None
+    elif fimouts is None:
+        opth = outpath if outpath is not None else os.path.dirname(flos[0])
+        imio.create_dir(opth)
+        fimouts = [
+            os.path.join(
+                opth, 'resampled-dipy_to_ref-' + os.path.basename(f).split('.nii')[0] + fcomment +
+                '.nii.gz') for f in flos]
+
+    # > compute the weights once, before any concurrent use
+    for i in set(intrp):
+        _rsmpl_weights(plan, i)
+
+    def rsmpl(i):
+        nii = nib.load(fspath(flos[i]))
+        im = resample_apply(plan, np.asanyarray(nii.dataobj), intrp=intrp[i])
+        if save:
+            nib.save(nib.Nifti1Image(im.astype(dtype_nifti[i]), plan['affine']), fimouts[i])
+        return im
+
+    if max_workers == 0:
+        ims = [rsmpl(i) for i in range(nimg)]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            ims = list(ex.map(rsmpl, range(nimg)))
+
+    return {'fnii': fimouts, 'im': ims, 'plan': plan}
+
+
 def affine_niftyreg(
     fref,
     fflo,
@@ -1230,6 +1535,157 @@ def motion_reg(
     return lstout
 
 
+# > registration context of the reference in the worker processes
+_REGCTX = {}
+
+
+def _regctx_init(regctx):
+    '''store the reference registration context in a worker process'''
+    _REGCTX.update(regctx)
+
+
+def _motion_reg_dipy_frame(fflo, ffwhm, pipeline):
+    '''register one floating image to the reference in the worker context'''
+    moving, moving_affine = _dipy_nii(fflo, fwhm=ffwhm)
+    return _affine_dipy_ctx(_REGCTX, moving, moving_affine, pipeline)
+
+
+def aff_rigid_params(A):
+    '''
+    Get the rotations (radians, about x, y and z) and translations of the
+    rigid part of the affine `A` (the rotation is found by polar decomposition).
+    '''
+    U, _, Vt = np.linalg.svd(A[:3, :3])
+    R = U @ Vt
+    rot = np.array([
+        np.arctan2(R[2, 1], R[2, 2]),
+        np.arcsin(np.clip(-R[2, 0], -1, 1)),
+        np.arctan2(R[1, 0], R[0, 0])])
+    return rot, A[:3, 3].copy()
+
+
+def motion_reg_dipy(
+    ref,
+    flo,
+    fcomment='',
+    outpath=None,
+    rot_thresh=1.,
+    trn_thresh=1.,
+    pipeline=('center_of_mass', 'translation', 'rigid'),
+    nbins=32,
+    level_iters=None,
+    sigmas=None,
+    factors=None,
+    rfwhm=8.,
+    ffwhm=8.,
+    max_workers=None,
+    resample=True,
+    intrp=1,
+    dtype_nifti=np.float32,
+):
+    '''
+    Motion detection/correction of dynamic frames `flo` (list of NIfTI files)
+    with respect to the reference `ref` using DIPY registrations run
+    concurrently in a process pool (no MATLAB/SPM needed).
+
+    The reference is preprocessed once (see `dipy_regctx`) and shared with
+    the workers.  The rotation (degrees) and translation (mm) thresholds are
+    used as in `motion_reg`.  When `resample` is True, all frames are resampled
+    to the reference in one pass at the end and saved as one 4D NIfTI.
+
+    Arguments:
+      max_workers: number of worker processes (`0` runs all in this process).
+      intrp: interpolation for resampling: 0-NN, 1-linear.
+    '''
+    if isinstance(flo, (str, PurePath)):
+        flolst = [flo]
+    elif isinstance(flo, list) and all(os.path.isfile(f) for f in flo):
+        flolst = flo
+    else:
+        raise OSError('could not decode the input of floating images.')
+
+    if intrp == 0:
+        interpolation = 'nearest'
+    elif intrp == 1:
+        interpolation = 'linear'
+    else:
+        raise ValueError('e> unrecognised interpolation input')
+
+    if outpath is None:
+        odir = os.path.join(os.path.dirname(flolst[0]), 'motion-dipy')
+    else:
+        odir = os.path.join(outpath, 'motion-dipy')
+    imio.create_dir(odir)
+
+    # > reference preprocessing done once for all frames
+    regctx = dipy_regctx(ref, nbins=nbins, level_iters=level_iters, sigmas=sigmas,
+                         factors=factors, rfwhm=rfwhm)
+
+    # ------------------------------------------------------------------
+    if max_workers == 0:
+        _regctx_init(regctx)
+        affines = [_motion_reg_dipy_frame(f, ffwhm, pipeline) for f in flolst]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_regctx_init,
+                                 initargs=(regctx,)) as ex:
+            affines = list(
+                ex.map(_motion_reg_dipy_frame, flolst, [ffwhm] * len(flolst),
+                       [pipeline] * len(flolst)))
+    # ------------------------------------------------------------------
+
+    lstout = []
+
+    motion_rot = False
+    motion_trn = False
+
+    for fflo, A in zip(flolst, affines):
+        faff = os.path.join(
+            odir,
+            'affine_dipy_flo-' + os.path.basename(fflo).split('.nii')[0] + fcomment + '.npy')
+        np.save(faff, A)
+
+        rot, trn = aff_rigid_params(A)
+        M = {'affine': A, 'faff': faff, 'rotations': rot, 'translations': trn}
+
+        if any((np.abs(rot) * 180 / np.pi) > rot_thresh):
+            log.warning(
+                dedent('''\
+                at least one rotation is above the threshold of {}, and is:
+                {}''').format(rot_thresh, rot * 180 / np.pi))
+            motion_rot = True
+        if any(np.abs(trn) > trn_thresh):
+            log.warning(
+                dedent('''\
+                at least one translation is above the threshold of {}, and is:
+                {}''').format(trn_thresh, trn))
+            motion_trn = True
+
+        lstout.append({'regout': M, 'trans_mo': motion_trn, 'rotat_mo': motion_rot})
+
+    outdct = {'frames': lstout, 'affines': np.array(affines)}
+
+    # > batched resampling of the original (unsmoothed) frames to the reference
+    if resample:
+        shape = regctx['im'].shape
+        imo = np.zeros(shape + (len(flolst),), dtype=dtype_nifti)
+        for i, (fflo, A) in enumerate(zip(flolst, affines)):
+            nii = nib.load(fspath(fflo))
+            amap = align.AffineMap(A, domain_grid_shape=shape, domain_grid2world=regctx['affine'],
+                                   codomain_grid_shape=nii.shape[:3],
+                                   codomain_grid2world=nii.affine)
+            imo[..., i] = amap.transform(np.asanyarray(nii.dataobj, dtype=np.float64),
+                                         interpolation=interpolation)
+
+        fout = os.path.join(
+            odir, 'motion-corrected-dipy_' + os.path.basename(flolst[0]).split('.nii')[0] +
+            fcomment + '.nii.gz')
+        nib.save(nib.Nifti1Image(imo, regctx['affine']), fout)
+        outdct.update(fnii=fout, im=imo)
+
+    return outdct
+
+
 # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
 # I M A G E   S I M I L A R I T Y
 # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
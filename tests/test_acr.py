@@ -0,0 +1,319 @@
+import csv
+import sys
+from pathlib import Path
+from subprocess import run
+
+import nibabel as nib
+import numpy as np
+import scipy.ndimage as ndi
+from pytest import approx, fail, fixture, mark, raises
+
+from niftypet.nimpa import acr
+from niftypet.nimpa.acr import batch, slab, store, templates
+from niftypet.nimpa.prc import imio, imsmooth
+
+
+@fixture(params=[np.float32, np.uint16])
+def parts(request):
+    rng = np.random.default_rng(0)
+    a = (9 * rng.random((20, 23))).astype(request.param)
+    b = (rng.random((20, 23)) > .5).astype(request.param)
+    return [(a, 5), (None, 3), (b, 7), (a, 1), (b, 4)]
+
+
+def full_array(parts, pad):
+    '''reference 3D array as assembled by the templates before using slabs'''
+    shp = next(s.shape for s, _ in parts if s is not None)
+    dtype = next(s.dtype for s, _ in parts if s is not None)
+    im = np.concatenate([
+        np.zeros((k,) + shp, dtype=dtype) if s is None else np.repeat(s[None], k, axis=0)
+        for s, k in parts])
+    return np.pad(im, pad)[::-1]
+
+
+def test_slab_zoom(parts):
+    pad = ((1, 0), (4, 5), (4, 5))
+    slb = slab.slab_flip(slab.slab_pad(slab.slab(parts), pad))
+    im = full_array(parts, pad)
+    assert slab.slab_shape(slb) == im.shape
+    assert (slab.slab_array(slb) == im).all()
+
+    imd = slab.slab_zoom(slb, 1 / 2)
+    assert imd.dtype == im.dtype
+    assert (imd == ndi.zoom(im, 1 / 2, order=1, mode='constant')).all()
+
+
+@mark.parametrize("trnsp,flip", [((2, 1, 0), (-1, 1, 1)), ((1, 2, 0), (1, 1, -1)),
+                                 ((0, 1, 2), (1, 1, 1))])
+@mark.parametrize("ext", ['.nii', '.nii.gz'])
+def test_slab2nii(tmp_path, parts, trnsp, flip, ext):
+    pad = ((0, 0), (4, 5), (4, 5))
+    slb = slab.slab_flip(slab.slab_pad(slab.slab(parts), pad))
+    A = np.diag([-.5, .5, .5, 1.])
+    fref, fslb = tmp_path / ('ref' + ext), tmp_path / ('slab' + ext)
+    imio.array2nii(full_array(parts, pad), A, fref, descrip='acr', trnsp=trnsp, flip=flip)
+    slab.slab2nii(slb, A, fslb, descrip='acr', trnsp=trnsp, flip=flip)
+
+    ref, nii = nib.load(fref), nib.load(fslb)
+    assert nii.header.binaryblock == ref.header.binaryblock
+    assert (np.asanyarray(nii.dataobj) == np.asanyarray(ref.dataobj)).all()
+
+
+def test_png_labels(tmp_path):
+    import imageio
+    rng = np.random.default_rng(0)
+    png = rng.choice(np.uint8([0, 17, 40, 254, 255]), (30, 40))
+    imageio.imwrite(tmp_path / 'dsgn.png', np.repeat(png[..., None], 3, axis=2))
+
+    # > reference: labels accumulated for each level
+    ref = np.zeros(png.shape, dtype=np.uint16)
+    for i, v in enumerate(np.unique(png)):
+        if v < 255:
+            ref += np.uint16((png == v) * (300+i))
+    lbl = templates._png_labels(tmp_path / 'dsgn.png', 300)
+    assert lbl.dtype == np.uint16
+    assert np.array_equal(lbl, ref)
+
+
+def acr_cntd(pth, vxsz=2.):
+    '''ACR constants with coarse templates and a dummy upscaled QNT image'''
+    Cntd = acr.get_params()
+    Cntd.update(vxsz=vxsz, scl=Cntd['vxysz'] / vxsz)
+    Cntd['fqntup'] = pth / 'qnt.nii.gz'
+    if not Cntd['fqntup'].is_file():
+        nib.save(nib.Nifti1Image(np.zeros((8, 8, 8), dtype=np.float32), np.eye(4)),
+                 Cntd['fqntup'])
+    return acr.get_paths(Cntd, pth / 'scan')
+
+
+def test_template_store(tmp_path, monkeypatch):
+    kinds = ('nac', 'sampl_reso')
+    Cntd = acr_cntd(tmp_path)
+    entries = acr.template_store(Cntd, store=tmp_path / 'store', kinds=kinds)
+    assert set(entries) == set(kinds)
+    for f in ('facrad', 'fst_res'):
+        assert Path(Cntd['out'][f]).parent in {Path(e) for e in entries.values()}
+        assert Path(Cntd['out'][f]).is_file()
+
+    # > another scan reuses the stored templates without generating them
+    monkeypatch.setattr(store, 'TMPL_KINDS', {
+        k: (lambda C: fail('templates regenerated'),) + v[1:]
+        for k, v in store.TMPL_KINDS.items()})
+    store._ENTRIES.clear()
+    Cntd2 = acr_cntd(tmp_path)
+    assert acr.template_store(Cntd2, store=tmp_path / 'store', kinds=kinds) == entries
+    assert Cntd2['out']['fst_res'] == Cntd['out']['fst_res']
+
+    # > different voxel size gives different templates
+    with raises(fail.Exception):
+        acr.template_store(acr_cntd(tmp_path, vxsz=2.5), store=tmp_path / 'store', kinds=kinds)
+    assert not list((tmp_path / 'store').glob('.*'))
+
+
+def test_sampling_masks(tmp_path):
+    Cntd = acr_cntd(tmp_path)
+    acr.template_store(Cntd, store=tmp_path / 'store', kinds=('sampl_reso',))
+    for t in [t for t in Cntd['out'] if t[:4] == 'fst_' and t != 'fst_res']:
+        del Cntd['out'][t]
+
+    # > PET grid of the rods template shifted by a known affine
+    nii = nib.load(Cntd['out']['fst_res'])
+    A = nii.affine @ np.diag([-1, 1, 1, 1])
+    A[0, 3] += nii.affine[0, 0] * (nii.shape[0] - 1)
+    nib.save(nib.Nifti1Image(np.zeros(nii.shape, dtype=np.float32), A), Cntd['fqntup'])
+    T = np.eye(4)
+    T[:3, 3] = [1.3, -2.1, 3.7]
+    np.save(Cntd['out']['faff_res'], T)
+    ref = acr.ioaux.regseg.resample_dipy(Cntd['fqntup'], Cntd['out']['fst_res'],
+                                         faff=Cntd['out']['faff_res'], intrp=0,
+                                         outpath=tmp_path)
+    ref = imio.getnii(ref['fnii'])
+
+    vois = acr.sampling_masks(Cntd, persist=False)
+    assert vois['fst_res'].dtype == np.uint16
+    assert np.array_equal(vois['fst_res'], ref)
+    fmsk = next((tmp_path / 'scan').rglob('*_dipy.nii.gz'), None)
+    assert fmsk is None
+
+    acr.sampling_masks(Cntd, persist='async')
+    vois = acr.sampling_masks(Cntd, use_stored=True)
+    assert np.array_equal(vois['fst_res'], ref)
+    assert not acr.ioaux._PENDING
+
+
+def test_batch_qc_headless(tmp_path):
+    # > no matplotlib for the headless batch QC
+    code = ("import sys\nfrom niftypet.nimpa.acr import batch\n"
+            "assert not [m for m in sys.modules if m.startswith('matplotlib')]")
+    run([sys.executable, '-c', code], check=True)
+
+    # > failed scans are reported in the table instead of stopping the batch
+    out = acr.batch_qc([tmp_path / 'missing.nii.gz', {'qnt': tmp_path / 'dcm', 'id': 'scan2'}],
+                       tmp_path / 'qc', store=tmp_path / 'store', max_workers=0)
+    assert [r['scan'] for r in out['rows']] == ['missing', 'scan2']
+    assert all('ValueError' in r['error'] for r in out['rows'])
+    with open(out['fcsv']) as f:
+        assert list(csv.DictReader(f))[1]['scan'] == 'scan2'
+
+
+def test_batch_qc(tmp_path, monkeypatch):
+    def params(cpath=None):
+        '''coarse templates, no upsampling and short registrations'''
+        Cntd = acr.get_params(cpath)
+        Cntd.update(vxsz=2., scl=Cntd['vxysz'] / 2., sclt=1, dipy_itrs=[100, 50, 20],
+                    dipy_rods_itrs=[100, 50, 20])
+        return Cntd
+
+    monkeypatch.setattr(batch, 'get_params', params)
+    Cntd = params()
+    Cntd['fqntup'] = tmp_path / 'qnt.nii.gz'
+    nib.save(nib.Nifti1Image(np.zeros((8, 8, 8), dtype=np.float32), np.eye(4)), Cntd['fqntup'])
+    acr.get_paths(Cntd, tmp_path / 'scan')
+    acr.template_store(Cntd, store=tmp_path / 'store')
+
+    # > synthetic phantom: the core activity with the rods pattern above the rods plate,
+    # > at SUV 1 in the background for the default dose and weight
+    core = nib.load(Cntd['out']['facrad'])
+    im = np.asanyarray(core.dataobj).astype(np.float32)
+    rods = acr.ioaux.regseg.resample_dipy(Cntd['out']['facrad'], Cntd['out']['fresdQmu'],
+                                          outpath=tmp_path)
+    rods = np.asanyarray(nib.load(rods['fnii']).dataobj)
+    rods = rods[..., int(np.median(np.nonzero(rods.any(axis=(0, 1)))[0]))]
+    prf = im.sum(axis=(0, 1)) > im.sum(axis=(0, 1)).max() / 2
+    z0 = np.nonzero(~prf[:-1] & prf[1:])[0][-1] + 1
+    z1 = np.nonzero(prf)[0][-1] + 1
+    bckg = np.median(im[..., z0][im[..., z0] > 0])
+    im[..., z0:z1] = rods[..., None] * bckg / rods.max()
+    im *= 220e6 / 70e3 / bckg
+    nib.save(nib.Nifti1Image(im, core.affine), tmp_path / 'phantom_tmpl.nii.gz')
+
+    # > PET on a 4 mm grid around the phantom
+    A = np.diag([4., 4., 4., 1.])
+    A[:3, 3] = core.affine[:3, :3] @ (np.array(im.shape) - 1) / 2 + core.affine[:3, 3] - 142
+    nib.save(nib.Nifti1Image(np.zeros((72, 72, 72), dtype=np.float32), A), tmp_path / 'grid.nii')
+    pet = acr.ioaux.regseg.resample_dipy(tmp_path / 'grid.nii', tmp_path / 'phantom_tmpl.nii.gz',
+                                         outpath=tmp_path)
+    pet = np.asanyarray(nib.load(pet['fnii']).dataobj).astype(np.float32)
+    nib.save(nib.Nifti1Image(pet, A), tmp_path / 'phantom.nii.gz')
+
+    out = acr.batch_qc([tmp_path / 'phantom.nii.gz', tmp_path / 'missing.nii.gz'],
+                       tmp_path / 'qc', store=tmp_path / 'store', fwhm_inserts=('hot2',),
+                       max_workers=0)
+    row, miss = out['rows']
+    assert row['scan'] == 'phantom' and row['error'] is None
+    assert miss['scan'] == 'missing' and 'ValueError' in miss['error']
+    assert row['bckg_avg'] == approx(1, rel=1e-3)
+    assert row['test_bckg_avg'].startswith('PASS')
+    assert row['h2_bckg'] > 1.5
+    assert row['rods_12.7_contrast'] > .9 > row['rods_4.8_contrast']
+    assert 0 < row['fwhm_hot2'] < 20
+
+    opth = tmp_path / 'qc' / 'phantom'
+    T = np.load(opth / 'ACR-core' / 'affine-acr-dipy.npy')
+    assert np.abs(T[:3, 3]).max() < 2 and np.allclose(T[:3, :3], np.eye(3), atol=1e-2)
+    assert (opth / 'ACR-rods' / 'affine-dipy-acr-reso.npy').is_file()
+    assert list((opth / 'sampling_masks').glob('*_dipy.nii.gz'))
+    with open(out['fcsv']) as f:
+        tbl = list(csv.DictReader(f))
+    assert [r['scan'] for r in tbl] == ['phantom', 'missing']
+    assert list(tbl[0]) == out['columns']
+    assert float(tbl[0]['bckg_avg']) == approx(row['bckg_avg'])
+
+
+def test_extract_rings():
+    rng = np.random.default_rng(2)
+    tmpl = rng.integers(0, 30, (12, 16, 16)).astype(np.int32)
+    tmpl[tmpl == 17] = 0
+    ims = rng.random((3,) + tmpl.shape).astype(np.float32)
+
+    ref = np.array([[im[tmpl == lbl].mean() if (tmpl == lbl).any() else np.nan for im in ims]
+                    for lbl in range(10, 20)])
+    out = acr.ioaux.extract_rings(ims, tmpl, l0=10, l1=20)
+    assert out.shape == (10, 3) and out.dtype == np.float32
+    assert np.allclose(out, ref, equal_nan=True, rtol=1e-6)
+    assert np.isnan(out[7]).all()
+    assert np.array_equal(acr.ioaux.extract_rings(ims[1], tmpl, l0=10, l1=20), out[:, 1],
+                          equal_nan=True)
+    assert len(acr.ioaux.extract_rings(list(ims), tmpl.astype(np.float32))) == 30
+
+
+def test_rods_contrast():
+    Cntd = acr.get_params()
+    # > concentric ring labels for each rod set with values increasing outwards
+    lbl = np.zeros((2, 32, 32 * len(Cntd['rods_off'])), dtype=np.int32)
+    im = np.zeros(lbl.shape, dtype=np.float32)
+    for j, (nrng, off) in enumerate(zip(Cntd['rods_nrngs'], Cntd['rods_off'])):
+        for i in range(nrng):
+            lbl[:, i, 32 * j:32 * j + 4] = off + i
+            im[:, i, 32 * j:32 * j + 4] = 1 + i / nrng
+    rods = acr.rods_contrast(Cntd, {'fst_res': lbl}, im)
+    nrng = Cntd['rods_nrngs']
+    assert np.allclose(rods['ratios'], 2 - 1/nrng)
+    assert np.allclose(rods['contrast'], (1 - 1/nrng) / (2 - 1/nrng))
+    assert np.allclose(rods['rawval'][0, :nrng[0]], 1 + np.arange(nrng[0]) / nrng[0])
+
+
+def test_zmask(tmp_path, monkeypatch):
+    Cntd = acr_cntd(tmp_path)
+    rng = np.random.default_rng(1)
+    im = rng.random((40, 32, 32)).astype(np.float32)
+    masks = {
+        k: np.zeros(im.shape, dtype=np.int32) for k in ('fst_insrt', 'fst_insrt3', 'fst_ibckg')}
+    masks['fst_insrt'][5:35, 4:10, 4:14] = rng.integers(10, 25, (30, 6, 10))
+    masks['fst_insrt'][5:35, 20:26, 6:12] = 100
+    masks['fst_insrt3'][5:35, 12:18, 16:20] = rng.integers(30, 40, (30, 6, 4))
+    masks['fst_ibckg'][5:35, 3:5, 8:28] = rng.integers(200, 206, (30, 2, 20))
+    assert acr.get_geom(Cntd)['shape'] == (8, 8, 8)
+
+    # > no image reloading for repeated sub-masks
+    monkeypatch.setattr(imio, 'getnii', lambda *a, **kw: fail('image reloaded'))
+    monkeypatch.setattr(nib, 'load', lambda *a, **kw: fail('image reloaded'))
+    zfull = acr.ioaux.zmask(masks, 'fst_insrt', Cntd, z_start_idx=12)
+    zcrop = acr.ioaux.zmask(masks, 'fst_insrt', Cntd, z_start_idx=12, crop=True)
+    assert zcrop['bbox'][1:] == (slice(3, 26), slice(4, 28))
+    assert all(np.shares_memory(zcrop[t], masks[t]) for t in masks)
+    assert not set(acr.ioaux.ZMSK_LABELS) & set(zcrop)
+
+    for k in acr.ioaux.ZMSK_LABELS:
+        assert zcrop[k].sum() == zfull[k].sum()
+        assert (im[zfull[k]] == acr.ioaux.zcrop(im, zcrop)[zcrop[k]]).all()
+    for t, l0, l1 in (('fst_insrt', 10, 25), ('fst_insrt3', 30, 40), ('fst_ibckg', 200, 206)):
+        assert (acr.ioaux.extract_rings(im, zfull[t], l0, l1) == acr.ioaux.extract_rings(
+            acr.ioaux.zcrop(im, zcrop), zcrop[t], l0, l1)).all()
+
+
+def test_standard_analysis(tmp_path):
+    rng = np.random.default_rng(0)
+    im = (1 + rng.random((60, 48, 48))).astype(np.float32)
+    fim = tmp_path / 'acr.nii.gz'
+    nib.save(nib.Nifti1Image(im.transpose(2, 1, 0), np.diag([-1., -1., 1., 1.])), fim)
+    im = imio.getnii(fim)
+    voxsize = imio.getnii(fim, output='all')['voxsize']
+
+    # > disc VOIs (the 3rd hot insert overlaps the background)
+    _, y, x = np.mgrid[:60, :48, :48]
+    vois = {'r_insrt': [20, 40]}
+    centres = [(10, 10), (10, 38), (24, 20), (38, 10), (24, 24), (38, 38), (24, 38), (38, 24)]
+    for v, (cy, cx) in zip(acr.analysis.ACR_VOIS, centres):
+        vois[v] = (y-cy)**2 + (x-cx)**2 < 16
+
+    fwhms, zoffs = [0, 3.], [-3, 0, 4]
+    lbl = acr.analysis_labels(vois, voxsize, width_mm=6, zoffset=zoffs)
+    assert lbl['lbl'].dtype == np.uint8 and len(lbl['lbl']) == 13
+    out = acr.standard_analysis(fim, vois, fwhm=fwhms, width_mm=6, zoffset=zoffs,
+                                simulated_dose=1e-3, patient_weight=1)
+    assert [(o['fwhm'], o['zoffset']) for o in out] == [(f, z) for f in fwhms for z in zoffs]
+
+    # > reference using the boolean masks
+    for o in out:
+        ims = imsmooth(im, fwhm=o['fwhm'], voxsize=voxsize)
+        msk = np.zeros(im.shape, dtype=bool)
+        msk[27 + o['zoffset']:33 + o['zoffset']] = True
+        assert o['h3max'] == np.max(ims[vois['s_i3'] & msk])
+        assert o['bone_min'] == np.min(ims[vois['s_b'] & msk])
+        assert np.isclose(o['bckg_avg'], np.mean(ims[vois['s_bckg'] & msk]), rtol=1e-6)
+        assert o['test_bckg_avg'].startswith('FAIL' if o['bckg_avg'] > 1.15 else 'PASS')
+    assert acr.standard_analysis(fim, vois, fwhm=3., width_mm=6, zoffset=4,
+                                 simulated_dose=1e-3, patient_weight=1) == {
+                                     k: v for k, v in out[-1].items()
+                                     if k not in ('fwhm', 'zoffset')}
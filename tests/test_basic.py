@@ -1,7 +1,26 @@
+import sys
 from os import path
+from subprocess import run
 
 from niftypet import nimpa
 
+# > heavy modules which `import niftypet.nimpa` should not load
+HEAVY = ('dipy', 'spm12', 'h5py', 'imageio', 'matplotlib', 'niftypet.ninst.cudasetup',
+         'niftypet.nimpa.acr', 'niftypet.nimpa.prc.regseg')
+
+
+def import_time(code):
+    '''time (in seconds) and the loaded modules of running `code` in a fresh interpreter'''
+    code = ("import sys, time\nt0 = time.perf_counter()\n" + code +
+            "\nprint(time.perf_counter() - t0)\nprint(' '.join(sys.modules))")
+    out = run([sys.executable, '-c', code], check=True, capture_output=True,
+              text=True).stdout.splitlines()
+    return float(out[-2]), set(out[-1].split())
+
+
+def loaded(mods, names):
+    return [n for n in names if n in mods]
+
 
 def test_dev_info(capsys):
     devs = nimpa.dev_info()
@@ -16,3 +35,27 @@ def test_dev_info(capsys):
 def test_resources():
     assert path.exists(nimpa.path_resources)
     assert nimpa.resources.DIRTOOLS
+
+
+def test_lazy_import():
+    t_pkg, mods = import_time("import niftypet.nimpa")
+    assert not loaded(mods, HEAVY + ('nibabel', 'pydicom', 'scipy'))
+    _, mods = import_time("from niftypet.nimpa import getnii")
+    assert not loaded(mods, HEAVY)
+
+    # > all the public names are still available
+    t_all, mods = import_time("from niftypet import nimpa\n"
+                              "[getattr(nimpa, k) for k in nimpa.__all__ if k not in "
+                              "('add', 'div', 'mul')]\nnimpa.acr.standard_analysis")
+    assert {'dipy', 'niftypet.nimpa.acr', 'niftypet.nimpa.prc.regseg'} <= mods
+    assert t_pkg < t_all
+    assert 'getnii' in dir(nimpa) and nimpa.img.rasterise is nimpa.rasterise
+
+
+if __name__ == "__main__":
+    from statistics import median
+
+    for code in ("import niftypet.nimpa", "from niftypet.nimpa import getnii",
+                 "from niftypet import nimpa\nnimpa.affine_dipy\nnimpa.acr"):
+        t = median(import_time(code)[0] for _ in range(5))
+        print(f"{t:.3f} s: {code!r}")
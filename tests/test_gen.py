@@ -0,0 +1,114 @@
+import math
+
+import nibabel as nib
+import numpy as np
+
+from niftypet.nimpa.img import gen
+
+CNT = {'SZ_IMY': 96, 'SZ_IMX': 96, 'SZ_IMZ': 20, 'SZ_VOXY': 2.}
+
+
+def test_rasterise_coverage():
+    vx = (2., 1.5, 1.5)
+    im = gen.rasterise((12, 80, 80), [{'r': 20., 'xo': 3.3, 'yo': -5.1}, {
+        'r': 12., 'r_in': 7., 'xo': -30., 'yo': 28., 'val': 2.}], voxsize=vx, supersample=16)
+    assert im.shape == (12, 80, 80) and im.strides[0] == 0
+    assert im.min() == 0 and im.max() == 2
+    assert math.isclose(im[0].sum() * vx[1] * vx[2],
+                        math.pi * 20**2 + 2 * math.pi * (12**2 - 7**2), rel_tol=1e-3)
+
+    # > labels within axial ranges
+    lbl = gen.rasterise((12, 80, 80), [{'r': 20., 'val': 3, 'z': (2, 5)},
+                                       {'r': 10., 'val': 7, 'z': (4, 8)}], voxsize=vx,
+                        labels=True)
+    assert lbl.dtype == np.uint16 and lbl.flags.writeable
+    assert set(np.unique(lbl[2])) == {0, 3} and set(np.unique(lbl[4])) == {0, 3, 7}
+    assert set(np.unique(lbl[6])) == {0, 7} and not lbl[8:].any()
+
+
+def test_get_cylinder():
+    # > voxel centres within the radius
+    yc = (48 - np.arange(96) - .5) * 2. + 11.
+    xc = (np.arange(96) - 48 + .5) * 2. - 7.
+    ref = yc[:, None]**2 + xc[None]**2 <= 25.**2
+    msk = gen.get_cylinder(CNT, rad=25., xo=7., yo=-11.)
+    assert msk.dtype == bool and msk.shape == (20, 96, 96)
+    assert (msk == ref).all() and msk.flags.writeable
+
+    im = gen.get_cylinder(CNT, rad=25., xo=7., yo=-11., mask=False, unival=3., gpu_dim=True,
+                          zview=True, supersample=8)
+    assert im.shape == (96, 96, 20) and not im.flags.writeable
+    assert math.isclose(im[..., 0].sum() * 4., 3. * math.pi * 25.**2, rel_tol=1e-3)
+
+    dsk = gen.create_disk((5, 64, 64), r=10, a=3, b=-2, gen_scale=4, threshold=.5)
+    assert dsk.shape == (5, 64, 64) and (dsk == dsk[0]).all()
+    assert abs(dsk[0].sum() - math.pi * 100) < 4
+
+
+def test_imdiff(tmp_path):
+    rng = np.random.default_rng(7)
+    ref = rng.random((3, 10, 12, 14)).astype(np.float32)
+    new = ref + rng.normal(0, .01, ref.shape).astype(np.float32)
+
+    # > reference metrics of each frame
+    msk = ref > .001 * ref.max(axis=(1, 2, 3), keepdims=True)
+    d = np.abs(ref - new)
+    mae = [d[i][msk[i]].mean() for i in range(3)]
+    mape = [100 * (d[i] / ref[i])[msk[i]].mean() for i in range(3)]
+    mad = [d[i][msk[i]].max() for i in range(3)]
+
+    # > NIfTI files (read by z-slabs in the `getnii` orientation) and arrays
+    A = np.array([[0, 0, 2, 0], [-2, 0, 0, 0], [0, 3, 0, 0], [0, 0, 0, 1.]])
+    fref, fnew = tmp_path / 'ref.nii.gz', tmp_path / 'new.nii'
+    nib.save(nib.Nifti1Image(ref.transpose(3, 2, 1, 0), A), fref)
+    nib.save(nib.Nifti1Image(new.transpose(3, 2, 1, 0), A), fnew)
+    for out in (gen.imdiff(ref, {'im': new}, chunk=3, max_workers=2),
+                gen.imdiff(fref, fnew), gen.imdiff(fref, fnew, chunk=4, max_workers=2)):
+        assert np.allclose(out['mae'], mae) and np.allclose(out['mape'], mape)
+        assert np.allclose(out['mad'], mad)
+
+    out = gen.imdiff(ref[1], new[1], chunk=3)
+    assert np.isscalar(out['mae']) and math.isclose(out['mad'], mad[1], rel_tol=1e-6)
+
+    # > slabs below 0.1% of the frame maximum in compressed files: the same as in memory
+    ref[:, :4] *= 1e-3
+    new[:, :4] = ref[:, :4] * 1.01
+    fnew = tmp_path / 'new.nii.gz'
+    nib.save(nib.Nifti1Image(ref.transpose(3, 2, 1, 0), A), fref)
+    nib.save(nib.Nifti1Image(new.transpose(3, 2, 1, 0), A), fnew)
+    out = gen.imdiff(fref, fnew, chunk=2, max_workers=2)
+    for k, v in gen.imdiff(ref, new).items():
+        assert np.allclose(out[k], v, rtol=1e-12)
+
+
+def test_profile_points():
+    yy, xx = np.mgrid[:40, :50]
+    im = (2. * xx + 3. * yy).astype(np.float32)
+
+    # > nearest neighbour profile of a single line
+    prf = gen.profile_points(im, (4, 6), (24, 16), steps=11)
+    assert prf.shape == (11,)
+    assert np.array_equal(prf, 2 * np.arange(4, 25, 2) + 3 * np.arange(6, 17))
+
+    # > many lines at once with linear interpolation (exact for the linear image)
+    p0 = np.array([[1.3, 2.2], [10., 30.5], [40.2, 5.]])
+    p1 = np.array([[20.7, 9.1], [45., 31.], [3.3, 35.8]])
+    prf = gen.profile_points(im, p0, p1, steps=25, order=1, width=3)
+    t = np.linspace(0, 1, 25)[None, :, None]
+    pts = p0[:, None] + t * (p1-p0)[:, None]
+    assert prf.shape == (3, 25)
+    assert np.allclose(prf, 2 * pts[..., 0] + 3 * pts[..., 1], atol=1e-4)
+
+    # > lines on the image edge (widths outside the image clipped to the edge)
+    for order in (0, 1):
+        prf = gen.profile_points(xx.astype(np.float32), (0, 0), (0, 9), steps=10, order=order,
+                                 width=3)
+        assert np.allclose(prf, 1 / 3)
+        prf = gen.profile_points(im, (49, 0), (49, 39), steps=40, order=order, width=3)
+        assert np.allclose(prf, 2 * (49 - 1/3) + 3 * np.arange(40), atol=1e-4)
+
+    # > 3D with the points given as (x, y, z)
+    im3 = np.broadcast_to(np.arange(8.)[:, None, None], (8, 20, 20))
+    prf = gen.profile_points(im3, [[5, 5, 0], [2, 9, 7]], [[5, 5, 7], [12, 9, 7]], steps=8,
+                             order=3, width=3)
+    assert np.allclose(prf, [np.arange(8.), np.full(8, 7.)])
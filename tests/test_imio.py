@@ -0,0 +1,27 @@
+import nibabel as nib
+import numpy as np
+from pytest import mark
+
+from niftypet.nimpa.prc import imio
+
+
+@mark.parametrize("ext_in", ['.nii', '.nii.gz'])
+@mark.parametrize("ext_out", [None, '.nii', '.nii.gz'])
+def test_nii_update_hdr(tmp_path, ext_in, ext_out):
+    im = np.random.random((8, 9, 10)).astype('float32')
+    A = np.diag([-2., 2., 2., 1.])
+    fnii = tmp_path / ('img' + ext_in)
+    nib.save(nib.Nifti1Image(im, A), fnii)
+
+    B = A.copy()
+    B[:3, 3] = [10., -5., 3.]
+    fout = None if ext_out is None else tmp_path / ('out' + ext_out)
+    fres = imio.nii_update_hdr(fnii, affine=B, descrip='modified', fout=fout)
+    assert fres == (fnii if fout is None else fout)
+
+    nii = nib.load(fres)
+    assert np.allclose(nii.affine, B)
+    assert np.allclose(nii.header.get_qform(), B)
+    assert nii.header['descrip'].item() == b'modified'
+    assert nii.get_data_dtype() == np.float32
+    assert (np.asanyarray(nii.dataobj) == im).all()
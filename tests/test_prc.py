@@ -0,0 +1,240 @@
+import logging
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from niftypet.nimpa.prc import imio, imsmooth, prc, regseg
+
+VOXSIZE = (2., 2.5, 2.5)
+
+
+def dynamic(nfrm, shape=(24, 32, 32)):
+    '''random dynamic series (frames along the first axis)'''
+    return np.random.default_rng(0).random((nfrm,) + shape).astype(np.float32)
+
+
+def test_imsmooth_4d(tmp_path):
+    im = dynamic(5)
+    ref = np.stack([imsmooth(f, fwhm=5., voxsize=VOXSIZE, dev_id=False) for f in im])
+
+    out = np.zeros_like(im)
+    res = imsmooth(im, fwhm=5., voxsize=VOXSIZE, dev_id=False, output_array=out, max_workers=2)
+    assert res is out
+    assert np.array_equal(res, ref)
+
+    # > 4D NIfTI in and out
+    fim = tmp_path / 'dyn.nii.gz'
+    A = np.diag([-VOXSIZE[2], VOXSIZE[1], VOXSIZE[0], 1.])
+    nib.save(nib.Nifti1Image(im.transpose(3, 2, 1, 0)[::-1], A), fim)
+    imd = imio.getnii(fim, output='all')
+    assert imd['im'].shape == im.shape
+    ref = np.stack([
+        imsmooth(f, fwhm=5., voxsize=imd['voxsize'], dev_id=False) for f in imd['im']])
+    res = imsmooth(fim, fwhm=5., output='all', dev_id=False)
+    assert np.array_equal(res['im'], ref)
+    assert nib.load(res['fim']).shape == (32, 32, 24, 5)
+    assert np.array_equal(imio.getnii(res['fim']), ref)
+
+
+def test_psf_kernel():
+    krnl = prc.psf_kernel(vx_size=VOXSIZE, fwhm=5.)
+    assert krnl.shape == (3, 17) and krnl.dtype == np.float32 and not krnl.flags.writeable
+    assert prc.psf_kernel(vx_size=list(VOXSIZE), fwhm=(5, 5, 5)) is krnl
+    assert np.allclose(krnl.sum(axis=1), 1)
+
+    # > public kernels are writeable copies of the cached ones
+    psf = prc.psf_gaussian(vx_size=VOXSIZE, fwhm=5.)
+    assert psf.flags.writeable and np.array_equal(psf, krnl)
+
+    # > radius extended to fit the PSF
+    assert prc.psf_fwhm(40., VOXSIZE).shape == (3, 41)
+
+    # > the measured PSF is read only once
+    hits = prc._psf_cached.cache_info().hits
+    assert np.array_equal(prc.psf_measured(scale=2), prc.psf_measured(scale=2))
+    assert prc._psf_cached.cache_info().hits > hits
+    assert prc._psf_cached.cache_info().maxsize == prc.PSF_CACHE_SIZE
+
+    # > no fallback to the Gaussian PSF or to a truncated scale
+    with pytest.raises(NameError):
+        prc.psf_measured(scanner=None)
+    with pytest.raises(NameError):
+        prc.psf_kernel(scanner='signa')
+    with pytest.raises(ValueError):
+        prc.psf_measured(scale=1.5)
+    assert np.array_equal(prc.psf_measured(scale=2.), prc.psf_measured(scale=2))
+
+
+def test_bias_field_correction(tmp_path):
+    pytest.importorskip("SimpleITK")
+    z, y, x = np.mgrid[:32, :40, :40]
+    obj = ((z-16)**2 / 200 + (y-20)**2 / 300 + (x-20)**2 / 300 < 1) * 100.
+    fmr = []
+    for i in range(2):
+        fmr.append(tmp_path / f'mr{i}.nii.gz')
+        im = obj * np.exp(.01 * (x-20) + .005 * i * (y-20)) + np.random.default_rng(i).random(
+            obj.shape)
+        nib.save(nib.Nifti1Image(im.astype(np.float32), np.eye(4)), fmr[-1])
+
+    out = prc.bias_field_correction(fmr, outpath=tmp_path, executable='sitk', max_workers=2,
+                                    threads=1, shrink=2, sitk_image_mask=False)
+    assert set(out) == {'fim'} and len(out['fim']) == 2
+    assert sorted(p.name for p in (tmp_path / 'N4bias').iterdir()) == [
+        'mr0_N4bias.nii.gz', 'mr1_N4bias.nii.gz']
+    for f in out['fim']:
+        im = nib.load(f).get_fdata()[obj > 0]
+        assert np.std(im) / np.mean(im) < .02
+
+
+def pvc_data(fdir, shape=(24, 32, 32)):
+    '''PET image and parcellation (in the PET space) NIfTI files'''
+    prcl = np.zeros(shape, dtype=np.float32)
+    prcl[2:-2, 4:-4, 4:-4] = 10
+    prcl[4:12, 8:16, 8:24] = 20
+    prcl[14:20, 8:16, 8:24] = 30
+    prcl[6:18, 18:28, 8:16] = 40
+    prcl[9:13, 20:24, 18:22] = 50
+    pet = imsmooth(prcl, fwhm=6., voxsize=VOXSIZE, dev_id=False)
+    A = np.diag([-VOXSIZE[2], VOXSIZE[1], VOXSIZE[0], 1.])
+    for f, im in (('pet.nii.gz', pet), ('prcl.nii.gz', prcl)):
+        nib.save(nib.Nifti1Image(im.transpose(2, 1, 0), A), fdir / f)
+    return fdir / 'pet.nii.gz', fdir / 'prcl.nii.gz'
+
+
+def test_roi_labels():
+    prcl = np.array([[0, 10, 20.5], [30, 40, 20], [-10, 50, 100]], dtype=np.float32)
+    pvcroi = [[10], [20, 30], [40, 10]]
+    ref = np.zeros_like(prcl)
+    for k, r in enumerate(pvcroi):
+        for m in r:
+            ref[prcl == m] = k + 1
+    assert np.array_equal(prc.roi_labels(prcl, pvcroi), ref)
+    assert prc.roi_labels(prcl.astype(np.uint8), pvcroi).dtype == np.uint8
+
+
+@pytest.fixture(scope='module')
+def pvc(tmp_path_factory):
+    '''PET and parcellation files, the PSF kernel and the PVC session shared by the tests'''
+    fdir = tmp_path_factory.mktemp('pvc')
+    fpet, fprcl = pvc_data(fdir)
+    Cnt = {'DEVID': False}
+    pvcroi = [[10], [20], [30, 40], [50]]
+    return {
+        'fpet': fpet, 'fprcl': fprcl, 'Cnt': Cnt, 'pvcroi': pvcroi,
+        'krnl': prc.psf_kernel(vx_size=VOXSIZE, fwhm=6.),
+        'sess': prc.pvc_session(fpet, fprcl, Cnt, pvcroi, outpath=fdir / 'ses')}
+
+
+def test_pvc_session(tmp_path, monkeypatch, pvc):
+    fpet, Cnt, krnl, sess = pvc['fpet'], pvc['Cnt'], pvc['krnl'], pvc['sess']
+
+    # > the PET image is read once
+    getnii, reads = imio.getnii, []
+    monkeypatch.setattr(imio, 'getnii', lambda f, *a, **kw: reads.append(f) or getnii(f, *a, **kw))
+    ref = prc.pvc_iyang(str(fpet), str(pvc['fprcl']), Cnt, pvc['pvcroi'], krnl, outpath=tmp_path)
+    assert reads.count(str(fpet)) == 1
+    monkeypatch.undo()
+    assert np.array_equal(sess['imroi'], ref['imroi'])
+
+    for _ in range(2):
+        out = prc.pvc_iyang(fpet, None, Cnt, None, krnl, session=sess)
+        assert np.array_equal(out['im'], ref['im'])
+        assert out['imroi'] is sess['imroi']
+
+    # > the mean of the small hot ROI recovered by the PVC
+    pet = imio.getnii(fpet)
+    msk = sess['imroi'] == 4
+    assert abs(out['im'][msk].mean() - 50) < .5 * abs(pet[msk].mean() - 50)
+
+    with pytest.raises(ValueError):
+        prc.pvc_iyang({'im': pet[1:], 'fpet': fpet, 'affine': np.eye(4)}, None, Cnt, None,
+                      krnl, session=sess)
+
+
+def test_iyang_4d(pvc):
+    Cnt, krnl, sess = pvc['Cnt'], pvc['krnl'], pvc['sess']
+
+    # > frames of different activity (and noise)
+    pet = imio.getnii(pvc['fpet'])
+    rng = np.random.default_rng(5)
+    dyn = np.stack([f * pet + rng.normal(0, .1, pet.shape) for f in (.5, 1., 2.)])
+    dyn = dyn.astype(np.float32)
+
+    out = prc.pvc_iyang({'im': dyn, 'fpet': pvc['fpet'], 'affine': sess['affine']}, None, Cnt,
+                        None, krnl, itr=4, session=sess, max_workers=2)
+    assert out['im'].shape == dyn.shape and out['m_a'].shape == (3, 5, 4)
+    for i, f in enumerate(dyn):
+        im, m_a = prc.iyang(f, krnl, sess['imroi'], Cnt, itr=4)
+        assert np.allclose(out['im'][i], im, rtol=1e-5, atol=1e-6)
+        assert np.allclose(out['m_a'][i], m_a, rtol=1e-5)
+
+
+def test_pvc_session_4d(tmp_path, pvc):
+    ref = pvc['sess']
+
+    # > dynamic PET file registered through its frame-averaged image
+    nii = nib.load(pvc['fpet'])
+    pet = nii.get_fdata(dtype=np.float32)
+    fdyn = tmp_path / 'dyn.nii.gz'
+    nib.save(nib.Nifti1Image(np.stack([f * pet for f in (.5, 1., 2.5)], axis=-1), nii.affine),
+             fdyn)
+    mrin = {'T1lbl': str(pvc['fprcl']), 'T1nii': str(pvc['fprcl'])}
+    sess = prc.pvc_session(fdyn, mrin, pvc['Cnt'], pvc['pvcroi'], tool='dipy', outpath=tmp_path)
+    fstat = tmp_path / 'PVC-preprocessed' / 'dyn_static.nii.gz'
+    assert np.allclose(nib.load(fstat).get_fdata(), 4 / 3 * pet)
+    assert sess['shape'] == ref['shape'] and np.allclose(sess['affine'], ref['affine'])
+    assert regseg.aff_dist(np.load(sess['faff']), [0, 0, 0]) < 1
+    assert np.mean(sess['imroi'] == ref['imroi']) > .95
+
+
+def test_iyang_tol(pvc):
+    fpet, Cnt, krnl, sess = pvc['fpet'], pvc['Cnt'], pvc['krnl'], pvc['sess']
+    pet = imio.getnii(fpet)
+
+    im, m_a, info = prc.iyang(pet, krnl, sess['imroi'], Cnt, itr=10, info=True)
+    assert info['itr'] == 10 and m_a.shape == (5, 10) and len(info['time']) == 10
+    assert np.all(np.diff(info['change'][1:]) < 0)
+
+    # > early stopping at the first iteration below the tolerance
+    tol = info['change'][3] * 1.01
+    out = prc.pvc_iyang(fpet, None, Cnt, None, krnl, itr=10, session=sess, tol=tol)
+    assert out['itr'] == 4 and out['m_a'].shape == (5, 4)
+    assert np.array_equal(out['m_a'], m_a[:, :4]) and np.all(out['itr_change'][:3] >= tol)
+
+    # > the input is not modified
+    assert np.array_equal(pet, imio.getnii(fpet))
+
+
+if __name__ == "__main__":
+    from textwrap import dedent
+    from time import time
+
+    from argopt import argopt
+    logging.basicConfig(level=logging.WARNING)
+
+    args = argopt(
+        dedent("""\
+        Performance testing of smoothing a dynamic series frame by frame
+        and as one 4D image with `imsmooth`.
+        Usage:
+            test_prc [options]
+
+        Options:
+            -n FRAMES, --frames FRAMES  : number of frames [default: 60:int]
+            -f FWHM, --fwhm FWHM  : smoothing FWHM [default: 4:float]
+            -d DEV, --dev-id DEV  : GPU device (-1 for CPU) [default: -1:int]
+        """)).parse_args()
+    dev_id = False if args.dev_id < 0 else args.dev_id
+
+    im = dynamic(args.frames, shape=(127, 172, 172))
+    t0 = time()
+    ref = np.stack([imsmooth(f, fwhm=args.fwhm, voxsize=VOXSIZE, dev_id=dev_id) for f in im])
+    tfrm = time() - t0
+
+    t0 = time()
+    out = imsmooth(im, fwhm=args.fwhm, voxsize=VOXSIZE, dev_id=dev_id)
+    t4d = time() - t0
+
+    print(f"{args.frames} frames: {tfrm:.2f} s (frame by frame), {t4d:.2f} s (4D);"
+          f" max difference {np.abs(out - ref).max()}")
@@ -0,0 +1,180 @@
+import logging
+from os import fspath
+
+import nibabel as nib
+import numpy as np
+import scipy.ndimage as ndi
+from pytest import fixture, mark
+
+from niftypet.nimpa.prc import regmi, regseg
+
+# > fast DIPY settings for the small synthetic volumes
+DIPY_KW = {'level_iters': [100, 50, 20], 'sigmas': [2.0, 1.0, 0.0], 'factors': [4, 2, 1]}
+VXSZ = 2.
+
+
+def phantom(shape=(40, 48, 48), vals=(1, 3, 2)):
+    '''smooth asymmetric blob phantom'''
+    im = np.zeros(shape, dtype=np.float32)
+    im[8:32, 10:38, 12:36] = vals[0]
+    im[12:20, 14:22, 16:24] = vals[1]
+    im[24:28, 30:34, 26:32] = vals[2]
+    return ndi.gaussian_filter(im, 1.5)
+
+
+def save_frames(pth, shifts, shape=(40, 48, 48)):
+    '''save the phantom shifted by the voxel `shifts` as NIfTI frames'''
+    im = phantom(shape)
+    A = np.diag([VXSZ, VXSZ, VXSZ, 1.])
+    fims = []
+    for i, s in enumerate(shifts):
+        fim = pth / f'frame{i:02d}.nii.gz'
+        nib.save(nib.Nifti1Image(ndi.shift(im, s, order=1), A), fim)
+        fims.append(fim)
+    return fims
+
+
+@fixture
+def frames(tmp_path):
+    return save_frames(tmp_path, [(0, 0, 0), (2., -1.5, 1.), (2.5, -1., 1.5)])
+
+
+def test_affine_dipy_regctx(tmp_path, frames):
+    ctx = regseg.dipy_regctx(frames[0], rfwhm=0., **DIPY_KW)
+    assert len(ctx['levels']) == 3
+    assert ctx['levels'][-1]['im'].shape == ctx['im'].shape
+
+    # > cached context vs the standard DIPY pipeline
+    ref = regseg.affine_dipy(frames[0], frames[1], outpath=tmp_path, rfwhm=0., ffwhm=0.,
+                             **DIPY_KW)
+    res = regseg.affine_dipy(None, frames[1], outpath=tmp_path, ffwhm=0., regctx=ctx)
+    trn = VXSZ * np.array([2., -1.5, 1.])
+    assert np.abs(ref['affine'][:3, 3] - trn).max() < .5
+    assert np.abs(res['affine'][:3, 3] - trn).max() < .5
+    assert res['regim'].shape == ref['regim'].shape
+
+    # > warm start from the previous frame
+    res2 = regseg.affine_dipy(None, frames[2], outpath=tmp_path, ffwhm=0., regctx=ctx,
+                              starting_affine=res['affine'])
+    assert np.abs(res2['affine'][:3, 3] - VXSZ * np.array([2.5, -1., 1.5])).max() < .5
+
+
+def test_motion_reg_dipy(tmp_path, frames):
+    out = regseg.motion_reg_dipy(frames[0], frames, outpath=tmp_path, rfwhm=0., ffwhm=0.,
+                                 trn_thresh=3.5, max_workers=2, **DIPY_KW)
+    assert out['affines'].shape == (3, 4, 4)
+    assert [f['trans_mo'] for f in out['frames']] == [False, True, True]
+    assert not any(f['rotat_mo'] for f in out['frames'])
+    assert np.abs(out['frames'][1]['regout']['translations'] -
+                  VXSZ * np.array([2., -1.5, 1.])).max() < .5
+
+    # > the motion-corrected frames are aligned to the reference
+    im = nib.load(out['fnii']).get_fdata()
+    assert im.shape == (40, 48, 48, 3)
+    ref = im[..., 0]
+    for i in (1, 2):
+        assert np.abs(im[4:-4, 4:-4, 4:-4, i] - ref[4:-4, 4:-4, 4:-4]).max() < .1 * ref.max()
+
+
+@mark.parametrize("vals", [(1, 3, 2), (3, .5, 1)], ids=["pet2pet", "mr2pet"])
+@mark.parametrize("masked", [False, True])
+def test_affine_mi(tmp_path, vals, masked):
+    ref = phantom()
+    A = np.diag([VXSZ, VXSZ, VXSZ, 1.])
+    c = A[:3, :3] @ ((np.array(ref.shape) - 1) / 2)
+
+    # > known rigid transformation from the reference to the floating image
+    T = np.eye(4)
+    T[:3, :3] = regmi._mi_transform(np.r_[np.array([4, -3, 5]) * np.pi / 180, 0, 0, 0], 'rigid',
+                                    c, 1.)[0][:3, :3]
+    T[:3, 3] = c + np.array([3., -2., 2.5]) - T[:3, :3] @ c
+    M = np.linalg.inv(A) @ np.linalg.inv(T) @ A
+    flo = ndi.affine_transform(phantom(vals=vals), M[:3, :3], M[:3, 3], order=1)
+
+    fref, fflo = tmp_path / 'ref.nii.gz', tmp_path / 'flo.nii.gz'
+    nib.save(nib.Nifti1Image(ref, A), fref)
+    nib.save(nib.Nifti1Image(flo, A), fflo)
+    rmsk = regseg.create_mask(fspath(fref), thrsh=.05, fwhm=4.) if masked else None
+
+    out = regmi.affine_mi(fref, fflo, outpath=tmp_path, rmsk=rmsk, dev_id=False)
+    assert regseg.aff_dist(np.linalg.inv(T) @ out['affine'], list(c), offset=20) < .5
+    assert out['regim'].shape == ref.shape
+    assert np.allclose(np.load(out['faff']), out['affine'])
+
+
+def test_resample_batch(tmp_path):
+    rng = np.random.default_rng(0)
+    Af = np.diag([1.5, 1.5, 2., 1.])
+    Af[:3, 3] = [-30, -40, -35]
+    Ar = np.diag([2., 2., 2.5, 1.])
+    Ar[:3, 3] = [-35, -45, -30]
+    fref, flbl, fint = (tmp_path / f for f in ('ref.nii.gz', 'lbl.nii.gz', 'int.nii.gz'))
+    nib.save(nib.Nifti1Image(np.zeros((45, 50, 38), dtype=np.float32), Ar), fref)
+    nib.save(nib.Nifti1Image(rng.integers(0, 20, (50, 60, 40)).astype(np.int16), Af), flbl)
+    nib.save(nib.Nifti1Image(rng.random((50, 60, 40)).astype(np.float32), Af), fint)
+
+    # > some reference world to floating world affine
+    A = np.eye(4)
+    A[:3, :3] = regmi._mi_transform(np.r_[.1, -.12, .05, 0, 0, 0], 'rigid', np.zeros(3),
+                                    1.)[0][:3, :3]
+    A[:3, 3] = [2, -3, 1.5]
+
+    out = regseg.resample_batch(fref, [flbl, fint], faff=A, intrp=[0, 1], outpath=tmp_path,
+                                dtype_nifti=[np.int16, np.float32], max_workers=2)
+    for i, f in enumerate((flbl, fint)):
+        ref = regseg.resample_dipy(fref, f, faff=A, intrp=i, outpath=tmp_path,
+                                   fimout=str(tmp_path / f'dipy{i}.nii.gz'))
+        assert np.allclose(out['im'][i], ref['im'], atol=1e-5)
+        assert np.allclose(nib.load(out['fnii'][i]).get_fdata(), out['im'][i], atol=1e-5)
+    assert nib.load(out['fnii'][0]).get_data_dtype() == np.int16
+
+
+if __name__ == "__main__":
+    from pathlib import Path
+    from tempfile import TemporaryDirectory
+    from textwrap import dedent
+    from time import time
+
+    from argopt import argopt
+    from tqdm import tqdm
+    logging.basicConfig(level=logging.WARNING)
+
+    args = argopt(
+        dedent("""\
+        Performance testing of registration of a dynamic series using DIPY
+        with and without the cached reference context (`dipy_regctx`), and
+        using the native MI registration (`affine_mi`).
+        Usage:
+            test_regseg [options]
+
+        Options:
+            -n FRAMES, --frames FRAMES  : number of frames [default: 30:int]
+            -f FWHM, --fwhm FWHM  : smoothing of images [default: 4:float]
+        """)).parse_args()
+
+    rng = np.random.default_rng(0)
+    shifts = np.cumsum(rng.normal(scale=.3, size=(args.frames, 3)), axis=0)
+    with TemporaryDirectory() as tmp:
+        fims = save_frames(Path(tmp), shifts)
+
+        t0 = time()
+        for fim in tqdm(fims[1:], desc="affine_dipy", unit="frame"):
+            regseg.affine_dipy(fims[0], fim, outpath=tmp, rfwhm=args.fwhm, ffwhm=args.fwhm,
+                               **DIPY_KW)
+        tref = (time() - t0) / (len(fims) - 1)
+
+        t0 = time()
+        ctx = regseg.dipy_regctx(fims[0], rfwhm=args.fwhm, **DIPY_KW)
+        A = None
+        for fim in tqdm(fims[1:], desc="affine_dipy+regctx", unit="frame"):
+            A = regseg.affine_dipy(None, fim, outpath=tmp, ffwhm=args.fwhm, regctx=ctx,
+                                   starting_affine=A)['affine']
+        tctx = (time() - t0) / (len(fims) - 1)
+
+        t0 = time()
+        for fim in tqdm(fims[1:], desc="affine_mi", unit="frame"):
+            regmi.affine_mi(fims[0], fim, outpath=tmp, rfwhm=args.fwhm, ffwhm=args.fwhm)
+        tmi = (time() - t0) / (len(fims) - 1)
+
+    print(f"per-frame registration: {tref:.3f} s (default), {tctx:.3f} s (cached, warm start),"
+          f" {tmi:.3f} s (native MI)")
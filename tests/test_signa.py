@@ -0,0 +1,51 @@
+import h5py
+import nibabel as nib
+import numpy as np
+
+from niftypet.nimpa.img import signa
+from niftypet.nimpa.prc import imio
+
+
+def pifa_files(fdir, shape=(45, 64, 64)):
+    '''synthetic PIFA files (object and object with the bed)'''
+    ivv = np.random.default_rng(0).random(shape).astype(np.float32) * .01
+    bed = np.zeros_like(ivv)
+    bed[:, 50:54] = .02
+    for nm, dat in (('pifa_x.h5', ivv + bed), ('pifaIvv_x.h5', ivv)):
+        with h5py.File(fdir / nm, 'w') as f:
+            f['HeaderData/ctacDfov'] = [600.]
+            f['HeaderData/xMatrix'] = [shape[2]]
+            f['HeaderData/zMatrix'] = [shape[0]]
+            f.create_dataset('PifaData', data=dat, chunks=(5,) + shape[1:])
+    return fdir / 'pifa_x.h5', ivv, bed
+
+
+def test_pifa(tmp_path):
+    fpifa, ivv, bed = pifa_files(tmp_path)
+
+    # > mu-map transposed to NIfTI by slabs
+    fnii = signa.pifa2nii(fpifa, outpath=tmp_path / 'nii', slab=7)
+    nii = nib.load(fnii)
+    assert np.array_equal(nii.get_fdata(dtype=np.float32),
+                          np.transpose((ivv + bed)[:, ::-1, :], (2, 1, 0)))
+
+    # > new mu-map blended with the bed
+    mu = 10 * nii.get_fdata(dtype=np.float32)
+    mu[..., :3] = 0.05
+    nib.save(nib.Nifti1Image(mu, nii.affine), tmp_path / 'mu.nii.gz')
+    out = signa.nii2pifa(tmp_path / 'mu.nii.gz', fpifa, outpath=tmp_path / 'out', slab=4)
+
+    msk = bed > .2 * bed.max()
+    # > scaled and flipped axially as in the PIFA
+    new_ivv = .1 * imio.getnii(tmp_path / 'mu.nii.gz')[::-1] * ~msk
+    assert np.allclose(out['opifa'], ivv + bed)
+    assert np.allclose(out['pifa'], np.maximum(bed, new_ivv))
+    with h5py.File(out['fpifa'], 'r') as f, h5py.File(out['fpifa_ivv'], 'r') as f_ivv:
+        assert np.array_equal(f['PifaData'][...], out['pifa'])
+        assert np.allclose(f_ivv['PifaData'][...], new_ivv)
+
+    # > no arrays output (only the files)
+    out2 = signa.nii2pifa(tmp_path / 'mu.nii.gz', fpifa, outpath=tmp_path / 'out2', arrays=False)
+    assert set(out2) == {'fpifa', 'fpifa_ivv'}
+    with h5py.File(out2['fpifa'], 'r') as f:
+        assert np.array_equal(f['PifaData'][...], out['pifa'])